@@ -0,0 +1,204 @@
+
+# coding: utf-8
+
+# # ELS Tissue Priors Workflow
+# Builds the tissue priors for ANTs cortical thickness from the (manually edited) template subject masks
+# that segment_flow delivered to template_proc:
+# * Register each template subject's T1 to the group template (ANTs SyN quick); the T1 is prepared exactly like
+#   template_flow's inputs (FreeSurfer T1 in standard orientation, cropped to the brain), so both sides are skull-on
+# * Warp the subject's 5 tissue masks (CSF, cortical GM, WM, subcortical GM, brain) to the template
+# * Add the warped masks to running per-class sums (memory-mapped float32, one subject at a time)
+# * Normalize the sums into priors
+#
+# Registrations and warps run in parallel across subjects; memory for the sums does not grow with the number of subjects.
+# The sums are kept in prior_state_dir with the sha256 of every subject's delivered masks: a rerun only registers and
+# warps the subjects whose masks were edited (or added), subtracting their old contribution before adding the new one.
+
+# In[ ]:
+
+
+# Import modules
+import os
+from nipype.pipeline.engine import Workflow, Node, MapNode, JoinNode
+from nipype.interfaces.utility import IdentityInterface, Function, Merge
+from nipype.interfaces.io import SelectFiles, FreeSurferSource
+from nipype.interfaces.ants import RegistrationSynQuick, ApplyTransforms
+from ct_tools.delivery import LinkDataSink, deliver_file, delivery_record, record_deliveries
+from ct_tools.profiling import run_profiled
+from ct_tools.result_cache import ResultCache
+from ct_tools.subjects import delivered_subjects
+from ct_tools.tissue_priors import plan_prior_update, update_priors, PRIOR_CLASSES, BRAIN_CLASS
+from ct_tools.volume_io import convert_to_std, crop_to_brain, INTERMEDIATE_EXT, TEMPLATE_CROP
+
+# Set up study specific variables
+project_home = '/share/iang/active/ELS/ELS_FreeSurfer/Analysis'
+fs_subjdir = '/share/iang/active/ELS/ELS_FreeSurfer/Analysis/proc/template_fs6'
+
+workflow_dir = project_home + '/workflows'
+template_proc = project_home + '/proc/template'
+template_file = template_proc + '/sample_template/ELS_CT_template0.nii.gz'
+
+# template subjects with a full set of delivered masks
+mask_containers = ['anats', 'brain_seg', 'gm_files', 'wm_csf']
+template_sub = delivered_subjects(template_proc, mask_containers)
+
+# mask order fed to the accumulator: the 4 ANTs priors, then the brain mask
+class_names = PRIOR_CLASSES + [BRAIN_CLASS]
+reg_threads = 4 # ANTs threads per registration
+
+# The registrations' moving image is the subject's T1 as it went into the template, cropped with template_flow's
+# setting (ct_tools/volume_io.py TEMPLATE_CROP). The reoriented T1s come out of the shared result cache.
+crop_brain = TEMPLATE_CROP['crop_brain']
+crop_margin = TEMPLATE_CROP['margin']
+result_cache_dir = project_home + '/cache'
+result_cache_gb = 50
+if result_cache_dir:
+    ResultCache.setup(result_cache_dir, result_cache_gb)
+
+# Per-node wall/CPU time, peak memory, threads and I/O, written with per-stage summaries to
+# report_dir/<workflow>_<start time>/ (nodes.csv, stages.csv, report.json)
+profile_run = True
+report_dir = project_home + '/reports'
+
+# running sums, the mask checksum index and each subject's warped masks, kept between runs
+# (delete the directory to force a full rebuild)
+prior_state_dir = template_proc + '/priors_state'
+
+
+# In[ ]:
+
+
+######### File handling #########
+
+infosource = Node(IdentityInterface(fields=['subject_id']),
+                  name='infosource')
+
+templates = {'csf': 'wm_csf/{subject_id}/csf.nii*',
+             'cortical_gm': 'gm_files/{subject_id}/cortical_gm.nii*',
+             'wm': 'wm_csf/{subject_id}/wm.nii*',
+             'subcortical_gm': 'gm_files/{subject_id}/subcortical_gm.nii*',
+             'brain': 'brain_seg/{subject_id}/brainmask_bin.nii*'}
+selectfiles = Node(SelectFiles(templates, base_directory=template_proc),
+                   name='selectfiles')
+
+# only subjects whose delivered files changed since their contribution was added (all of them on the first run)
+update_sub, removed_sub, mask_checksums = plan_prior_update(prior_state_dir, template_proc, templates,
+                                                            template_sub, template_file, class_names)
+print('priors_flow: %d of %d subjects to (re)warp, %d to remove' %
+      (len(update_sub), len(template_sub), len(removed_sub)))
+infosource.iterables = ('subject_id', update_sub)
+
+fs_source = Node(FreeSurferSource(subjects_dir=fs_subjdir),
+                 name='fs_source')
+
+#set up datasink
+datasink = Node(LinkDataSink(base_directory = template_proc),
+                name = 'datasink')
+
+
+# In[ ]:
+
+
+######### Tissue priors nodes #########
+
+#the T1 in standard orientation and cropped to the brain, as in template_flow
+reorientT1 = Node(Function(input_names=['in_file', 'out_file', 'orientation', 'cache_dir'],
+                           output_names=['out_file'],
+                           function=convert_to_std),
+                  name='reorientT1')
+reorientT1.inputs.out_file = 'T1' + INTERMEDIATE_EXT['NIFTI']
+reorientT1.inputs.cache_dir = result_cache_dir
+
+cropT1 = Node(Function(input_names=['in_file', 'out_file', 'mask_file', 'margin', 'threshold'],
+                       output_names=['out_file'],
+                       function=crop_to_brain),
+              name='cropT1')
+cropT1.inputs.out_file = 'T1_crop' + INTERMEDIATE_EXT['NIFTI']
+cropT1.inputs.margin = crop_margin
+
+# the skull-on T1 gets registered to the (skull-on) template
+register = Node(RegistrationSynQuick(fixed_image=template_file,
+                                     transform_type='s',
+                                     num_threads=reg_threads),
+                name='register', n_procs=reg_threads)
+
+# masks in class_names order
+merge_masks = Node(Merge(len(class_names)), name='merge_masks')
+
+# ANTs applies transforms last-to-first: affine, then warp
+merge_transforms = Node(Merge(2), name='merge_transforms')
+
+# warp each tissue mask to the template (linear interpolation keeps partial volume)
+warp_masks = MapNode(ApplyTransforms(reference_image=template_file,
+                                     interpolation='Linear',
+                                     float=True),
+                     name='warp_masks',
+                     iterfield=['input_image'])
+
+# swap the updated subjects' warped masks into the running sums and normalize
+# (always rerun: the sums live outside the node directory)
+make_priors = JoinNode(Function(input_names=['warped_masks', 'subject_ids', 'checksums', 'class_names',
+                                             'template_file', 'state_dir', 'removed', 'out_ext'],
+                                output_names=['prior_files', 'brain_prior'],
+                                function=update_priors),
+                       joinsource='infosource',
+                       joinfield=['warped_masks', 'subject_ids'],
+                       name='make_priors',
+                       overwrite=True)
+make_priors.inputs.checksums = mask_checksums
+make_priors.inputs.class_names = class_names
+make_priors.inputs.template_file = template_file
+make_priors.inputs.state_dir = prior_state_dir
+make_priors.inputs.removed = removed_sub
+
+
+# In[ ]:
+
+
+######### Tissue priors workflow #########
+priors_flow = Workflow(name = 'priors_flow')
+priors_flow.connect([(infosource, selectfiles, [('subject_id', 'subject_id')]),
+                     (infosource, make_priors, [('subject_id', 'subject_ids')]),
+                     (infosource, fs_source, [('subject_id', 'subject_id')]),
+                     (fs_source, reorientT1, [('T1', 'in_file')]),
+                     (selectfiles, merge_masks, [('csf', 'in1'),
+                                                 ('cortical_gm', 'in2'),
+                                                 ('wm', 'in3'),
+                                                 ('subcortical_gm', 'in4'),
+                                                 ('brain', 'in5')]),
+                     (register, merge_transforms, [('forward_warp_field', 'in1'),
+                                                   ('out_matrix', 'in2')]),
+                     (merge_masks, warp_masks, [('out', 'input_image')]),
+                     (merge_transforms, warp_masks, [('out', 'transforms')]),
+                     (warp_masks, make_priors, [('output_image', 'warped_masks')]),
+                     (make_priors, datasink, [('prior_files', 'priors'),
+                                              ('brain_prior', 'priors.@brain')])
+                    ])
+if crop_brain:
+    priors_flow.connect([(reorientT1, cropT1, [('out_file', 'in_file')]),
+                         (fs_source, cropT1, [('brainmask', 'mask_file')]),
+                         (cropT1, register, [('out_file', 'moving_image')])])
+else:
+    priors_flow.connect([(reorientT1, register, [('out_file', 'moving_image')])])
+
+priors_flow.base_dir = workflow_dir
+priors_flow.write_graph(graph2use = 'flat')
+if update_sub and profile_run:
+    run_profiled(priors_flow, report_dir, 'MultiProc', {'n_procs': 16})
+elif update_sub:
+    priors_flow.run('MultiProc', plugin_args={'n_procs': 16})
+elif removed_sub:
+    # nothing to warp: take the removed subjects out of the sums and deliver the priors
+    removed_dir = workflow_dir + '/priors_flow/remove_subjects'
+    if not os.path.isdir(removed_dir):
+        os.makedirs(removed_dir)
+    prior_files, brain_prior = update_priors([], [], {}, class_names, template_file, prior_state_dir,
+                                             removed_sub, out_dir=removed_dir)
+    records = []
+    for prior_file in prior_files + [brain_prior]:
+        dst = os.path.join(template_proc, 'priors', os.path.basename(prior_file))
+        records.append(delivery_record(template_proc, dst, prior_file, 'priors', '',
+                                       deliver_file(prior_file, dst)))
+    record_deliveries(template_proc, records)
+else:
+    print('priors_flow: priors in %s are up to date' % prior_state_dir)
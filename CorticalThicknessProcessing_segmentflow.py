@@ -15,13 +15,23 @@
 
 
 # Import modules
-from nipype.pipeline.engine import Workflow, Node, MapNode
+from nipype.pipeline.engine import Workflow, Node, MapNode, JoinNode
 from nipype.interfaces.utility import IdentityInterface, Function
-from nipype.interfaces.io import SelectFiles, DataSink, FreeSurferSource
+from nipype.interfaces.io import SelectFiles, FreeSurferSource
 from nipype.interfaces.fsl.preprocess import FAST
-from nipype.interfaces.fsl.utils import Reorient2Std
-from nipype.interfaces.freesurfer import FSCommand, MRIConvert, Binarize
-from os import listdir
+from nipype.interfaces.freesurfer import FSCommand
+from nipype import config, logging
+from inspect import getsource
+from ct_tools.batching import make_batches, batch_apply
+from ct_tools.delivery import LinkDataSink
+from ct_tools.tissue_maps import binarize_brain_mask
+from ct_tools.tissue_segment import segment_tissues_node
+from ct_tools.profiling import run_profiled
+from ct_tools.subjects import find_new_subjects, record_subjects
+from ct_tools.templates import make3DTemplate
+from ct_tools.result_cache import ResultCache
+from ct_tools.staging import stage_subjects, WriteBack, SEGMENT_FILES
+from ct_tools.volume_io import convert_to_std, crop_to_brain, compress_outputs, INTERMEDIATE_EXT, SEGMENT_CROP
 
 # Set up study specific variables
 project_home = '/share/iang/active/ELS/ELS_FreeSurfer/Analysis'
@@ -41,7 +51,69 @@ group_proc = project_home + '/proc/group'
 template_proc = project_home + '/proc/template'
 #subject_info = project_home + '/misc/subjects.csv' 
 #template_sub = ['011-T1']
-template_sub=listdir(fs_subjdir)
+# only finished subjects (scripts/recon-all.done) that are new or re-run since the last segment_flow run
+subject_manifest = workflow_dir + '/segment_flow_subjects.json'
+template_sub = find_new_subjects(fs_subjdir, subject_manifest)
+
+# Format of files passed between nodes: 'NIFTI' (uncompressed, can be memory-mapped)
+# or 'NIFTI_GZ' (our own nodes write fast level-1 gzip). DataSink outputs are always gzipped.
+intermediate_type = 'NIFTI'
+intermediate_ext = INTERMEDIATE_EXT[intermediate_type]
+sink_compresslevel = 6
+
+# Content-addressed cache shared by both workflows (keyed on input file contents + node parameters).
+# Set result_cache_dir = None to turn it off.
+result_cache_dir = project_home + '/cache'
+result_cache_gb = 50
+if result_cache_dir:
+    ResultCache.setup(result_cache_dir, result_cache_gb)
+
+# Run the lightweight Python nodes (aseg_to_gm, relabel_fast_seg, binarize_brain) batched: one worker per chunk
+# of batch_size subjects instead of one nipype node per subject. 0 = one node per subject.
+batch_size = 0
+
+# Segment only the brain's bounding box plus crop_margin voxels (FAST / numpy engine run on a fraction of the
+# 256^3 field of view). The crop is recorded in the affine; delivered wm_csf masks are put back on the full grid.
+# This is the segmentation's own margin (ct_tools/volume_io.py SEGMENT_CROP), not the template T1 crop.
+crop_brain = SEGMENT_CROP['crop_brain']
+crop_margin = SEGMENT_CROP['margin']
+
+# Tissue segmentation engine: 'fast' (FSL FAST) or 'numpy' (in-process, multi-threaded GMM + MRF
+# from ct_tools.tissue_segment, same tissue_class_files/partial_volume_files outputs)
+segmentation_engine = 'fast'
+segmentation_threads = 4
+
+# Per-node wall/CPU time, peak memory, threads and I/O, written with per-stage summaries to
+# report_dir/<workflow>_<start time>/ (nodes.csv, stages.csv, report.json)
+profile_run = True
+report_dir = project_home + '/reports'
+
+# nipype debug mode keeps every intermediate file and logs verbosely, but slows the run down
+debug_mode = False
+if debug_mode:
+    config.enable_debug_mode()
+    logging.update_logging(config)
+
+# DataSink delivery: 'reflink' clones results into template_proc when it is on the same (copy-on-write) filesystem
+# as the workflow directory and copies them otherwise, 'copy' always copies; copies run delivery_threads at a time.
+# Delivered files are independent, writable files that can be edited in place (e.g. the masks). 'link' also
+# hard-links (no second copy, but edits change the workflow directory's files; result-cache files are still
+# copied). Every delivered file is listed in template_proc/delivered.jsonl (ct_tools.delivery.delivered_files).
+delivery_mode = 'reflink'
+delivery_threads = 4
+
+# Node-local scratch (e.g. os.environ['TMPDIR'] on the compute node): the subjects' FreeSurfer inputs are
+# staged there, the workflow runs there, and DataSink outputs are copied back to template_proc by a background
+# thread pool with sha256 checks. None = read, work and write on /share directly.
+scratch_dir = None
+writeback_threads = 4
+if scratch_dir and template_sub:
+    source_subjdir = stage_subjects(fs_subjdir, template_sub, scratch_dir + '/fs_subjects', SEGMENT_FILES)
+    run_dir = scratch_dir + '/workflows'
+    sink_dir = scratch_dir + '/outbox'
+    writeback = WriteBack(sink_dir, template_proc, writeback_threads)
+else:
+    source_subjdir, run_dir, sink_dir, writeback = fs_subjdir, workflow_dir, template_proc, None
 
 #set default FreeSurfer subjects dir
 FSCommand.set_default_subjects_dir(fs_subjdir)
@@ -53,14 +125,16 @@ FSCommand.set_default_subjects_dir(fs_subjdir)
 ######### File handling #########
 
 #Pass in list to freesurfer source node (subs) 
-fs_source = Node(FreeSurferSource(subjects_dir = fs_subjdir), 
+fs_source = Node(FreeSurferSource(subjects_dir = source_subjdir), 
                  name = 'fs_source')
 fs_source.iterables = ('subject_id', template_sub)
 
 #set up datasink
 substitutions = [('_subject_id_','')]
-datasink = Node(DataSink(base_directory = template_proc, 
-                         substitutions=substitutions),
+datasink = Node(LinkDataSink(base_directory = sink_dir, 
+                             substitutions=substitutions,
+                             delivery_mode=delivery_mode,
+                             delivery_threads=delivery_threads),
                 name = 'datasink')
 
 
@@ -70,39 +144,14 @@ datasink = Node(DataSink(base_directory = template_proc,
 #     - make3DTemplate wraps the ANTs antsMultivariateTemplateConstruction2 script
 # * Template creation Nodes
 # * Template creation workflow steps
-#     - Convert template subjects' FreeSurfer T1 images to nifti 
-#     - Reorient T1s to standard
+#     - Convert template subjects' FreeSurfer T1 images to nifti in standard orientation (single in-process step)
 #     - Pass the T1s to the ANTs template creation script
 
 # In[ ]:
 
 
 ######### Template creation functions #########
-def make3DTemplate(subject_T1s, num_proc, output_prefix):
-    from nipype import config, logging
-    config.enable_debug_mode()
-    logging.update_logging(config)
-    
-    from os.path import abspath, split
-    from os import getcwd
-    from shutil import copyfile
-    from glob import glob
-    from subprocess import call
-
-    curr_dir = getcwd()
-
-    #copy T1s into current directory
-    for T in range(0,len(subject_T1s)):
-        [dirname,filename] = split(subject_T1s[T])
-        copyfile(subject_T1s[T],curr_dir + '/S' + str(T)+'_'+filename)
-
-    # -c flag is control for local computing (2= use localhost; required for -j flag)
-    # -j flag is for number of processors allowed
-    call(['antsMultivariateTemplateConstruction2.sh', '–d','3','–o', output_prefix,'–r','1','–c','2','–j', str(num_proc), '*.nii.gz'])
-    
-    sample_template = abspath(output_prefix + 'template0.nii.gz')
-    
-    return(sample_template)
+# make3DTemplate lives in ct_tools/templates.py; it is shared with the other workflow script
 
 
 # In[ ]:
@@ -110,24 +159,24 @@ def make3DTemplate(subject_T1s, num_proc, output_prefix):
 
 ######### Template creation nodes #########
 
-#convert freesurfer brainmask files to .nii
-convertT1 = MapNode(MRIConvert(out_file='brainmask.nii.gz',
-                               out_type='niigz'), 
-                    name='convertT1', 
-                    iterfield = ['in_file'])
-
-#reorient files to standard space
-reorientT1 = MapNode(Reorient2Std(),
+#convert freesurfer brainmask files to .nii and reorient to standard space
+reorientT1 = MapNode(Function(input_names=['in_file', 'out_file', 'orientation', 'cache_dir'],
+                              output_names=['out_file'],
+                              function=convert_to_std),
                      name = 'reorientT1',
                      iterfield = ['in_file'])
+reorientT1.inputs.out_file = 'brainmask' + intermediate_ext
+reorientT1.inputs.cache_dir = result_cache_dir
 
 #pass files into template function (normalized, pre-skull-stripping)
-makeTemplate = Node(Function(input_names=['subject_T1s','num_proc','output_prefix'],
+makeTemplate = Node(Function(input_names=['subject_T1s','num_proc','output_prefix',
+                                          'parallel_mode','iterations','ants_script','extra_args'],
                              output_names=['sample_template'],
                              function=make3DTemplate),
                     name='makeTemplate')
 makeTemplate.inputs.num_proc=8 # feel free to change to suit what's free on SNI-VCS
 makeTemplate.inputs.output_prefix='ELS_CT_'
+makeTemplate.inputs.parallel_mode='local' # 'local', 'serial', 'sge', 'pbs' or 'slurm'
 
 
 # ## Template Subject Tissue Segmentation Workflow
@@ -135,7 +184,7 @@ makeTemplate.inputs.output_prefix='ELS_CT_'
 # * Custom functions
 # * Nodes
 # * Workflow
-#     - FSL's FAST is used to segment CSF and WM
+#     - FSL's FAST is used to segment CSF and WM (on the brain's bounding box, results put back on the full grid)
 #     - FreeSurfer's automated segmentation is used to segment subcortical and cortical GM
 #     - FreeSurfer's brainmask is binarized for whole brain extraction
 # 
@@ -147,106 +196,157 @@ makeTemplate.inputs.output_prefix='ELS_CT_'
 ######### Tissue creation nodes: segment template subjects to 5 tissue classes #########
 ### 1)CSF, 2)cortical gray matter, 3)white matter, 4)subcortical gray matter, and 5)whole brain
 
-def relabel_fast(fast_tissue_list):
-    from nipype import config, logging
-    from os.path import split
-    from os import rename
-    config.enable_debug_mode()
-    logging.update_logging(config)
+# FAST's class numbering is not tied to tissue type, so classes are identified by their mean
+# T1 intensity (CSF darkest, WM brightest) within FAST's partial volume maps. FAST's own files
+# are never renamed, which keeps its cached results valid; csf/wm are links in this node's directory.
+# When FAST ran on the brain bounding box (crop_brain), t1_file is the full-FOV volume: it is cropped the same way
+# for the class means, and csf/wm are written back on the full grid instead of being linked.
+def relabel_fast(fast_tissue_list, t1_file, fast_pve_list=None):
+    from os import link, remove, symlink
+    from os.path import abspath, basename, lexists
+    import nibabel as nib
+    from ct_tools.tissue_maps import order_classes_by_intensity
+    from ct_tools.volume_io import crop_offsets, load_volume, uncrop_image
     tissue_list = sorted(fast_tissue_list)
-    csf = tissue_list[0]
-    wm = tissue_list[2]
-    [wd, csf_file] = split(csf)
-    [wd, wm_file] = split(wm)
-    rename(csf, wd + 'csf.nii.gz')
-    rename(wm, wd + 'wm.nii.gz')
-    wm_csf = [wd + 'csf.nii.gz', wd + 'wm.nii.gz']
+    class_maps = sorted(fast_pve_list) if fast_pve_list else tissue_list
+    t1_img, t1_data = load_volume(t1_file)
+    class_imgs = [load_volume(f) for f in class_maps]
+    class_img = class_imgs[0][0]
+    cropped = class_img.shape[:3] != t1_img.shape[:3]
+    if cropped:
+        offsets = crop_offsets(class_img, t1_img)
+        t1_data = t1_data[tuple(slice(o, o + n) for o, n in zip(offsets, class_img.shape[:3]))]
+    order, means = order_classes_by_intensity(t1_data, [data for img, data in class_imgs])
+    csf = tissue_list[order[0]]
+    wm = tissue_list[order[-1]]
+
+    wm_csf = []
+    for tissue, fast_file in [('csf', csf), ('wm', wm)]:
+        ext = '.nii.gz' if basename(fast_file).endswith('.nii.gz') else '.nii'
+        out_file = abspath(tissue + ext)
+        if lexists(out_file):
+            remove(out_file)
+        if cropped:
+            nib.save(uncrop_image(nib.load(fast_file), t1_img), out_file)
+        else:
+            try:
+                link(fast_file, out_file)
+            except OSError:
+                symlink(fast_file, out_file)
+        wm_csf.append(out_file)
     return(wm_csf)
 
 # Create subcortical and cortical gray matter masks <-- custom function. inputs: fs aseg + tissue class files
-def aseg_to_tissuemaps(aseg):
-    from nipype import config, logging
-    config.enable_debug_mode()
-    logging.update_logging(config)
-    from nibabel import load, save, Nifti1Image
-    from numpy import zeros_like
+# label_scheme is an ordered {tissue name: [aseg labels]} dict; the default is DEFAULT_LABEL_SCHEME in ct_tools.tissue_maps
+def aseg_to_tissuemaps(aseg, label_scheme=None, out_ext='.nii.gz', cache_dir=None):
     from os.path import abspath
-    aseg_nifti = load(aseg)
-    aseg_data = aseg_nifti.get_data()
-    cortical_labels = [3, 42]
-    subcortical_labels =[8, 10, 11, 12, 13, 17, 18, 26, 47, 49, 50, 51, 52, 53, 54, 58]
-
-    #creating array of zeroes that replaces 0's with 1's when matches values of subcortical_labels
-    cortical_data = zeros_like(aseg_data)
-    for x in cortical_labels:
-        cortical_data[aseg_data == x] = 1
-    cortical_nifti = Nifti1Image(cortical_data, aseg_nifti.affine)
-    
-    subcort_data = zeros_like(aseg_data) 
-    for x in subcortical_labels:
-        subcort_data[aseg_data == x] = 1
-    subcort_nifti = Nifti1Image(subcort_data, aseg_nifti.affine)
-    
-    save(subcort_nifti, "subcortical_gm.nii.gz")
-    save(cortical_nifti, "cortical_gm.nii.gz")
-    subcort_file = abspath("subcortical_gm.nii.gz")
-    cortical_file = abspath("cortical_gm.nii.gz")
-    gm_list = [subcort_file, cortical_file]
+    from ct_tools.tissue_maps import labels_to_tissue_masks
+    from ct_tools.volume_io import load_volume, save_mask
+    def _tissuemaps():
+        #labels stay in their on-disk integer dtype (memory-mapped when uncompressed)
+        aseg_nifti, aseg_data = load_volume(aseg)
+
+        #map every label to its tissue class in one pass over the volume (uint8 masks)
+        tissue_masks = labels_to_tissue_masks(aseg_data, label_scheme)
+
+        gm_list = []
+        for tissue, mask in tissue_masks.items():
+            save_mask(mask, aseg_nifti, tissue + out_ext)
+            gm_list.append(abspath(tissue + out_ext))
+        return(gm_list)
+
+    if cache_dir:
+        from ct_tools.result_cache import ResultCache
+        params = {'label_scheme': label_scheme, 'out_ext': out_ext}
+        gm_list = ResultCache(cache_dir).run('aseg_to_tissuemaps', [aseg], params, _tissuemaps,
+                                             modules=('ct_tools.tissue_maps', 'ct_tools.volume_io'))
+    else:
+        gm_list = _tissuemaps()
     return(gm_list)
 
 
 # In[ ]:
 
 
-#convert freesurfer brainmask files to .nii
-convert_to_nii = Node(MRIConvert(out_file='brainmask.nii.gz',
-                                 out_type='niigz'), 
-                      name='convert_to_nii', 
-                      iterfield = ['in_file'])
-
-#reorient brainmask file to standard
-reorient_to_std = Node(Reorient2Std(),
-                       name = 'reorient_to_std',
-                       iterfield = ['in_file'])
-
-# Reorient aseg to standard
-reorient_aseg = Node(Reorient2Std(),
-                     name = 'reorient_aseg',
-                     iterfield = ['in_file'])
+#convert freesurfer brainmask to .nii and reorient to standard in one step
+reorient_to_std = Node(Function(input_names=['in_file', 'out_file', 'orientation', 'cache_dir'],
+                                output_names=['out_file'],
+                                function=convert_to_std),
+                       name = 'reorient_to_std')
+reorient_to_std.inputs.out_file = 'brainmask' + intermediate_ext
+reorient_to_std.inputs.cache_dir = result_cache_dir
+
+# Convert freesurfer aseg to .nii and reorient to standard
+reorient_aseg = Node(Function(input_names=['in_file', 'out_file', 'orientation', 'cache_dir'],
+                              output_names=['out_file'],
+                              function=convert_to_std),
+                     name = 'reorient_aseg')
+reorient_aseg.inputs.out_file = 'aseg' + intermediate_ext
+reorient_aseg.inputs.cache_dir = result_cache_dir
+
+# trim the brainmask to the brain's bounding box (+ margin) before segmentation
+crop_to_std = Node(Function(input_names=['in_file', 'out_file', 'mask_file', 'margin', 'threshold'],
+                            output_names=['out_file'],
+                            function=crop_to_brain),
+                   name = 'crop_to_std')
+crop_to_std.inputs.out_file = 'brainmask_crop' + intermediate_ext
+crop_to_std.inputs.margin = crop_margin
 
 #T1 gets run through segmentation (2) ---> results in segmentation into 3 tissue classes (wm, gm, csf)
-segment = Node(FAST(number_classes = 3, 
-                    segments=True, 
-                    no_bias=True), 
-               name = 'segment', 
-               iterfield = ['in_files'])
-
-# Convert freesurfer aseg to nii
-convert_aseg = Node(MRIConvert(out_file='aseg.nii.gz',
-                               out_type='niigz'), 
-                    name='convert_aseg',
-                    iterfield = ['in_file'])
+if segmentation_engine == 'fast':
+    segment = Node(FAST(number_classes = 3, 
+                        segments=True, 
+                        no_bias=True,
+                        output_type=intermediate_type), 
+                   name = 'segment', 
+                   iterfield = ['in_files'])
+else:
+    segment = Node(Function(input_names=['in_files', 'number_classes', 'out_basename', 'out_ext',
+                                         'mrf_beta', 'mrf_iter', 'n_threads'],
+                            output_names=['tissue_class_files', 'partial_volume_files'],
+                            function=segment_tissues_node),
+                   name = 'segment')
+    segment.inputs.number_classes = 3
+    segment.inputs.out_ext = intermediate_ext
+    segment.inputs.n_threads = segmentation_threads
+    segment.n_procs = segmentation_threads
 
 # Split aseg into to types of gray matter
-aseg_to_gm = Node(Function(input_names=['aseg'],
+aseg_to_gm = Node(Function(input_names=['aseg', 'label_scheme', 'out_ext', 'cache_dir'],
                            output_names=['gm_list'],
                            function=aseg_to_tissuemaps),
                   name='aseg_to_gm', 
                   iterfield=['aseg'])
+aseg_to_gm.inputs.out_ext = intermediate_ext
+aseg_to_gm.inputs.cache_dir = result_cache_dir
 
 # Relabel the FAST segmentation 
-relabel_fast_seg = Node(Function(input_names=['fast_tissue_list'],
+relabel_fast_seg = Node(Function(input_names=['fast_tissue_list', 't1_file', 'fast_pve_list'],
                                  output_names=['wm_csf'],
                                  function=relabel_fast),
                         name='relabel_fast_seg',
                         iterfield=['fast_tissue_list'])
 
-# make brainmask by binarizing the brainmask
-binarize_brain = Node(Binarize(min=1, 
-                               dilate=1, 
-                               erode=1), 
-                      name='binarize_brain', 
-                      iterfield=['in_file'])
+# make brainmask by binarizing the brainmask (threshold + one dilate/erode pass, as mri_binarize did)
+binarize_brain = Node(Function(input_names=['in_file', 'out_file', 'min', 'dilate', 'erode'],
+                               output_names=['binary_file'],
+                               function=binarize_brain_mask),
+                      name='binarize_brain')
+binarize_brain.inputs.out_file = 'brainmask_bin' + intermediate_ext
+binarize_brain.inputs.min = 1
+binarize_brain.inputs.dilate = 1
+binarize_brain.inputs.erode = 1
+
+# gzip the uncompressed intermediates on their way to the datasink
+gzip_anat = Node(Function(input_names=['in_files', 'compresslevel'],
+                          output_names=['out_files'],
+                          function=compress_outputs),
+                 name='gzip_anat')
+gzip_brain_seg = gzip_anat.clone('gzip_brain_seg')
+gzip_gm_files = gzip_anat.clone('gzip_gm_files')
+gzip_wm_csf = gzip_anat.clone('gzip_wm_csf')
+for gzip_node in [gzip_anat, gzip_brain_seg, gzip_gm_files, gzip_wm_csf]:
+    gzip_node.inputs.compresslevel = sink_compresslevel
 
 
 # In[ ]:
@@ -254,20 +354,118 @@ binarize_brain = Node(Binarize(min=1,
 
 ######### Tissue segmentation workflow #########
 segment_flow = Workflow(name = "segment_flow")
-segment_flow.connect([(fs_source, convert_to_nii, [('brainmask','in_file')]),
-                      (convert_to_nii, reorient_to_std, [('out_file', 'in_file')]),
-                      (reorient_to_std, segment, [('out_file', 'in_files')]),
-                      (segment, relabel_fast_seg, [('tissue_class_files', 'fast_tissue_list')]),
-                      (fs_source, convert_aseg, [('aseg','in_file')]),
-                      (convert_aseg, reorient_aseg, [('out_file', 'in_file')]),
-                      (reorient_aseg, aseg_to_gm, [('out_file', 'aseg')]),
-                      (reorient_to_std, binarize_brain, [('out_file','in_file')]),
-                      (reorient_to_std, datasink, [('out_file','anats')]),
-                      (binarize_brain, datasink, [('binary_file','brain_seg')]),
-                      (aseg_to_gm, datasink, [('gm_list', 'gm_files')]),
-                      (relabel_fast_seg, datasink, [('wm_csf', 'wm_csf')])
+segment_flow.connect([(fs_source, reorient_to_std, [('brainmask','in_file')]),
+                      (fs_source, reorient_aseg, [('aseg','in_file')]),
+                      (reorient_to_std, gzip_anat, [('out_file','in_files')]),
+                      (gzip_anat, datasink, [('out_files','anats')])
                      ])
-
-segment_flow.base_dir = workflow_dir
+if crop_brain:
+    segment_flow.connect([(reorient_to_std, crop_to_std, [('out_file', 'in_file')]),
+                          (crop_to_std, segment, [('out_file', 'in_files')])])
+else:
+    segment_flow.connect([(reorient_to_std, segment, [('out_file', 'in_files')])])
+
+if not batch_size:
+    segment_flow.connect([(reorient_to_std, binarize_brain, [('out_file','in_file')]),
+                          (binarize_brain, gzip_brain_seg, [('binary_file','in_files')]),
+                          (gzip_brain_seg, datasink, [('out_files','brain_seg')]),
+                          (segment, relabel_fast_seg, [('tissue_class_files', 'fast_tissue_list'),
+                                                       ('partial_volume_files', 'fast_pve_list')]),
+                          (reorient_to_std, relabel_fast_seg, [('out_file', 't1_file')]),
+                          (reorient_aseg, aseg_to_gm, [('out_file', 'aseg')]),
+                          (aseg_to_gm, gzip_gm_files, [('gm_list', 'in_files')]),
+                          (relabel_fast_seg, gzip_wm_csf, [('wm_csf', 'in_files')]),
+                          (gzip_gm_files, datasink, [('out_files', 'gm_files')]),
+                          (gzip_wm_csf, datasink, [('out_files', 'wm_csf')])
+                         ])
+else:
+    # join the per-subject inputs (in template_sub order) and split them into chunks
+    join_aseg = JoinNode(Function(input_names=['in_files', 'subject_ids', 'chunk_size'],
+                                  output_names=['subject_batches', 'file_batches'],
+                                  function=make_batches),
+                         joinsource='fs_source',
+                         joinfield=['in_files'],
+                         name='join_aseg')
+    join_aseg.inputs.subject_ids = template_sub
+    join_aseg.inputs.chunk_size = batch_size
+    join_fast = JoinNode(Function(input_names=['in_files', 'subject_ids', 'chunk_size',
+                                               'in_files2', 'in_files3'],
+                                  output_names=['subject_batches', 'file_batches'],
+                                  function=make_batches),
+                         joinsource='fs_source',
+                         joinfield=['in_files', 'in_files2', 'in_files3'],
+                         name='join_fast')
+    join_fast.inputs.subject_ids = template_sub
+    join_fast.inputs.chunk_size = batch_size
+
+    # one worker per chunk; outputs go straight to template_proc/<container>/<subject>/
+    batch_inputs = ['function_source', 'arg_name', 'subject_ids', 'in_files', 'params',
+                    'sink_dir', 'container', 'sink_compresslevel', 'delivery_mode']
+    aseg_to_gm_batch = MapNode(Function(input_names=batch_inputs,
+                                        output_names=['gm_lists'],
+                                        function=batch_apply),
+                               name='aseg_to_gm_batch',
+                               iterfield=['subject_ids', 'in_files'])
+    aseg_to_gm_batch.inputs.function_source = getsource(aseg_to_tissuemaps)
+    aseg_to_gm_batch.inputs.arg_name = 'aseg'
+    aseg_to_gm_batch.inputs.params = {'out_ext': intermediate_ext, 'cache_dir': result_cache_dir}
+    aseg_to_gm_batch.inputs.container = 'gm_files'
+
+    relabel_fast_batch = MapNode(Function(input_names=batch_inputs,
+                                          output_names=['wm_csf_lists'],
+                                          function=batch_apply),
+                                 name='relabel_fast_batch',
+                                 iterfield=['subject_ids', 'in_files'])
+    relabel_fast_batch.inputs.function_source = getsource(relabel_fast)
+    relabel_fast_batch.inputs.arg_name = ['fast_tissue_list', 'fast_pve_list', 't1_file']
+    relabel_fast_batch.inputs.container = 'wm_csf'
+
+    binarize_brain_batch = MapNode(Function(input_names=batch_inputs,
+                                            output_names=['binary_files'],
+                                            function=batch_apply),
+                                   name='binarize_brain_batch',
+                                   iterfield=['subject_ids', 'in_files'])
+    binarize_brain_batch.inputs.function_source = getsource(binarize_brain_mask)
+    binarize_brain_batch.inputs.arg_name = 'in_file'
+    binarize_brain_batch.inputs.params = {'out_file': 'brainmask_bin' + intermediate_ext,
+                                          'min': 1, 'dilate': 1, 'erode': 1}
+    binarize_brain_batch.inputs.container = 'brain_seg'
+    join_brain = join_aseg.clone('join_brain')
+
+    for batch_node in [aseg_to_gm_batch, relabel_fast_batch, binarize_brain_batch]:
+        batch_node.inputs.sink_dir = sink_dir
+        batch_node.inputs.sink_compresslevel = sink_compresslevel
+        batch_node.inputs.delivery_mode = delivery_mode
+
+    segment_flow.connect([(reorient_aseg, join_aseg, [('out_file', 'in_files')]),
+                          (join_aseg, aseg_to_gm_batch, [('subject_batches', 'subject_ids'),
+                                                         ('file_batches', 'in_files')]),
+                          (segment, join_fast, [('tissue_class_files', 'in_files'),
+                                                ('partial_volume_files', 'in_files2')]),
+                          (reorient_to_std, join_fast, [('out_file', 'in_files3')]),
+                          (join_fast, relabel_fast_batch, [('subject_batches', 'subject_ids'),
+                                                           ('file_batches', 'in_files')]),
+                          (reorient_to_std, join_brain, [('out_file', 'in_files')]),
+                          (join_brain, binarize_brain_batch, [('subject_batches', 'subject_ids'),
+                                                              ('file_batches', 'in_files')])
+                         ])
+
+segment_flow.base_dir = run_dir
 segment_flow.write_graph(graph2use = 'flat')
-segment_flow.run('MultiProc', plugin_args={'n_procs': 10})
\ No newline at end of file
+if template_sub:
+    plugin_args = {'n_procs': 10}
+    if writeback:
+        # each subject's sink outputs start copying back as soon as its datasink finishes
+        plugin_args['status_callback'] = writeback.callback
+    try:
+        if profile_run:
+            run_profiled(segment_flow, report_dir, 'MultiProc', plugin_args)
+        else:
+            segment_flow.run('MultiProc', plugin_args=plugin_args)
+    finally:
+        if writeback:
+            writeback.sync()
+            writeback.close()
+    record_subjects(subject_manifest, fs_subjdir, template_sub)
+else:
+    print('segment_flow: no new or changed subjects in ' + fs_subjdir)
\ No newline at end of file
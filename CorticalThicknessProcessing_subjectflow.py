@@ -0,0 +1,162 @@
+
+# coding: utf-8
+
+# # ELS Subject Cortical Thickness Workflow
+# Runs ANTs antsCorticalThickness on every finished FreeSurfer session, using the group template and
+# the tissue priors that template_flow and priors_flow delivered to template_proc.
+#
+# Every node declares its threads (n_procs, which also sets ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS for ANTs)
+# and memory (mem_gb), so MultiProc packs sessions onto the cores and memory without oversubscribing.
+
+# In[ ]:
+
+
+# Import modules
+from nipype.pipeline.engine import Workflow, Node
+from nipype.interfaces.utility import Function
+from nipype.interfaces.io import FreeSurferSource
+from nipype.interfaces.ants import CorticalThickness
+from nipype.interfaces.freesurfer import FSCommand
+from os import cpu_count
+from ct_tools.delivery import LinkDataSink
+from ct_tools.group_cube import GroupCube
+from ct_tools.profiling import run_profiled
+from ct_tools.regional import thickness_files
+from ct_tools.resources import plan_threads, set_node_resources
+from ct_tools.subjects import completed_subjects
+from ct_tools.volume_io import convert_to_std
+
+# Set up study specific variables
+project_home = '/share/iang/active/ELS/ELS_FreeSurfer/Analysis'
+fs_subjdir = '/share/iang/active/ELS/ELS_FreeSurfer/ELS_FS_subjDir'
+
+workflow_dir = project_home + '/workflows'
+subj_proc = project_home + '/proc/subject'
+group_proc = project_home + '/proc/group'
+template_proc = project_home + '/proc/template'
+
+template_file = template_proc + '/sample_template/ELS_CT_template0.nii.gz'
+brain_prior = template_proc + '/priors/brain_prior.nii.gz'
+segmentation_priors = [template_proc + '/priors/segmentationPriors%d.nii.gz' % k for k in range(1, 5)]
+
+# every finished session (scripts/recon-all.done)
+subjects_list = list(completed_subjects(fs_subjdir))
+
+# Resources: total cores/memory handed to MultiProc and the need of one antsCorticalThickness run
+total_cores = cpu_count()
+total_mem_gb = 64
+ct_mem_gb = 8
+ct_threads, ct_concurrent = plan_threads(len(subjects_list), total_cores, total_mem_gb, ct_mem_gb,
+                                         min_threads=2, max_threads=8)
+
+# DataSink delivery into subj_proc ('reflink', 'copy' or the opt-in hard-linking 'link', see ct_tools.delivery);
+# delivered files are listed in subj_proc/delivered.jsonl
+delivery_mode = 'reflink'
+delivery_threads = 4
+
+# After the run, every session's template-space thickness map (in-mask voxels of the brain prior) is packed into
+# one memory-mapped float32 (sessions x voxels) matrix with a subject/session index (ct_tools.group_cube);
+# new sessions are appended, re-run ones overwritten in place.
+cube_dir = group_proc + '/thickness_cube'
+cube_mask_threshold = 0.5
+
+# Per-node wall/CPU time, peak memory, threads and I/O, written with per-stage summaries to
+# report_dir/<workflow>_<start time>/ (nodes.csv, stages.csv, report.json)
+profile_run = True
+report_dir = project_home + '/reports'
+
+#set default FreeSurfer subjects dir
+FSCommand.set_default_subjects_dir(fs_subjdir)
+
+
+# In[ ]:
+
+
+######### File handling #########
+
+fs_source = Node(FreeSurferSource(subjects_dir = fs_subjdir),
+                 name = 'fs_source')
+fs_source.iterables = ('subject_id', subjects_list)
+
+#set up datasink
+substitutions = [('_subject_id_','')]
+datasink = Node(LinkDataSink(base_directory = subj_proc,
+                             substitutions=substitutions,
+                             delivery_mode=delivery_mode,
+                             delivery_threads=delivery_threads),
+                name = 'datasink')
+
+
+# In[ ]:
+
+
+######### Cortical thickness nodes #########
+
+#convert the freesurfer T1 to .nii in standard orientation (same as the template inputs)
+reorientT1 = Node(Function(input_names=['in_file', 'out_file', 'orientation', 'cache_dir'],
+                           output_names=['out_file'],
+                           function=convert_to_std),
+                  name = 'reorientT1', n_procs=1, mem_gb=0.5)
+reorientT1.inputs.out_file = 'T1.nii.gz'
+
+corticalthickness = Node(CorticalThickness(dimension=3,
+                                           brain_template=template_file,
+                                           brain_probability_mask=brain_prior,
+                                           segmentation_priors=segmentation_priors,
+                                           t1_registration_template=template_file,
+                                           out_prefix='antsCT_'),
+                         name = 'corticalthickness', n_procs=ct_threads, mem_gb=ct_mem_gb)
+set_node_resources(corticalthickness, ct_threads)
+# keep the files nipype does not list as outputs (see thickness_to_template)
+corticalthickness.config = {'execution': {'remove_unnecessary_outputs': False}}
+
+# nipype's CorticalThicknessNormedToTemplate output names the subject-space map; antsCorticalThickness.sh writes the
+# template-space one next to it as <prefix>CorticalThicknessNormalizedToTemplate
+def normalized_thickness(cortical_thickness):
+    from os.path import exists
+    out_file = cortical_thickness.replace('CorticalThickness.', 'CorticalThicknessNormalizedToTemplate.')
+    if not exists(out_file):
+        raise IOError('no template-space thickness map %s' % out_file)
+    return(out_file)
+
+thickness_to_template = Node(Function(input_names=['cortical_thickness'],
+                                      output_names=['out_file'],
+                                      function=normalized_thickness),
+                             name = 'thickness_to_template', n_procs=1, mem_gb=0.1)
+
+
+# In[ ]:
+
+
+######### Cortical thickness workflow #########
+subject_flow = Workflow(name = 'subject_flow')
+subject_flow.connect([(fs_source, reorientT1, [('T1','in_file')]),
+                      (reorientT1, corticalthickness, [('out_file','anatomical_image')]),
+                      (corticalthickness, thickness_to_template, [('CorticalThickness', 'cortical_thickness')]),
+                      (thickness_to_template, datasink, [('out_file', 'cortical_thickness_template')]),
+                      (corticalthickness, datasink, [('CorticalThickness','cortical_thickness'),
+                                                     ('BrainSegmentation','brain_segmentation'),
+                                                     ('BrainSegmentationPosteriors','posteriors'),
+                                                     ('BrainExtractionMask','brain_mask'),
+                                                     ('SubjectToTemplate1Warp','transforms.@warp'),
+                                                     ('SubjectToTemplate0GenericAffine','transforms.@affine'),
+                                                     ('SubjectToTemplateLogJacobian','transforms.@logjacobian'),
+                                                     ('BrainVolumes','brain_volumes')])
+                     ])
+
+subject_flow.base_dir = workflow_dir
+subject_flow.write_graph(graph2use = 'flat')
+print('subject_flow: %d sessions, %d at a time with %d threads each' % (len(subjects_list), ct_concurrent, ct_threads))
+plugin_args = {'n_procs': total_cores, 'memory_gb': total_mem_gb}
+if profile_run:
+    run_profiled(subject_flow, report_dir, 'MultiProc', plugin_args)
+else:
+    subject_flow.run('MultiProc', plugin_args=plugin_args)
+
+# pack the template-space thickness maps for group analysis
+cube = GroupCube.open_or_create(cube_dir, brain_prior, cube_mask_threshold)
+template_maps = thickness_files(subj_proc, 'cortical_thickness_template')
+cube_sessions = [sub for sub in subjects_list if sub in template_maps]
+added, replaced = cube.append([template_maps[sub] for sub in cube_sessions], cube_sessions)
+print('thickness cube: %d sessions x %d voxels (%d added, %d replaced)' %
+      (len(cube), cube.n_voxels, len(added), len(replaced)))
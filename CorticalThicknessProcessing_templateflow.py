@@ -7,11 +7,18 @@
 # Import modules
 from nipype.pipeline.engine import Workflow, Node, MapNode
 from nipype.interfaces.utility import IdentityInterface, Function
-from nipype.interfaces.io import SelectFiles, DataSink, FreeSurferSource
+from nipype.interfaces.io import SelectFiles, FreeSurferSource
 from nipype.interfaces.fsl.preprocess import FAST
-from nipype.interfaces.fsl.utils import Reorient2Std
-from nipype.interfaces.freesurfer import FSCommand, MRIConvert
-from os import listdir
+from nipype.interfaces.freesurfer import FSCommand
+from nipype import config, logging
+from ct_tools.delivery import LinkDataSink
+from ct_tools.profiling import run_profiled
+from ct_tools.subjects import completed_subjects
+from ct_tools.templates import make3DTemplate, make_subject_templates, group_sessions
+from ct_tools.resources import plan_threads
+from ct_tools.result_cache import ResultCache
+from ct_tools.staging import stage_subjects, WriteBack, TEMPLATE_FILES
+from ct_tools.volume_io import convert_to_std, crop_to_brain, compress_outputs, INTERMEDIATE_EXT, TEMPLATE_CROP
 
 # Set up study specific variables
 #project_home = '/Volumes/iang/active/ELS/ELS_FreeSurfer/Analysis'
@@ -30,7 +37,76 @@ group_proc = project_home + '/proc/group'
 template_proc = project_home + '/proc/template'
 #subject_info = project_home + '/misc/subjects.csv' 
 #template_sub = ['011-T1']
-template_sub=listdir(fs_subjdir)
+# the template is built from every finished subject (scripts/recon-all.done), not just new ones
+template_sub = list(completed_subjects(fs_subjdir))
+
+# Format of files passed between nodes: 'NIFTI' (uncompressed, can be memory-mapped)
+# or 'NIFTI_GZ' (our own nodes write fast level-1 gzip). DataSink outputs are always gzipped.
+intermediate_type = 'NIFTI'
+intermediate_ext = INTERMEDIATE_EXT[intermediate_type]
+sink_compresslevel = 6
+
+# Build the template from the T1s cropped to the brain's bounding box (from FreeSurfer's brainmask) plus
+# crop_margin voxels, so registrations skip most of the empty 256^3 field of view. The crop is recorded in the
+# affines, and the template field of view follows the cropped inputs. priors_flow registers the same cropped
+# T1s to the template, so the setting is shared: change it in ct_tools/volume_io.py (TEMPLATE_CROP).
+crop_brain = TEMPLATE_CROP['crop_brain']
+crop_margin = TEMPLATE_CROP['margin']
+
+# Two-level template: first one within-subject template per participant from its sessions (<participant>-T1, -Tmid,
+# -T2, -TK1, ...), participants built in parallel in a process pool; then the group template from those. With the
+# result cache on, only participants with new or changed sessions are rebuilt. False = every session is an input
+# of the group template.
+two_level_template = True
+subject_template_cores = 16 # cores shared by the within-subject templates
+
+# Template iterations: at most template_iterations, run one at a time; each iteration's change from the previous
+# template (normalized RMS difference) is logged and compared with template_tolerance, and the build stops once it
+# is smaller (None = always run every iteration). Every iteration's template and a template_convergence.csv are
+# kept in template_state_dir/group_template (and subject_templates/<participant>), so a rerun after a crash resumes
+# after the last finished iteration.
+template_iterations = 4
+template_tolerance = 0.002
+template_state_dir = template_proc + '/template_state'
+
+# Content-addressed cache shared by both workflows (keyed on input file contents + node parameters).
+# Set result_cache_dir = None to turn it off.
+result_cache_dir = project_home + '/cache'
+result_cache_gb = 50
+if result_cache_dir:
+    ResultCache.setup(result_cache_dir, result_cache_gb)
+
+# Per-node wall/CPU time, peak memory, threads and I/O, written with per-stage summaries to
+# report_dir/<workflow>_<start time>/ (nodes.csv, stages.csv, report.json)
+profile_run = True
+report_dir = project_home + '/reports'
+
+# nipype debug mode keeps every intermediate file and logs verbosely, but slows the run down
+debug_mode = False
+if debug_mode:
+    config.enable_debug_mode()
+    logging.update_logging(config)
+
+# DataSink delivery: 'reflink' clones results into template_proc when it is on the same (copy-on-write) filesystem
+# as the workflow directory and copies them otherwise, 'copy' always copies; copies run delivery_threads at a time.
+# Delivered files are independent, writable files that can be edited in place. 'link' also
+# hard-links (no second copy, but edits change the workflow directory's files; result-cache files are still
+# copied). Every delivered file is listed in template_proc/delivered.jsonl (ct_tools.delivery.delivered_files).
+delivery_mode = 'reflink'
+delivery_threads = 4
+
+# Node-local scratch (e.g. os.environ['TMPDIR'] on the compute node): the subjects' FreeSurfer inputs are
+# staged there, the workflow runs there, and DataSink outputs are copied back to template_proc by a background
+# thread pool with sha256 checks. None = read, work and write on /share directly.
+scratch_dir = None
+writeback_threads = 4
+if scratch_dir and template_sub:
+    source_subjdir = stage_subjects(fs_subjdir, template_sub, scratch_dir + '/fs_subjects', TEMPLATE_FILES)
+    run_dir = scratch_dir + '/workflows'
+    sink_dir = scratch_dir + '/outbox'
+    writeback = WriteBack(sink_dir, template_proc, writeback_threads)
+else:
+    source_subjdir, run_dir, sink_dir, writeback = fs_subjdir, workflow_dir, template_proc, None
 
 #set default FreeSurfer subjects dir
 FSCommand.set_default_subjects_dir(fs_subjdir)
@@ -42,12 +118,14 @@ FSCommand.set_default_subjects_dir(fs_subjdir)
 ######### File handling #########
 
 #Pass in list to freesurfer source node (subs) 
-fs_source = MapNode(FreeSurferSource(subjects_dir = fs_subjdir), 
+fs_source = MapNode(FreeSurferSource(subjects_dir = source_subjdir), 
                     name = 'fs_source', iterfield = ['subject_id'])
 fs_source.inputs.subject_id = template_sub
 
 #set up datasink
-datasink = Node(DataSink(base_directory = template_proc),
+datasink = Node(LinkDataSink(base_directory = sink_dir,
+                             delivery_mode=delivery_mode,
+                             delivery_threads=delivery_threads),
                 name = 'datasink')
 
 
@@ -55,56 +133,69 @@ datasink = Node(DataSink(base_directory = template_proc),
 
 
 ######### Template creation functions #########
-def make3DTemplate(subject_T1s, num_proc, output_prefix):
-    from nipype import config, logging
-    config.enable_debug_mode()
-    logging.update_logging(config)
-    
-    from os.path import abspath, split
-    from os import getcwd
-    from shutil import copyfile
-    from glob import glob
-    from subprocess import call
-
-    curr_dir = getcwd()
-
-    #copy T1s into current directory
-    for T in range(0,len(subject_T1s)):
-        [dirname,filename] = split(subject_T1s[T])
-        copyfile(subject_T1s[T],curr_dir + '/S' + str(T)+'_'+filename)
-
-    # -c flag is control for local computing (2= use localhost; required for -j flag)
-    # -j flag is for number of processors allowed
-    call(['antsMultivariateTemplateConstruction2.sh', '–d','3','–o', output_prefix,'–r','1','–c','2','–j', str(num_proc), '*.nii.gz'])
-    
-    sample_template = abspath(output_prefix + 'template0.nii.gz')
-    
-    return(sample_template)
+# make3DTemplate lives in ct_tools/templates.py; it is shared with the other workflow script
 
 # In[4]:
 
 
 ######### Template creation nodes #########
 
-#convert freesurfer brainmask files to .nii
-convertT1 = MapNode(MRIConvert(out_file='T1.nii.gz',
-                               out_type='niigz', 
-                    out_orientation='RAS'), 
-                    name='convertT1', 
-                    iterfield = ['in_file'])
-
-#reorient files to standard space
-reorientT1 = MapNode(Reorient2Std(out_file = 'brain_reorient.nii.gz'),
+#convert freesurfer T1 files to .nii and reorient to standard space in one step
+reorientT1 = MapNode(Function(input_names=['in_file', 'out_file', 'orientation', 'cache_dir'],
+                              output_names=['out_file'],
+                              function=convert_to_std),
                      name = 'reorientT1',
                      iterfield = ['in_file'])
+reorientT1.inputs.out_file = 'T1' + intermediate_ext
+reorientT1.inputs.cache_dir = result_cache_dir
+
+#trim the T1s to the brain's bounding box (+ margin)
+cropT1 = MapNode(Function(input_names=['in_file', 'out_file', 'mask_file', 'margin', 'threshold'],
+                          output_names=['out_file'],
+                          function=crop_to_brain),
+                 name = 'cropT1',
+                 iterfield = ['in_file', 'mask_file'])
+cropT1.inputs.out_file = 'T1_crop' + intermediate_ext
+cropT1.inputs.margin = crop_margin
 
 #pass files into template function (normalized, pre-skull-stripping)
-makeTemplate = Node(Function(input_names=['subject_T1s','num_proc','output_prefix'],
+makeTemplate = Node(Function(input_names=['subject_T1s','num_proc','output_prefix',
+                                          'parallel_mode','iterations','ants_script','extra_args',
+                                          'tolerance','state_dir'],
                              output_names=['sample_template'],
                              function=make3DTemplate),
                     name='makeTemplate')
 makeTemplate.inputs.num_proc=16 # feel free to change to suit what's free on SNI=VCS
 makeTemplate.inputs.output_prefix='ELS_CT_'
+makeTemplate.inputs.parallel_mode='local' # 'local', 'serial', 'sge', 'pbs' or 'slurm'
+makeTemplate.inputs.iterations = template_iterations
+makeTemplate.inputs.tolerance = template_tolerance
+makeTemplate.inputs.state_dir = template_state_dir + '/group_template'
+
+#within-subject templates (two_level_template), participants in parallel
+n_participants = len(group_sessions(template_sub, template_sub))
+subject_template_threads, subject_template_jobs = plan_threads(n_participants, subject_template_cores,
+                                                               max_threads=4)
+subjectTemplates = Node(Function(input_names=['subject_T1s', 'subject_ids', 'n_jobs', 'num_threads',
+                                              'iterations', 'ants_script', 'extra_args', 'cache_dir',
+                                              'tolerance', 'state_dir'],
+                                 output_names=['subject_templates', 'participants'],
+                                 function=make_subject_templates),
+                        name='subjectTemplates')
+subjectTemplates.inputs.subject_ids = template_sub
+subjectTemplates.inputs.n_jobs = subject_template_jobs
+subjectTemplates.inputs.num_threads = subject_template_threads
+subjectTemplates.inputs.cache_dir = result_cache_dir
+subjectTemplates.inputs.iterations = template_iterations
+subjectTemplates.inputs.tolerance = template_tolerance
+subjectTemplates.inputs.state_dir = template_state_dir + '/subject_templates'
+
+# gzip the uncompressed within-subject templates on their way to the datasink
+gzip_templates = Node(Function(input_names=['in_files', 'compresslevel'],
+                               output_names=['out_files'],
+                               function=compress_outputs),
+                      name='gzip_templates')
+gzip_templates.inputs.compresslevel = sink_compresslevel
 
 
 # In[5]:
@@ -112,12 +203,33 @@ makeTemplate.inputs.output_prefix='ELS_CT_'
 
 ######### Template creation workflow #########
 template_flow = Workflow(name = 'template_flow')
-template_flow.connect([(fs_source, convertT1, [('T1','in_file')]),
-                       (convertT1, makeTemplate, [('out_file', 'subject_T1s')]),
-s                       (makeTemplate, datasink, [('sample_template', 'sample_template')])
+template_flow.connect([(fs_source, reorientT1, [('T1','in_file')]),
+                       (makeTemplate, datasink, [('sample_template', 'sample_template')])
                       ])
-
-template_flow.base_dir = workflow_dir
+if crop_brain:
+    template_flow.connect([(reorientT1, cropT1, [('out_file', 'in_file')]),
+                           (fs_source, cropT1, [('brainmask', 'mask_file')])])
+    session_T1s = cropT1
+else:
+    session_T1s = reorientT1
+if two_level_template:
+    template_flow.connect([(session_T1s, subjectTemplates, [('out_file', 'subject_T1s')]),
+                           (subjectTemplates, makeTemplate, [('subject_templates', 'subject_T1s')]),
+                           (subjectTemplates, gzip_templates, [('subject_templates', 'in_files')]),
+                           (gzip_templates, datasink, [('out_files', 'subject_templates')])])
+else:
+    template_flow.connect([(session_T1s, makeTemplate, [('out_file', 'subject_T1s')])])
+
+template_flow.base_dir = run_dir
 template_flow.write_graph(graph2use = 'flat')
-template_flow.run()
+plugin_args = {'status_callback': writeback.callback} if writeback else {}
+try:
+    if profile_run:
+        run_profiled(template_flow, report_dir, 'Linear', plugin_args)
+    else:
+        template_flow.run('Linear', plugin_args=plugin_args)
+finally:
+    if writeback:
+        writeback.sync()
+        writeback.close()
 
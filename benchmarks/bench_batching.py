@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Benchmark: one nipype node per subject vs batched MapNode workers.
+#
+# Runs the aseg -> tissue map step for N synthetic subjects through nipype
+# twice (iterables with one Function node per subject, and the batched
+# join + chunked MapNode mode from ct_tools.batching), and reports
+# Function-node launches, total executed nodes, wall time and the overhead on
+# top of the pure compute time (per node and per subject). Function-node
+# launches are extrapolated to --project-subjects sessions.
+#
+#   python benchmarks/bench_batching.py --subjects 40 --chunk-size 10 --n-procs 4
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from inspect import getsource
+from os.path import abspath, dirname, join
+
+import numpy as np
+import nibabel as nib
+
+REPO = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPO)
+from bench_tissuemaps import synthetic_aseg
+
+
+def aseg_to_tissuemaps(aseg, out_ext='.nii'):
+    # same work as the segment_flow node, without the cache
+    from os.path import abspath
+    from ct_tools.tissue_maps import labels_to_tissue_masks
+    from ct_tools.volume_io import load_volume, save_mask
+    aseg_nifti, aseg_data = load_volume(aseg)
+    gm_list = []
+    for tissue, mask in labels_to_tissue_masks(aseg_data).items():
+        save_mask(mask, aseg_nifti, tissue + out_ext)
+        gm_list.append(abspath(tissue + out_ext))
+    return(gm_list)
+
+
+def per_subject_flow(base_dir, subjects, aseg_files):
+    from nipype.pipeline.engine import Workflow, Node
+    from nipype.interfaces.utility import IdentityInterface, Function
+    source = Node(IdentityInterface(fields=['aseg']), name='source')
+    source.iterables = ('aseg', aseg_files)
+    aseg_to_gm = Node(Function(input_names=['aseg'], output_names=['gm_list'],
+                               function=aseg_to_tissuemaps),
+                      name='aseg_to_gm')
+    flow = Workflow(name='per_subject', base_dir=base_dir)
+    flow.connect(source, 'aseg', aseg_to_gm, 'aseg')
+    return flow
+
+
+def batched_flow(base_dir, subjects, aseg_files, chunk_size, sink_dir):
+    from nipype.pipeline.engine import Workflow, Node, JoinNode, MapNode
+    from nipype.interfaces.utility import IdentityInterface, Function
+    from ct_tools.batching import make_batches, batch_apply
+    source = Node(IdentityInterface(fields=['aseg']), name='source')
+    source.iterables = ('aseg', aseg_files)
+    join = JoinNode(Function(input_names=['in_files', 'subject_ids', 'chunk_size'],
+                             output_names=['subject_batches', 'file_batches'],
+                             function=make_batches),
+                    joinsource='source', joinfield=['in_files'], name='join')
+    join.inputs.subject_ids = subjects
+    join.inputs.chunk_size = chunk_size
+    batch = MapNode(Function(input_names=['function_source', 'arg_name', 'subject_ids',
+                                          'in_files', 'sink_dir', 'container'],
+                             output_names=['gm_lists'], function=batch_apply),
+                    iterfield=['subject_ids', 'in_files'], name='aseg_to_gm_batch')
+    batch.inputs.function_source = getsource(aseg_to_tissuemaps)
+    batch.inputs.arg_name = 'aseg'
+    batch.inputs.sink_dir = sink_dir
+    batch.inputs.container = 'gm_files'
+    flow = Workflow(name='batched', base_dir=base_dir)
+    flow.connect([(source, join, [('aseg', 'in_files')]),
+                  (join, batch, [('subject_batches', 'subject_ids'),
+                                 ('file_batches', 'in_files')])])
+    return flow
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subjects', type=int, default=40)
+    parser.add_argument('--size', type=int, default=96,
+                        help='edge length of the synthetic aseg volumes')
+    parser.add_argument('--chunk-size', type=int, default=10)
+    parser.add_argument('--n-procs', type=int, default=4)
+    parser.add_argument('--project-subjects', type=int, default=300)
+    parser.add_argument('--poll', type=float, default=None,
+                        help='nipype poll_sleep_duration (default: nipype default)')
+    args = parser.parse_args(argv)
+
+    if args.poll is not None:
+        from nipype import config
+        config.set('execution', 'poll_sleep_duration', str(args.poll))
+
+    base = tempfile.mkdtemp()
+    try:
+        subjects = ['sub%03d' % i for i in range(args.subjects)]
+        aseg_files = []
+        for i, sub in enumerate(subjects):
+            os.makedirs(join(base, 'data', sub))
+            fname = join(base, 'data', sub, 'aseg.nii')
+            nib.save(nib.Nifti1Image(synthetic_aseg(args.size, seed=i), np.eye(4)), fname)
+            aseg_files.append(fname)
+
+        # pure compute time, no nipype
+        compute_dir = join(base, 'compute')
+        os.makedirs(compute_dir)
+        cwd = os.getcwd()
+        os.chdir(compute_dir)
+        t0 = time.perf_counter()
+        for f in aseg_files:
+            aseg_to_tissuemaps(f)
+        compute = time.perf_counter() - t0
+        os.chdir(cwd)
+
+        plugin_args = {'n_procs': args.n_procs}
+        n_chunks = -(-args.subjects // args.chunk_size)
+        runs = [('per-subject', per_subject_flow(join(base, 'wf'), subjects, aseg_files),
+                 args.subjects, args.project_subjects),
+                ('batched', batched_flow(join(base, 'wf'), subjects, aseg_files,
+                                         args.chunk_size, join(base, 'sink')),
+                 n_chunks + 1, -(-args.project_subjects // args.chunk_size) + 1)]
+
+        print('%d subjects, %d^3 aseg, MultiProc n_procs=%d, chunk size %d' %
+              (args.subjects, args.size, args.n_procs, args.chunk_size))
+        print('pure compute: %.2f s (%.3f s/subject)' % (compute, compute / args.subjects))
+        print('%-12s %9s %7s %9s %15s %17s %16s' %
+              ('mode', 'launches', 'nodes', 'wall (s)', 'overhead/node', 'overhead/subject',
+               'launches @%d' % args.project_subjects))
+        for name, flow, launches, projected in runs:
+            t0 = time.perf_counter()
+            exec_graph = flow.run('MultiProc', plugin_args=plugin_args)
+            wall = time.perf_counter() - t0
+            # a MapNode shows up once in the graph but runs one sub-node per chunk
+            nodes = len(exec_graph.nodes()) + (launches - 2 if name == 'batched' else 0)
+            overhead = max(0.0, wall - compute / args.n_procs)
+            print('%-12s %9d %7d %9.2f %15.3f %17.3f %16d' %
+                  (name, launches, nodes, wall, overhead / nodes, overhead / args.subjects,
+                   projected))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
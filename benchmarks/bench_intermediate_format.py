@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# Benchmark: intermediate file format, as whole-workflow wall time and I/O.
+#
+# Runs segment_flow and template_flow end-to-end (bench_pipeline.py: synthetic
+# subjects, stub tools, profiled per node) once with each intermediate_type:
+#   NIFTI      uncompressed intermediates, outputs gzipped once for the sink
+#   NIFTI_GZ   fast level-1 gzip for every intermediate
+# and prints each workflow's wall time and the bytes its nodes read and
+# wrote per format. Other options (--subjects, --size, --stub-seconds,
+# --out, ...) are passed on to bench_pipeline.py.
+#
+#   python benchmarks/bench_intermediate_format.py --subjects 8 --size 256
+
+import sys
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(abspath(__file__)))
+import bench_pipeline
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if '--intermediate-type' not in argv:
+        argv += ['--intermediate-type'] + list(bench_pipeline.INTERMEDIATE_TYPES)
+    if '--workflows' not in argv:
+        argv += ['--workflows'] + list(bench_pipeline.FORMAT_WORKFLOWS)
+    bench_pipeline.main(argv)
+
+
+if __name__ == '__main__':
+    main()
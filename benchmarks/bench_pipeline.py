@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# Benchmark: segment_flow, template_flow, priors_flow and subject_flow
+# end-to-end on synthetic subjects.
+#
+# Generates FreeSurfer-like subjects (synthetic_subjects.py, 256^3 by
+# default), puts the stub FSL/FreeSurfer/ANTs executables from
+# benchmarks/stubs first on the PATH and runs the real workflow scripts with
+# their study variables pointed at one scratch project directory, in
+# pipeline order: priors_flow uses the masks and template of the first two,
+# subject_flow the template and priors. Each workflow runs in its own
+# process, profiled per node (ct_tools.profiling). Reports wall time,
+# throughput (subjects/hour), peak memory and the per-stage breakdown, saves
+# them as JSON (--out) and, with --baseline, flags wall time or peak memory
+# more than --tolerance above a previous result (exit status 1).
+#
+# The stubs do the tools' file I/O but almost none of their compute, so the
+# numbers are the pipeline's own cost (Python nodes, format conversion,
+# compression, scheduling); --stub-seconds adds a fixed run time per tool call.
+# With several --intermediate-type values the workflows that have the setting
+# run once per format, each format in its own project directory (results
+# under <workflow>/<format>), followed by a comparison of each workflow's
+# wall time and bytes read/written by its nodes (the profiler's per-node
+# I/O counters, summed) per format; the other workflows only run with the
+# first format.
+#
+#   python benchmarks/bench_pipeline.py --subjects 8 --out bench.json
+#   python benchmarks/bench_pipeline.py --subjects 8 --baseline bench.json
+#   python benchmarks/bench_pipeline.py --intermediate-type NIFTI NIFTI_GZ
+
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from os.path import abspath, dirname, exists, join
+
+BENCH_DIR = dirname(abspath(__file__))
+REPO = dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from synthetic_subjects import make_subjects
+
+STUB_DIR = join(BENCH_DIR, 'stubs')
+WORKFLOWS = OrderedDict([('segment', 'CorticalThicknessProcessing_segmentflow.py'),
+                         ('template', 'CorticalThicknessProcessing_templateflow.py'),
+                         ('priors', 'CorticalThicknessProcessing_priorsflow.py'),
+                         ('subject', 'CorticalThicknessProcessing_subjectflow.py')])
+# workflows with an intermediate_type / result_cache_dir setting
+FORMAT_WORKFLOWS = ('segment', 'template')
+CACHE_WORKFLOWS = ('segment', 'template', 'priors')
+INTERMEDIATE_TYPES = ('NIFTI', 'NIFTI_GZ')
+
+
+def override_variables(source, overrides):
+    """Replace the top-level `name = value` study variables in a workflow script."""
+    for name, value in overrides.items():
+        pattern = r'(?m)^%s = .*$' % re.escape(name)
+        if not re.search(pattern, source):
+            raise ValueError('no study variable %r in the script' % name)
+        source = re.sub(pattern, lambda m: '%s = %r' % (name, value), source, count=1)
+    return source
+
+
+def run_script(script, overrides):
+    """Child process: run a workflow script with overridden study variables."""
+    sys.path.insert(0, REPO)
+    from nipype.pipeline.engine import Workflow
+    # graph drawing needs graphviz and is not part of what is measured
+    Workflow.write_graph = lambda self, *args, **kwargs: None
+    with open(script) as f:
+        source = override_variables(f.read(), overrides)
+    exec(compile(source, script, 'exec'), {'__name__': '__main__', '__file__': script})
+
+
+def run_workflow(name, project_home, work_dir, fs_dir, n_subjects, args, intermediate_type=None):
+    run_name = name + '_' + intermediate_type if intermediate_type else name
+    overrides = OrderedDict([('project_home', project_home),
+                             ('fs_subjdir', fs_dir),
+                             ('profile_run', True)])
+    if name in CACHE_WORKFLOWS:
+        overrides['result_cache_dir'] = join(work_dir, 'cache') if args.cache else None
+    if name == 'segment':
+        overrides['segmentation_engine'] = args.engine
+        overrides['batch_size'] = args.batch_size
+    if intermediate_type:
+        overrides['intermediate_type'] = intermediate_type
+    env = dict(os.environ,
+               PATH=STUB_DIR + os.pathsep + os.environ.get('PATH', ''),
+               PYTHONPATH=REPO + os.pathsep + os.environ.get('PYTHONPATH', ''),
+               FSLOUTPUTTYPE='NIFTI_GZ',
+               BENCH_STUB_SECONDS=str(args.stub_seconds))
+    cmd = [sys.executable, abspath(__file__), '--run-script', join(REPO, WORKFLOWS[name]),
+           '--overrides', json.dumps(overrides)]
+    log_file = join(work_dir, run_name + '.log')
+    t0 = time.perf_counter()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=work_dir)
+        # wait4 gives this child's own rusage: peak RSS of the largest process in its tree
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed (exit %d); see %s' % (name, proc.returncode, log_file))
+
+    reports = sorted(glob.glob(join(project_home, 'reports', name + '_flow_*', 'report.json')))
+    report = json.load(open(reports[-1])) if reports else {'stages': {}}
+    return OrderedDict([
+        ('subjects', n_subjects),
+        ('wall_s', round(wall, 2)),
+        ('subjects_per_hour', round(n_subjects / wall * 3600, 1)),
+        ('cpu_s', round(usage.ru_utime + usage.ru_stime, 2)),
+        ('peak_rss_gb', round(usage.ru_maxrss / 1024.0 ** 2, 3)),
+        ('node_peak_rss_gb', report.get('peak_rss_gb_max')),
+        ('nodes', report.get('nodes')),
+        ('read_bytes', report.get('read_bytes_total')),
+        ('write_bytes', report.get('write_bytes_total')),
+        ('stages', OrderedDict((stage, OrderedDict((k, s.get(k)) for k in
+                                                   ('runs', 'wall_s_total', 'wall_s_max',
+                                                    'cpu_s_total', 'peak_rss_gb_max',
+                                                    'read_bytes_total', 'write_bytes_total')))
+                               for stage, s in report['stages'].items()))])
+
+
+def compare(results, baseline, tolerance):
+    """Messages for wall time / peak memory more than tolerance above baseline."""
+    regressions = []
+    for name, result in results['workflows'].items():
+        old = baseline.get('workflows', {}).get(name)
+        if not old:
+            continue
+        for key in ('wall_s', 'peak_rss_gb'):
+            if old.get(key) and result[key] > old[key] * (1 + tolerance):
+                regressions.append('%s %s: %.3g -> %.3g (+%.0f%%)' %
+                                   (name, key, old[key], result[key],
+                                    100.0 * (result[key] / old[key] - 1)))
+    return regressions
+
+
+def _mb(n_bytes):
+    return None if n_bytes is None else n_bytes / 1024.0 ** 2
+
+
+def print_format_comparison(workflows, formats):
+    """Whole-workflow wall time and node I/O of each workflow per intermediate format."""
+    columns = [('wall s', 'wall_s', lambda v: v), ('read MB', 'read_bytes', _mb),
+               ('write MB', 'write_bytes', _mb)]
+    print('\n  %-10s %-9s' % ('workflow', '') + ''.join(' %12s' % fmt for fmt in formats))
+    for name in FORMAT_WORKFLOWS:
+        results = [workflows.get('%s/%s' % (name, fmt), {}) for fmt in formats]
+        if not any(results):
+            continue
+        for label, key, scale in columns:
+            values = [scale(result.get(key)) for result in results]
+            print('  %-10s %-9s' % (name if key == 'wall_s' else '', label) +
+                  ''.join(' %12s' % ('-' if value is None else '%.2f' % value)
+                          for value in values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--max-sessions', type=int, default=2,
+                        help='sessions per participant (synthetic_subjects.session_ids)')
+    parser.add_argument('--workflows', nargs='+', choices=list(WORKFLOWS), default=list(WORKFLOWS))
+    parser.add_argument('--engine', choices=['fast', 'numpy'], default='fast',
+                        help='segment_flow segmentation_engine')
+    parser.add_argument('--batch-size', type=int, default=0, help='segment_flow batch_size')
+    parser.add_argument('--intermediate-type', nargs='+', choices=INTERMEDIATE_TYPES,
+                        help='intermediate_type of the workflows that have one; several '
+                             'values run each of those workflows once per format')
+    parser.add_argument('--cache', action='store_true', help='use the result cache (cold at first)')
+    parser.add_argument('--stub-seconds', type=float, default=0.0,
+                        help='seconds each stub tool call sleeps')
+    parser.add_argument('--data-dir', help='synthetic subjects directory to create/reuse')
+    parser.add_argument('--work-dir', help='keep workflow outputs here instead of a temp dir')
+    parser.add_argument('--out', help='write the results as JSON')
+    parser.add_argument('--baseline', help='earlier --out JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--run-script', help=argparse.SUPPRESS)
+    parser.add_argument('--overrides', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_script:
+        run_script(args.run_script, json.loads(args.overrides, object_pairs_hook=OrderedDict))
+        return
+
+    work_dir = abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix='bench_pipeline_')
+    fs_dir = abspath(args.data_dir) if args.data_dir else join(work_dir, 'fs')
+    if not exists(work_dir):
+        os.makedirs(work_dir)
+    try:
+        t0 = time.perf_counter()
+        subjects = make_subjects(fs_dir, args.subjects, args.size, max_sessions=args.max_sessions)
+        print('%d synthetic %d^3 subjects in %s (%.1f s)' %
+              (len(subjects), args.size, fs_dir, time.perf_counter() - t0))
+
+        results = OrderedDict([('python', platform.python_version()),
+                               ('host', platform.node()),
+                               ('cpus', os.cpu_count()),
+                               ('settings', OrderedDict(sorted(vars(args).items()))),
+                               ('workflows', OrderedDict())])
+        formats = args.intermediate_type or [None]
+        runs = [(name, fmt if name in FORMAT_WORKFLOWS else None,
+                 join(work_dir, 'project_' + fmt if fmt else 'project'))
+                for fmt in formats
+                for name in WORKFLOWS
+                if name in args.workflows and (fmt == formats[0] or name in FORMAT_WORKFLOWS)]
+        for name, fmt, project_home in runs:
+            result = run_workflow(name, project_home, work_dir, fs_dir, len(subjects), args, fmt)
+            key = '%s/%s' % (name, fmt) if len(formats) > 1 and fmt else name
+            results['workflows'][key] = result
+            print('\n%s_flow%s: %.1f s, %.1f subjects/hour, %.2f s CPU, peak RSS %.2f GB (largest node %s GB)' %
+                  (name, ' (%s)' % fmt if fmt else '', result['wall_s'], result['subjects_per_hour'],
+                   result['cpu_s'], result['peak_rss_gb'], result['node_peak_rss_gb']))
+            print('  %-22s %5s %10s %10s %10s %9s %9s %9s' %
+                  ('stage', 'runs', 'wall total', 'wall max', 'cpu total', 'peak GB',
+                   'read MB', 'write MB'))
+            for stage, s in result['stages'].items():
+                print('  %-22s %5d %10.2f %10.2f %10.2f %9s %9s %9s' %
+                      (stage, s['runs'], s['wall_s_total'], s['wall_s_max'], s['cpu_s_total'],
+                       s['peak_rss_gb_max'],
+                       *['-' if _mb(s[k]) is None else '%.1f' % _mb(s[k])
+                         for k in ('read_bytes_total', 'write_bytes_total')]))
+        if len(formats) > 1:
+            print_format_comparison(results['workflows'], formats)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        regressions = compare(results, json.load(open(args.baseline)), args.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            sys.exit(1)
+        print('\nno regressions beyond %.0f%% of %s' % (100 * args.tolerance, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
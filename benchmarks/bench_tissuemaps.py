@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Benchmark: per-label loops (old aseg_to_tissuemaps) vs the single-pass
+# lookup table engine in ct_tools.tissue_maps.
+#
+# Uses a synthetic aseg-like int32 volume so it runs without subject data.
+# Reports wall time and peak traced memory (numpy allocations) per subject.
+#
+#   python benchmarks/bench_tissuemaps.py --size 256 --repeats 3
+
+import argparse
+import sys
+import time
+import tracemalloc
+from os.path import abspath, dirname
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from ct_tools.tissue_maps import DEFAULT_LABEL_SCHEME, labels_to_tissue_masks
+
+# labels that show up in a typical aseg, background dominates
+ASEG_LABELS = [0, 2, 3, 4, 5, 7, 8, 10, 11, 12, 13, 14, 15, 16, 17, 18, 24,
+               26, 28, 41, 42, 43, 44, 46, 47, 49, 50, 51, 52, 53, 54, 58,
+               60, 77, 85, 251, 252, 253, 254, 255]
+
+
+def synthetic_aseg(size, seed=0):
+    rng = np.random.default_rng(seed)
+    p = np.full(len(ASEG_LABELS), 0.4 / (len(ASEG_LABELS) - 1))
+    p[0] = 0.6
+    return rng.choice(np.array(ASEG_LABELS, dtype=np.int32),
+                      size=(size, size, size), p=p)
+
+
+def legacy_tissuemaps(aseg_int):
+    # what the original node did: get_data() -> float64, one scan per label
+    aseg_data = aseg_int.astype(np.float64)
+    masks = []
+    for labels in DEFAULT_LABEL_SCHEME.values():
+        mask = np.zeros_like(aseg_data)
+        for x in labels:
+            mask[aseg_data == x] = 1
+        masks.append(mask)
+    return masks
+
+
+def lut_tissuemaps(aseg_int):
+    return list(labels_to_tissue_masks(aseg_int).values())
+
+
+def measure(func, aseg, repeats):
+    times = []
+    peak = 0
+    for _ in range(repeats):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        out = func(aseg)
+        times.append(time.perf_counter() - t0)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del out
+    return min(times), peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=256,
+                        help='edge length of the cubic test volume')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    aseg = synthetic_aseg(args.size)
+
+    # the engines must agree before timing means anything
+    for old, new in zip(legacy_tissuemaps(aseg), lut_tissuemaps(aseg)):
+        assert np.array_equal(old.astype(np.uint8), new)
+
+    results = {}
+    for name, func in [('per-label loops', legacy_tissuemaps),
+                       ('lookup table', lut_tissuemaps)]:
+        results[name] = measure(func, aseg, args.repeats)
+
+    print('aseg volume: %d^3 int32' % args.size)
+    print('%-16s %10s %14s' % ('engine', 'time (s)', 'peak mem (MB)'))
+    for name, (t, peak) in results.items():
+        print('%-16s %10.3f %14.1f' % (name, t, peak / 1e6))
+    (t_old, m_old), (t_new, m_new) = results.values()
+    print('speedup: %.1fx, peak memory: %.1fx lower' % (t_old / t_new,
+                                                        m_old / m_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# stub antsCorticalThickness.sh: writes every <prefix> output of the real script, derived
+# from the anatomical image (-a) and the number of priors (-p pattern). Subject-to-template
+# outputs are on the template grid (-t, or -e without it): the subject-space map resampled
+# with an identity transform (nearest neighbour, world coordinates)
+import glob, os, sys
+import numpy as np
+from scipy import ndimage
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from stub_common import parse_opts, load, save, emulate_work
+
+opts, _ = parse_opts(sys.argv[1:])
+prefix = opts.get('-o', 'antsCT_')
+img, anat = load(opts['-a'])
+n_priors = len(glob.glob(opts['-p'].replace('%02d', '*').replace('%d', '*'))) or 4
+brain = anat > 0
+cuts = np.percentile(anat[brain], np.linspace(0, 100, n_priors + 1)[1:-1]) if brain.any() else []
+seg = np.where(brain, np.searchsorted(cuts, anat) + 1, 0).astype(np.uint8)
+save(brain, img, prefix + 'BrainExtractionMask.nii.gz', np.uint8)
+save(seg, img, prefix + 'BrainSegmentation.nii.gz', np.uint8)
+for name in ('ExtractedBrain0N4', 'BrainSegmentation0N4'):
+    save(anat * brain, img, prefix + name + '.nii.gz', np.float32)
+for k in range(n_priors):
+    save(seg == k + 1, img, prefix + 'BrainSegmentationPosteriors%02d.nii.gz' % (k + 1), np.float32)
+template_img, _ = load(opts.get('-t', opts['-e']))
+
+
+def to_template(data):
+    # template voxel -> subject voxel
+    vox = np.linalg.inv(img.affine).dot(template_img.affine)
+    return ndimage.affine_transform(np.asarray(data, dtype=np.float32), vox[:3, :3], vox[:3, 3],
+                                    output_shape=template_img.shape[:3], order=0)
+
+
+thickness = np.where(seg == 2, 2.5, 0).astype(np.float32)
+save(thickness, img, prefix + 'CorticalThickness.nii.gz')
+save(to_template(thickness), template_img, prefix + 'CorticalThicknessNormalizedToTemplate.nii.gz')
+save(np.zeros(anat.shape[:3] + (1, 3), np.float32), img, prefix + 'TemplateToSubject0Warp.nii.gz')
+save(np.zeros(template_img.shape[:3] + (1, 3), np.float32), template_img,
+     prefix + 'SubjectToTemplate1Warp.nii.gz')
+save(np.zeros(template_img.shape[:3], np.float32), template_img,
+     prefix + 'SubjectToTemplateLogJacobian.nii.gz')
+for name in ('TemplateToSubject1GenericAffine.mat', 'SubjectToTemplate0GenericAffine.mat'):
+    with open(prefix + name, 'w') as f:
+        f.write('#Insight Transform File V1.0 (stub identity)\n')
+with open(prefix + 'brainvols.csv', 'w') as f:
+    f.write('Label,Volume\n' + ''.join('%d,%d\n' % (k, (seg == k).sum()) for k in range(1, n_priors + 1)))
+emulate_work()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# stub antsMultivariateTemplateConstruction2.sh: template0 is the voxelwise mean of the
+# inputs (on the first input's grid), written as <prefix>template0.nii.gz; with an
+# initial template (-z), each iteration moves it halfway towards that mean. With
+# ANTS_STUB_FAIL set it exits with an error before writing anything.
+import os, sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from stub_common import parse_opts, load, save, emulate_work
+
+opts, inputs = parse_opts(sys.argv[1:])
+if os.environ.get('ANTS_STUB_FAIL'):
+    sys.exit('stub antsMultivariateTemplateConstruction2.sh: failed')
+prefix = opts.get('-o', 'antsBTP')
+ref_img, total = load(inputs[0])
+total = total.astype(np.float32)
+for in_file in inputs[1:]:
+    _, data = load(in_file)
+    if data.shape == total.shape:
+        total += data
+print('building template from %d images, %s iterations' % (len(inputs), opts.get('-i', 4)))
+template = total / len(inputs)
+if '-z' in opts:
+    ref_img, initial = load(opts['-z'])
+    for _ in range(int(opts.get('-i', 4))):
+        initial = (initial + template) / 2
+    template = initial
+save(template, ref_img, prefix + 'template0.nii.gz', np.float32)
+emulate_work()
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# stub antsRegistrationSyNQuick.sh: identity registration, -o <prefix> outputs
+import os, sys
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from stub_common import parse_opts, load, save, emulate_work
+
+opts, _ = parse_opts(sys.argv[1:])
+prefix = opts.get('-o', 'transform')
+fixed_img, fixed = load(opts['-f'])
+moving_img, moving = load(opts['-m'])
+save(moving, fixed_img, prefix + 'Warped.nii.gz', np.float32)
+save(fixed, moving_img, prefix + 'InverseWarped.nii.gz', np.float32)
+warp = np.zeros(fixed.shape[:3] + (1, 3), dtype=np.float32)
+for name in ('1Warp.nii.gz', '1InverseWarp.nii.gz'):
+    save(warp, fixed_img, prefix + name)
+with open(prefix + '0GenericAffine.mat', 'w') as f:
+    f.write('#Insight Transform File V1.0 (stub identity)\n')
+emulate_work()
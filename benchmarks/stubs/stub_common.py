@@ -0,0 +1,73 @@
+# Shared helpers for the stub neuroimaging executables in this directory.
+#
+# The stubs stand in for FreeSurfer/FSL/ANTs when benchmarking the
+# workflows: they parse the same arguments, read their inputs and write
+# outputs of the real names, shapes and types, but do almost no compute.
+# Set BENCH_STUB_SECONDS to make every call also sleep that long, to model
+# the tool's own run time.
+
+import os
+import sys
+import time
+
+import numpy as np
+import nibabel as nib
+
+
+def parse_opts(args, flags=()):
+    """({option: value}, positional args); options in flags take no value."""
+    opts, positional = {}, []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('-') and len(arg) > 1 and not arg[1].isdigit():
+            if arg in flags or i + 1 == len(args):
+                opts[arg] = True
+                i += 1
+            else:
+                opts.setdefault(arg, args[i + 1])
+                i += 2
+        else:
+            positional.append(arg)
+            i += 1
+    return opts, positional
+
+
+def load(path):
+    img = nib.load(path)
+    return img, np.asanyarray(img.dataobj)
+
+
+def save(data, ref_img, path, dtype=None):
+    """Save data on ref_img's grid; the file type follows the extension."""
+    if dtype is not None:
+        data = np.asarray(data, dtype=dtype)
+    if path.endswith('.mgz') or path.endswith('.mgh'):
+        img = nib.MGHImage(data, ref_img.affine)
+    else:
+        img = nib.Nifti1Image(data, ref_img.affine)
+        img.set_data_dtype(data.dtype)
+    nib.save(img, path)
+
+
+def fsl_ext():
+    return {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}.get(os.environ.get('FSLOUTPUTTYPE'), '.nii.gz')
+
+
+def strip_ext(path):
+    for ext in ('.nii.gz', '.nii', '.mgz', '.mgh'):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def emulate_work():
+    seconds = float(os.environ.get('BENCH_STUB_SECONDS', 0))
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+def version_check(args, text):
+    if '--version' in args or '-version' in args:
+        print(text)
+        sys.exit(0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Synthetic FreeSurfer-like subjects directories for benchmarking.
+#
+# Each subject gets mri/T1.mgz, mri/brainmask.mgz (uint8) and mri/aseg.mgz
+# (int32 FreeSurfer labels) on the conformed 1 mm LIA grid, and
+# scripts/recon-all.done, so completed_subjects() and FreeSurferSource treat
+# it as a finished recon-all. The brain is the bench_segmentation phantom
+# (CSF/GM/WM shells with partial volume and noise) with left/right labels,
+# a few subcortical structures and a scalp ring in T1.mgz. Subjects are
+# named like the ELS sessions (<participant>-<session>): participants
+# alternate between max_sessions sessions and fewer (000-T1, 000-T2, 001-T1,
+# 002-T1, 002-T2, ... for 2), so the within-subject template path runs too.
+# A session differs from the participant's others only in its noise, and
+# every session is reproducible from its index.
+#
+#   python benchmarks/synthetic_subjects.py /tmp/bench_fs --subjects 8 --size 256
+
+import argparse
+import os
+import sys
+from os.path import abspath, dirname, exists, join
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from bench_segmentation import phantom
+
+# aseg labels (left, right)
+CSF_LABEL = 24
+CORTEX_LABELS = (3, 42)
+WM_LABELS = (2, 41)
+SUBCORTICAL_LABELS = [(10, 49), (11, 50), (12, 51), (13, 52), (17, 53), (18, 54)]
+SESSIONS = ('T1', 'T2', 'Tmid', 'TK1')
+
+
+def conformed_affine(size):
+    """FreeSurfer conformed vox2ras (LIA, 1 mm, centred)."""
+    c = size / 2.0
+    return np.array([[-1, 0, 0, c],
+                     [0, 0, 1, -c],
+                     [0, -1, 0, c],
+                     [0, 0, 0, 1]], dtype=np.float64)
+
+
+def synthetic_volumes(size=256, seed=0):
+    """Return (T1, brainmask, aseg) arrays for one synthetic subject."""
+    brain, truth = phantom(size, seed=seed)
+    x, y, z = np.ogrid[:size, :size, :size]
+    c = (size - 1) / 2.0
+    left = (x < c) & np.ones((1, size, size), dtype=bool)   # voxel x runs right -> left in LIA
+
+    aseg = np.zeros(truth.shape, dtype=np.int32)
+    aseg[truth == 1] = CSF_LABEL
+    for tissue, labels in [(2, CORTEX_LABELS), (3, WM_LABELS)]:
+        aseg[(truth == tissue) & left] = labels[0]
+        aseg[(truth == tissue) & ~left] = labels[1]
+    # subcortical structures: slabs of a small central ellipsoid inside the WM
+    r = np.sqrt(((x - c) / 0.25) ** 2 + ((y - c) / 0.2) ** 2 + ((z - c) / 0.2) ** 2) / (size / 2.0)
+    core = (r < 1) & (truth == 3)
+    bands = np.minimum(((z - (c - 0.2 * size / 2)) / (0.4 * size / 2) * len(SUBCORTICAL_LABELS)).astype(int),
+                       len(SUBCORTICAL_LABELS) - 1)
+    bands = np.broadcast_to(bands, truth.shape)
+    for k, labels in enumerate(SUBCORTICAL_LABELS):
+        aseg[core & (bands == k) & left] = labels[0]
+        aseg[core & (bands == k) & ~left] = labels[1]
+
+    # T1: brain plus a scalp ring just outside it
+    r_head = np.sqrt((x - c) ** 2 + ((y - c) / 0.85) ** 2 + ((z - c) / 0.75) ** 2) / (size / 2.0)
+    t1 = brain.copy()
+    t1[(truth == 0) & (r_head > 0.92) & (r_head < 0.98)] = 90
+    return t1, brain, aseg
+
+
+def make_subject(subjects_dir, subject_id, size=256, seed=0):
+    subject_dir = join(subjects_dir, subject_id)
+    for sub_dir in ('mri', 'scripts'):
+        if not exists(join(subject_dir, sub_dir)):
+            os.makedirs(join(subject_dir, sub_dir))
+    t1, brainmask, aseg = synthetic_volumes(size, seed)
+    affine = conformed_affine(size)
+    for name, data in [('T1', t1), ('brainmask', brainmask), ('aseg', aseg)]:
+        nib.save(nib.MGHImage(data, affine), join(subject_dir, 'mri', name + '.mgz'))
+    with open(join(subject_dir, 'scripts', 'recon-all.done'), 'w') as f:
+        f.write('#CMDARGS synthetic benchmark subject, seed %d\n' % seed)
+    return subject_dir
+
+
+def session_ids(n_subjects, max_sessions=2):
+    """n_subjects <participant>-<session> IDs, max_sessions, ..., 1 sessions per participant in turn."""
+    if not 1 <= max_sessions <= len(SESSIONS):
+        raise ValueError('max_sessions must be 1 to %d' % len(SESSIONS))
+    subject_ids = []
+    participant = 0
+    while len(subject_ids) < n_subjects:
+        n_sessions = max_sessions - participant % max_sessions
+        subject_ids += ['%03d-%s' % (participant, session) for session in SESSIONS[:n_sessions]]
+        participant += 1
+    return subject_ids[:n_subjects]
+
+
+def make_subjects(subjects_dir, n_subjects, size=256, seed=0, max_sessions=2):
+    """Create (or reuse) n_subjects synthetic sessions (see session_ids); returns their IDs."""
+    subject_ids = []
+    for k, subject_id in enumerate(session_ids(n_subjects, max_sessions)):
+        done = join(subjects_dir, subject_id, 'scripts', 'recon-all.done')
+        if not exists(done):
+            make_subject(subjects_dir, subject_id, size, seed + k)
+        subject_ids.append(subject_id)
+    return subject_ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('subjects_dir')
+    parser.add_argument('--subjects', type=int, default=4)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-sessions', type=int, default=2,
+                        help='sessions of the participants with the most (1 = every subject -T1)')
+    args = parser.parse_args(argv)
+    for subject_id in make_subjects(args.subjects_dir, args.subjects, args.size, args.seed,
+                                    args.max_sessions):
+        print(join(args.subjects_dir, subject_id))
+
+
+if __name__ == '__main__':
+    main()
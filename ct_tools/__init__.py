@@ -0,0 +1,3 @@
+# Helper modules shared by the ELS cortical thickness workflows.
+# Functions used inside nipype Function nodes import from here at run time,
+# so the repository root needs to be on the PYTHONPATH of the workers.
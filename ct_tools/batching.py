@@ -0,0 +1,86 @@
+# Batched execution of the lightweight Python nodes.
+#
+# With fs_source.iterables every Python function runs as its own nipype node
+# per subject, so most of its time goes to worker startup, pickling and
+# importing nipype/nibabel. In batched mode the per-subject inputs are joined,
+# split into chunks of chunk_size subjects (make_batches), and each chunk is
+# processed by one MapNode sub-node (batch_apply), which runs the unchanged
+# node function once per subject and delivers the outputs straight into the
+# DataSink layout (<sink_dir>/<container>/<subject>/).
+#
+# Both functions are wrapped in nipype Function nodes, so their imports stay
+# inside the function bodies.
+
+
+def make_batches(in_files, subject_ids, chunk_size, in_files2=None,
+                 in_files3=None):
+    """Split per-subject inputs (in iterables order) into chunks.
+
+    When in_files2/in_files3 are given (more joined per-subject inputs), each
+    subject's item becomes the list [in_file, in_file2(, in_file3)], to be
+    unpacked by batch_apply with a list of argument names.
+    """
+    if len(in_files) != len(subject_ids):
+        raise ValueError('got %d inputs for %d subjects' %
+                         (len(in_files), len(subject_ids)))
+    extra = [f for f in (in_files2, in_files3) if f is not None]
+    if extra:
+        in_files = [list(item) for item in zip(in_files, *extra)]
+    chunk_size = max(1, int(chunk_size))
+    subject_batches = [list(subject_ids[i:i + chunk_size])
+                       for i in range(0, len(subject_ids), chunk_size)]
+    file_batches = [list(in_files[i:i + chunk_size])
+                    for i in range(0, len(in_files), chunk_size)]
+    return(subject_batches, file_batches)
+
+
+def batch_apply(function_source, arg_name, subject_ids, in_files, params=None,
+                sink_dir=None, container=None, sink_compresslevel=6, delivery_mode='reflink'):
+    """Run a node function for each subject of a chunk.
+
+    function_source is the source of a nipype-style (self-contained) node
+    function, as given to Function(); it is called with {arg_name: in_file}
+    (or, for a list of arg_names, one value of in_file per name) plus params
+    inside its own _subject_id_<subject> directory. If sink_dir is set,
+    outputs are gzipped and delivered (ct_tools.delivery, reflinked when possible)
+    to <sink_dir>/<container>/<subject>/, just like LinkDataSink with the
+    '_subject_id_' substitution would place and record them.
+    Returns one output (file or list of files) per subject.
+    """
+    from os import chdir, getcwd, makedirs
+    from os.path import abspath, basename, isdir, join
+    from nipype.utils.functions import create_function_from_source
+    from ct_tools.delivery import deliver_file, delivery_record, record_deliveries
+    from ct_tools.volume_io import compress_outputs
+
+    function = create_function_from_source(function_source)
+    params = params or {}
+    base_dir = getcwd()
+    outputs = []
+    for sub, in_file in zip(subject_ids, in_files):
+        sub_dir = join(base_dir, '_subject_id_' + sub)
+        if not isdir(sub_dir):
+            makedirs(sub_dir)
+        chdir(sub_dir)
+        try:
+            kwargs = dict(params)
+            if isinstance(arg_name, (list, tuple)):
+                kwargs.update(zip(arg_name, in_file))
+            else:
+                kwargs[arg_name] = in_file
+            result = function(**kwargs)
+            if sink_dir:
+                dest_dir = join(sink_dir, container, sub)
+                if not isdir(dest_dir):
+                    makedirs(dest_dir)
+                sunk = compress_outputs(result, sink_compresslevel)
+                records = []
+                for f in (sunk if isinstance(sunk, list) else [sunk]):
+                    dst = join(dest_dir, basename(f))
+                    method = deliver_file(f, dst, delivery_mode)
+                    records.append(delivery_record(sink_dir, dst, abspath(f), container, sub, method))
+                record_deliveries(sink_dir, records)
+        finally:
+            chdir(base_dir)
+        outputs.append(result)
+    return(outputs)
@@ -0,0 +1,223 @@
+# Link-based, parallel DataSink delivery.
+#
+# DataSink copies every result from the workflow directory into the sink
+# (one file at a time, hashing both files' contents when the destination
+# already exists), which doubles the storage and I/O of every subject volume.
+# LinkDataSink places the same files under the same (substituted) paths, but:
+#
+# * on the same filesystem a file is reflinked (copy-on-write clone, on
+#   filesystems that support it) so nothing is copied, and otherwise copied;
+#   with delivery_mode 'link' it is hard-linked before falling back to a copy;
+# * across filesystems files are copied from a thread pool;
+# * a destination that already is the source file, or an identical copy of
+#   it (same size and mtime), is kept as it is;
+# * every delivered file is appended to <base_directory>/delivered.jsonl
+#   (container, subject, path relative to base_directory, source, method),
+#   so downstream stages look outputs up with delivered_files() instead of
+#   walking the sink directories.
+#
+# Delivered files are what users open and edit (e.g. the gm/wm/csf masks
+# before the priors and template flows), so by default ('reflink') they never
+# share data with the workflow directory or the result cache, and are always
+# writable. Hard links ('link') are opt-in; even then read-only sources
+# (result cache objects) are copied, not linked.
+
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, exists, getmtime, getsize, isdir, join, realpath, relpath
+
+from nipype.interfaces.base import isdefined, traits
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
+
+MANIFEST_NAME = 'delivered.jsonl'
+DELIVERY_MODES = ('reflink', 'link', 'copy')
+
+# ioctl(dest_fd, FICLONE, src_fd) (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def _same_file(src, dst):
+    try:
+        return os.path.samefile(src, dst) or (getsize(dst) == getsize(src) and
+                                              getmtime(dst) == getmtime(src))
+    except OSError:
+        return False
+
+
+def deliver_file(src, dst, mode='reflink'):
+    """Put src at dst; returns how: 'kept', 'reflink', 'hardlink' or 'copy'.
+
+    mode 'reflink' tries a reflink, then copies; 'link' also tries a hard
+    link before copying, except for read-only sources (result cache objects);
+    'copy' always copies. Reflinked and copied files are writable. dst is
+    replaced atomically.
+    """
+    if mode not in DELIVERY_MODES:
+        raise ValueError('delivery mode must be one of %s, not %r' % (DELIVERY_MODES, mode))
+    src = realpath(src)
+    if exists(dst) and _same_file(src, dst):
+        if os.stat(dst).st_mode & stat.S_IWUSR and (mode == 'link' or
+                                                   not os.path.samefile(src, dst)):
+            return 'kept'
+        # hard-linked or read-only from an earlier delivery: replace it with a writable copy
+    if not isdir(dirname(dst)):
+        os.makedirs(dirname(dst), exist_ok=True)
+    tmp = '%s.tmp%d.%d' % (dst, os.getpid(), threading.get_ident())
+    method = 'copy'
+    if mode != 'copy' and os.stat(src).st_dev == os.stat(dirname(dst)).st_dev:
+        try:
+            _reflink(src, tmp)
+            shutil.copystat(src, tmp)
+            method = 'reflink'
+        except OSError:
+            if exists(tmp):
+                os.remove(tmp)
+            if mode == 'link' and os.stat(src).st_mode & stat.S_IWUSR:
+                try:
+                    os.link(src, tmp)
+                    method = 'hardlink'
+                except OSError as err:
+                    if err.errno not in (errno.EPERM, errno.EMLINK, errno.EXDEV, errno.ENOTSUP):
+                        raise
+    if method == 'copy':
+        shutil.copy2(src, tmp)
+    if method != 'hardlink':
+        # copystat carries over the read-only mode of cached files
+        os.chmod(tmp, os.stat(tmp).st_mode | stat.S_IWUSR)
+    os.replace(tmp, dst)
+    return method
+
+
+def deliver_files(pairs, mode='reflink', threads=4):
+    """deliver_file for each (src, dst) pair from a thread pool; returns the methods."""
+    if threads <= 1 or len(pairs) <= 1:
+        return [deliver_file(src, dst, mode) for src, dst in pairs]
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(lambda pair: deliver_file(pair[0], pair[1], mode), pairs))
+
+
+def record_deliveries(base_dir, records):
+    """Append delivery records to base_dir's manifest (one O_APPEND write)."""
+    if not records:
+        return
+    if not isdir(base_dir):
+        os.makedirs(base_dir, exist_ok=True)
+    # a single write per call, so concurrent sinks do not interleave their lines
+    data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+    fd = os.open(join(base_dir, MANIFEST_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def delivery_record(base_dir, dst, src, container, subject, method):
+    return OrderedDict([('container', container),
+                        ('subject', subject),
+                        ('path', relpath(dst, base_dir)),
+                        ('source', src),
+                        ('method', method),
+                        ('size', getsize(dst)),
+                        ('time', time.strftime('%Y-%m-%dT%H:%M:%S'))])
+
+
+def read_deliveries(base_dir):
+    """Latest manifest record for each delivered path ({path: record}).
+
+    Records whose file has been removed from base_dir since are dropped.
+    """
+    manifest = join(base_dir, MANIFEST_NAME)
+    latest = OrderedDict()
+    if not exists(manifest):
+        return latest
+    with open(manifest) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                latest.pop(record['path'], None)
+                latest[record['path']] = record
+    return OrderedDict((path, record) for path, record in latest.items()
+                       if exists(join(base_dir, path)))
+
+
+def delivered_files(base_dir, container=None, subject=None):
+    """Absolute paths of delivered files, optionally of one container/subject."""
+    return sorted(join(abspath(base_dir), path)
+                  for path, record in read_deliveries(base_dir).items()
+                  if (container is None or record['container'] == container) and
+                  (subject is None or record['subject'] == subject))
+
+
+class LinkDataSinkInputSpec(DataSinkInputSpec):
+    delivery_mode = traits.Enum(*DELIVERY_MODES, usedefault=True,
+                                desc="'reflink' (reflink or copy), 'link' (reflink, "
+                                     "hard link or copy) or 'copy'")
+    delivery_threads = traits.Int(4, usedefault=True,
+                                  desc='parallel copies when files cannot be linked')
+
+
+class LinkDataSink(DataSink):
+    """DataSink that links outputs into place and records them in a manifest.
+
+    Paths, containers, parameterization and substitutions work as in
+    DataSink; S3 destinations and local_copy fall back to DataSink.
+    """
+    input_spec = LinkDataSinkInputSpec
+
+    def _list_outputs(self):
+        base_dir = self.inputs.base_directory
+        if ((isdefined(base_dir) and base_dir.lower().startswith('s3://')) or
+                isdefined(self.inputs.local_copy)):
+            return super(LinkDataSink, self)._list_outputs()
+        base_dir = abspath(base_dir if isdefined(base_dir) else '.')
+        outdir = base_dir
+        container = self.inputs.container if isdefined(self.inputs.container) else ''
+        if container:
+            outdir = join(outdir, container)
+
+        pairs, keys, subjects = [], [], []
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            tempoutdir = join(outdir, *[d for d in key.split('.') if d[0] != '@'])
+            files = files if isinstance(files, list) else [files]
+            if files and isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            for src in files:
+                src = abspath(src)
+                if isdir(src):
+                    # directories are delivered file by file
+                    srcs = [join(root, name) for root, _, names in os.walk(src) for name in names]
+                    dst_dir = join(tempoutdir, self._get_dst(join(src, '')))
+                    dsts = [join(dst_dir, relpath(f, src)) for f in srcs]
+                else:
+                    srcs, dsts = [src], [join(tempoutdir, self._get_dst(src))]
+                for f, dst in zip(srcs, dsts):
+                    match = re.search(r'_subject_id_([^/]+)', dst)
+                    pairs.append((f, self._substitute(dst)))
+                    keys.append(key)
+                    subjects.append(match.group(1) if match else '')
+
+        methods = deliver_files(pairs, self.inputs.delivery_mode, self.inputs.delivery_threads)
+        record_deliveries(base_dir, [
+            delivery_record(base_dir, dst, src,
+                            join(container, key.split('.')[0]) if container else key.split('.')[0],
+                            subject, method)
+            for (src, dst), key, subject, method in zip(pairs, keys, subjects, methods)])
+        outputs = self.output_spec().get()
+        outputs['out_file'] = [dst for _, dst in pairs]
+        return outputs
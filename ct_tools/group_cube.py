@@ -0,0 +1,173 @@
+# Stacked, memory-mapped group data for template-space analysis.
+#
+# Loading every session's template-space thickness map at once does not fit
+# in memory for hundreds of sessions at 1 mm. A GroupCube keeps, in one
+# directory,
+#
+# * mask.nii.gz - the template-space voxels that are stored;
+# * data.f32    - a raw float32 (sessions x in-mask voxels) matrix, one row
+#                 per session in C order, so adding sessions only appends to
+#                 the file;
+# * index.json  - the rows' subject IDs, participant/session, source file and
+#                 its sha256.
+#
+# data() returns an np.memmap; column slices (voxel chunks) are views into
+# the page cache, e.g. for ct_tools.mixed_effects.fit_mass_univariate.
+# The index is written after the rows it describes, so a cut-short append
+# leaves extra bytes that the next append drops.
+
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from os.path import abspath, exists, getsize, join
+
+import numpy as np
+import nibabel as nib
+
+from ct_tools.subjects import parse_session
+from ct_tools.staging import file_sha256
+from ct_tools.volume_io import load_volume
+
+DTYPE = np.float32
+
+
+class GroupCube(object):
+    """(sessions x in-mask voxels) float32 matrix on disk with a subject index."""
+
+    def __init__(self, cube_dir):
+        self.cube_dir = abspath(cube_dir)
+        self.mask_file = join(self.cube_dir, 'mask.nii.gz')
+        self.data_file = join(self.cube_dir, 'data.f32')
+        self.index_file = join(self.cube_dir, 'index.json')
+        if not exists(self.index_file):
+            raise IOError('%s is not a group cube (no index.json); use GroupCube.create' % cube_dir)
+        self.mask_img = nib.load(self.mask_file)
+        self.mask = np.asanyarray(self.mask_img.dataobj) > 0
+        self._read_index()
+
+    @classmethod
+    def create(cls, cube_dir, mask_file, threshold=0.5):
+        """New empty cube storing the voxels of mask_file above threshold."""
+        cube_dir = abspath(cube_dir)
+        if exists(join(cube_dir, 'index.json')):
+            raise IOError('%s already holds a group cube' % cube_dir)
+        if not exists(cube_dir):
+            os.makedirs(cube_dir)
+        img, data = load_volume(mask_file)
+        mask = (np.asanyarray(data) > threshold).astype(np.uint8)
+        nib.save(nib.Nifti1Image(mask, img.affine), join(cube_dir, 'mask.nii.gz'))
+        open(join(cube_dir, 'data.f32'), 'wb').close()
+        index = {'n_voxels': int(mask.sum()), 'dtype': np.dtype(DTYPE).str,
+                 'mask_source': abspath(mask_file), 'mask_threshold': threshold, 'rows': []}
+        _write_json(join(cube_dir, 'index.json'), index)
+        return cls(cube_dir)
+
+    @classmethod
+    def open_or_create(cls, cube_dir, mask_file, threshold=0.5):
+        if exists(join(cube_dir, 'index.json')):
+            return cls(cube_dir)
+        return cls.create(cube_dir, mask_file, threshold)
+
+    def _read_index(self):
+        with open(self.index_file) as f:
+            self.index = json.load(f)
+        self.n_voxels = self.index['n_voxels']
+        self.rows = self.index['rows']
+
+    @property
+    def subject_ids(self):
+        return [row['subject'] for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def data(self, mode='r'):
+        """np.memmap of shape (sessions, in-mask voxels); mode 'r+' to edit in place."""
+        if not self.rows:
+            return np.zeros((0, self.n_voxels), dtype=DTYPE)
+        return np.memmap(self.data_file, dtype=DTYPE, mode=mode,
+                         shape=(len(self.rows), self.n_voxels))
+
+    def _masked(self, in_file):
+        img, data = load_volume(in_file)
+        if (img.shape[:3] != self.mask.shape or
+                not np.allclose(img.affine, self.mask_img.affine, atol=1e-3)):
+            raise ValueError('%s is not on the group cube grid %s' % (in_file, self.mask.shape))
+        return np.asarray(data[self.mask], dtype=DTYPE)
+
+    @contextmanager
+    def _locked(self):
+        # one writer at a time; readers only rely on index.json being replaced atomically
+        with open(join(self.cube_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._read_index()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, in_files, subject_ids, replace_changed=True):
+        """Add each subject's template-space map as a row.
+
+        Subjects already in the cube are skipped, or (replace_changed) have
+        their row overwritten in place when the source file changed.
+        Returns (added, replaced) subject IDs.
+        """
+        added, replaced = [], []
+        with self._locked():
+            row_bytes = self.n_voxels * np.dtype(DTYPE).itemsize
+            rows = dict((row['subject'], k) for k, row in enumerate(self.rows))
+            # drop the tail of an append that was cut short before its index update
+            if getsize(self.data_file) > len(self.rows) * row_bytes:
+                os.truncate(self.data_file, len(self.rows) * row_bytes)
+            for in_file, sub in zip(in_files, subject_ids):
+                checksum = file_sha256(in_file)
+                if sub in rows:
+                    k = rows[sub]
+                    if not replace_changed or self.rows[k]['sha256'] == checksum:
+                        continue
+                    data = np.memmap(self.data_file, dtype=DTYPE, mode='r+',
+                                     shape=(len(self.rows), self.n_voxels))
+                    data[k] = self._masked(in_file)
+                    data.flush()
+                    del data
+                    self.rows[k].update(_row(sub, in_file, checksum))
+                    replaced.append(sub)
+                else:
+                    with open(self.data_file, 'ab') as f:
+                        f.write(self._masked(in_file).tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+                    rows[sub] = len(self.rows)
+                    self.rows.append(_row(sub, in_file, checksum))
+                    added.append(sub)
+                # the index only ever describes rows that are on disk
+                _write_json(self.index_file, self.index)
+        return added, replaced
+
+    def to_volume(self, values, out_file=None, fill=0):
+        """Put one value per in-mask voxel back on the template grid."""
+        volume = np.full(self.mask.shape, fill, dtype=DTYPE)
+        volume[self.mask] = values
+        img = nib.Nifti1Image(volume, self.mask_img.affine)
+        if out_file:
+            nib.save(img, out_file)
+        return img
+
+
+def _row(subject_id, in_file, checksum):
+    try:
+        participant, session = parse_session(subject_id)
+    except ValueError:
+        participant, session = subject_id, ''
+    return {'subject': subject_id, 'participant': participant, 'session': session,
+            'source': abspath(in_file), 'sha256': checksum,
+            'added': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def _write_json(path, obj):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,288 @@
+# Mass-univariate longitudinal linear mixed-effects models.
+#
+# Fits the same model at every voxel/vertex,
+#
+#     y_ij = X_ij beta + Z_ij b_i + e_ij,   b_i ~ N(0, G),  e_ij ~ N(0, sigma^2)
+#
+# with a random intercept (Z = 1) or a random intercept and time slope
+# (Z = [1, time]) per participant i, by REML as statsmodels MixedLM does.
+# The design is shared by all voxels, so everything the likelihood needs
+# reduces to per-participant sums (Z'Z, Z'X, Z'y) and the profiled REML
+# criterion is evaluated for a whole chunk of voxels at once with batched
+# small-matrix algebra. The variance parameters are optimised per voxel by
+# a damped Newton iteration on finite-difference derivatives, also batched.
+# Chunks of voxels run in a process pool.
+
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+import numpy as np
+
+from ct_tools.subjects import parse_session
+
+# ordinal wave times; pass times= (e.g. age at scan) for real analyses
+SESSION_TIMES = {'T1': 0.0, 'Tmid': 1.0, 'T2': 2.0, 'TK': 3.0}
+
+
+def session_time(session, session_times=SESSION_TIMES):
+    if session in session_times:
+        return session_times[session]
+    return session_times[session.rstrip('0123456789')]
+
+
+class LongitudinalDesign(object):
+    """Shared fixed/random-effects design for a list of subject IDs.
+
+    Fixed effects are an intercept, time and any covariates ({name: values
+    in subject_ids order}); the random effects are a per-participant
+    intercept, plus a time slope if random_slope is set.
+    """
+
+    def __init__(self, subject_ids, covariates=None, times=None,
+                 random_slope=False, session_times=SESSION_TIMES):
+        self.subject_ids = list(subject_ids)
+        parsed = [parse_session(sub) for sub in self.subject_ids]
+        self.participant_ids = [p for p, _ in parsed]
+        self.sessions = [s for _, s in parsed]
+        if times is None:
+            times = [session_time(s, session_times) for s in self.sessions]
+        self.time = np.asarray(times, dtype=np.float64)
+
+        self.exog_names = ['Intercept', 'time']
+        columns = [np.ones(len(self.time)), self.time]
+        for name, values in (covariates or {}).items():
+            self.exog_names.append(name)
+            columns.append(np.asarray(values, dtype=np.float64))
+        self.exog = np.column_stack(columns)
+        self.exog_re = self.exog[:, :2] if random_slope else self.exog[:, :1]
+        self.random_slope = random_slope
+
+        self.participants, self.groups = np.unique(self.participant_ids,
+                                                   return_inverse=True)
+        n_obs, n_groups = len(self.time), len(self.participants)
+        if np.linalg.matrix_rank(self.exog) < self.exog.shape[1]:
+            raise ValueError('the fixed-effects design is rank deficient')
+        # per-participant sums: group_re[k] maps y (n_obs) to sum_i Z_ik y_i
+        self.group_re = np.zeros((self.exog_re.shape[1], n_groups, n_obs))
+        for k in range(self.exog_re.shape[1]):
+            self.group_re[k, self.groups, np.arange(n_obs)] = self.exog_re[:, k]
+        self.ztz = self._group_cross(self.exog_re)
+        self.ztx = self._group_cross(self.exog)
+        self.xtx = self.exog.T @ self.exog
+
+    def _group_cross(self, a):
+        """(n_groups, q, a columns) per-participant Z_i' a_i."""
+        return np.einsum('kgn,nl->gkl', self.group_re, a)
+
+    @property
+    def n_obs(self):
+        return self.exog.shape[0]
+
+    @property
+    def n_fe(self):
+        return self.exog.shape[1]
+
+    @property
+    def n_re(self):
+        return self.exog_re.shape[1]
+
+
+def _cov_from_theta(theta, q):
+    """Relative random-effects covariance D = L L' from the Cholesky factor entries."""
+    L = np.zeros(theta.shape[:-1] + (q, q))
+    L[(...,) + np.tril_indices(q)] = theta
+    return L @ np.swapaxes(L, -1, -2)
+
+
+def _small_inv_det(A):
+    """Inverse and determinant of a stack of q x q matrices; closed form for q <= 2."""
+    q = A.shape[-1]
+    if q == 1:
+        return 1.0 / A, A[..., 0, 0]
+    if q == 2:
+        det = A[..., 0, 0] * A[..., 1, 1] - A[..., 0, 1] * A[..., 1, 0]
+        inv = np.empty_like(A)
+        inv[..., 0, 0] = A[..., 1, 1]
+        inv[..., 1, 1] = A[..., 0, 0]
+        inv[..., 0, 1] = -A[..., 0, 1]
+        inv[..., 1, 0] = -A[..., 1, 0]
+        return inv / det[..., None, None], det
+    return np.linalg.inv(A), np.linalg.det(A)
+
+
+def _reml_criterion(theta, design, stats, full=False):
+    """-2 x profiled REML log-likelihood (up to a constant) for each voxel.
+
+    theta: (n_voxels, q(q+1)/2) Cholesky entries of D = G / sigma^2.
+    With H_i = I + Z_i D Z_i', H_i^-1 = I - Z_i (I + D Z_i'Z_i)^-1 D Z_i'.
+    """
+    xty, yty, zty = stats
+    n, p, q = design.n_obs, design.n_fe, design.n_re
+    D = _cov_from_theta(theta, q)                                   # (v, q, q)
+    A = np.eye(q) + np.einsum('vkl,glm->vgkm', D, design.ztz)       # I + D Z'Z
+    A_inv, A_det = _small_inv_det(A)
+    M = A_inv @ D[:, None]                                          # (v, g, q, q)
+    logdet_h = np.log(A_det).sum(axis=1)
+
+    xthx = design.xtx - np.einsum('gkp,vgkl,glr->vpr', design.ztx, M, design.ztx, optimize=True)
+    xthy = xty.T - np.einsum('gkp,vgkl,glv->vp', design.ztx, M, zty, optimize=True)
+    ythy = yty - np.einsum('gkv,vgkl,glv->v', zty, M, zty)
+    beta = np.linalg.solve(xthx, xthy[..., None])[..., 0]
+    rhr = np.maximum(ythy - np.einsum('vp,vp->v', xthy, beta), 1e-300)
+    logdet_x = np.linalg.slogdet(xthx)[1]
+    crit = (n - p) * np.log(rhr) + logdet_h + logdet_x
+    if not full:
+        return crit
+    scale = rhr / (n - p)
+    cov_beta = scale[:, None, None] * np.linalg.inv(xthx)
+    return crit, beta, cov_beta, scale, scale[:, None, None] * D
+
+
+def _sufficient_stats(design, y):
+    return (design.exog.T @ y,                                  # (p, v)
+            np.einsum('nv,nv->v', y, y),                        # (v,)
+            np.einsum('kgn,nv->gkv', design.group_re, y))       # (g, q, v)
+
+
+def _initial_theta(design, y):
+    """Method-of-moments start: between-participant share of the variance."""
+    q = design.n_re
+    n_groups = len(design.participants)
+    resid = y - design.exog @ np.linalg.lstsq(design.exog, y, rcond=None)[0]
+    counts = np.bincount(design.groups, minlength=n_groups)
+    means = np.zeros((n_groups, y.shape[1]))
+    np.add.at(means, design.groups, resid)
+    means /= counts[:, None]
+    within = ((resid - means[design.groups]) ** 2).sum(axis=0) / max(design.n_obs - n_groups, 1)
+    between = np.maximum(means.var(axis=0) - within / counts.mean(), 0)
+    ratio = np.sqrt(between / np.maximum(within, 1e-12)) + 0.1
+    theta = np.zeros((y.shape[1], q * (q + 1) // 2))
+    theta[:, 0] = ratio
+    if q == 2:
+        theta[:, 2] = 0.1 / max(design.time.std(), 1e-6)
+    return theta
+
+
+def _fit_chunk(design, y, max_iter=100, tol=1e-6):
+    y = np.asarray(y, dtype=np.float64)
+    stats = _sufficient_stats(design, y)
+    theta = _initial_theta(design, y)
+    n_vox, k = theta.shape
+    f = _reml_criterion(theta, design, stats)
+    damping = np.full(n_vox, 1e-3)
+    converged = np.zeros(n_vox, dtype=bool)
+    active = np.ones(n_vox, dtype=bool)
+    h = 1e-4
+
+    def crit(t, idx):
+        return _reml_criterion(t, design, tuple(s[..., idx] for s in stats))
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if not len(idx):
+            break
+        t0, f0 = theta[idx], f[idx]
+        # central finite-difference gradient and Hessian, batched over voxels
+        grad = np.zeros((len(idx), k))
+        hess = np.zeros((len(idx), k, k))
+        steps = np.eye(k) * h
+        f_plus = [crit(t0 + steps[a], idx) for a in range(k)]
+        f_minus = [crit(t0 - steps[a], idx) for a in range(k)]
+        for a in range(k):
+            grad[:, a] = (f_plus[a] - f_minus[a]) / (2 * h)
+            hess[:, a, a] = (f_plus[a] - 2 * f0 + f_minus[a]) / h ** 2
+            for b in range(a):
+                f_pp = crit(t0 + steps[a] + steps[b], idx)
+                f_mm = crit(t0 - steps[a] - steps[b], idx)
+                hess[:, a, b] = hess[:, b, a] = \
+                    (f_pp + f_mm + 2 * f0 - f_plus[a] - f_minus[a] - f_plus[b] - f_minus[b]) / (2 * h ** 2)
+
+        # damped Newton on |Hessian| eigenvalues, so saddle points (e.g. a
+        # slope variance of 0) are left along the direction of negative
+        # curvature; the damping grows until the criterion improves
+        w, U = np.linalg.eigh(hess)
+        g = np.einsum('vba,vb->va', U, grad)
+        accepted = np.zeros(len(idx), dtype=bool)
+        step = np.zeros_like(t0)
+        lam = damping[idx]
+        for _ in range(30):
+            todo = np.flatnonzero(~accepted)
+            if not len(todo):
+                break
+            w_abs = np.abs(w[todo])
+            shift = lam[todo, None] * (w_abs.max(axis=1, keepdims=True) + 1e-8)
+            trial = -np.einsum('vab,vb->va', U[todo], g[todo] / (w_abs + shift))
+            f_trial = crit(t0[todo] + trial, idx[todo])
+            better = f_trial <= f0[todo]
+            step[todo[better]] = trial[better]
+            accepted[todo[better]] = True
+            f[idx[todo[better]]] = f_trial[better]
+            lam[todo[better]] /= 10
+            lam[todo[~better]] *= 10
+        damping[idx] = np.clip(lam, 1e-10, 1e10)
+        theta[idx] = t0 + step
+        small = (np.abs(step).max(axis=1) < tol) | (f0 - f[idx] < tol * 1e-2)
+        # no improving step at all is a minimum to numerical precision if
+        # the gradient vanishes there
+        converged[idx] = (accepted & small) | (~accepted & (np.abs(grad).max(axis=1) < 1e-3))
+        active[idx] = accepted & ~small
+
+    crit_value, beta, cov_beta, scale, cov_re = _reml_criterion(theta, design, stats, full=True)
+    return {'fe_params': beta,
+            'bse_fe': np.sqrt(np.diagonal(cov_beta, axis1=1, axis2=2)),
+            'scale': scale,
+            'cov_re': cov_re,
+            'reml_criterion': crit_value,
+            'converged': converged}
+
+
+def _fit_chunk_star(args):
+    return _fit_chunk(*args)
+
+
+def fit_mass_univariate(design, data, chunk_size=2000, n_procs=None):
+    """Fit the mixed model at every column of data (n_obs x n_voxels).
+
+    data may be a memmap; chunks of chunk_size columns are fitted in a pool
+    of n_procs processes (n_procs=1 fits in this process). Returns a dict of
+    per-voxel arrays: fe_params and bse_fe (n_voxels x n_fe), tvalues,
+    scale (residual variance), cov_re (n_voxels x q x q), reml_criterion and
+    converged.
+    """
+    n_vox = data.shape[1]
+    chunks = [(start, min(start + chunk_size, n_vox)) for start in range(0, n_vox, chunk_size)]
+    jobs = ((design, np.asarray(data[:, start:stop])) for start, stop in chunks)
+    n_procs = n_procs or cpu_count()
+    if n_procs == 1 or len(chunks) == 1:
+        results = [_fit_chunk_star(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(n_procs) as pool:
+            results = list(pool.map(_fit_chunk_star, jobs))
+    fit = {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+    fit['tvalues'] = fit['fe_params'] / fit['bse_fe']
+    return fit
+
+
+def validate_against_statsmodels(design, data, fit, n_sample=20, seed=0):
+    """Refit a random sample of voxels with statsmodels MixedLM (REML).
+
+    Returns (voxel indices, {quantity: max absolute difference}) comparing
+    fixed effects, their standard errors, residual variance and random
+    effects covariance. Estimates agree to the optimiser tolerance; the
+    standard errors here are the usual GLS ones, (X'V^-1X)^-1, while
+    statsmodels inverts the observed information of all parameters, so
+    bse_fe differs by a few percent in small samples.
+    """
+    import statsmodels.api as sm
+    rng = np.random.default_rng(seed)
+    voxels = np.sort(rng.choice(data.shape[1], min(n_sample, data.shape[1]), replace=False))
+    diffs = {'fe_params': 0.0, 'bse_fe': 0.0, 'scale': 0.0, 'cov_re': 0.0}
+    for v in voxels:
+        model = sm.MixedLM(np.asarray(data[:, v], dtype=np.float64), design.exog,
+                           groups=design.groups, exog_re=design.exog_re)
+        result = model.fit(reml=True)
+        diffs['fe_params'] = max(diffs['fe_params'], np.abs(result.fe_params - fit['fe_params'][v]).max())
+        diffs['bse_fe'] = max(diffs['bse_fe'], np.abs(result.bse_fe - fit['bse_fe'][v]).max())
+        diffs['scale'] = max(diffs['scale'], abs(result.scale - fit['scale'][v]))
+        diffs['cov_re'] = max(diffs['cov_re'], np.abs(np.asarray(result.cov_re) - fit['cov_re'][v]).max())
+    return voxels, diffs
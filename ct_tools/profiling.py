@@ -0,0 +1,358 @@
+# Per-node resource profiling and run reports for the nipype workflows.
+#
+# Every node is measured in the process that runs it: wall time, CPU time
+# (the node's own and that of the FSL/FreeSurfer/ANTs commands it waits
+# for), bytes read/written (including those commands, as Linux adds a
+# reaped child's I/O to its parent) and, by sampling /proc, the peak RSS and
+# thread count of the process and everything it launched. Records are
+# appended as JSON lines to <report_dir>/nodes.jsonl while the workflow runs
+# and summarised per stage (node name; the subnodes of a MapNode, run as
+# separate jobs by MultiProc, count towards their MapNode) afterwards.
+#
+# Only the standard library is used (no psutil); without /proc (non-Linux)
+# peak RSS falls back to ru_maxrss and the I/O and thread columns are empty.
+#
+#   from ct_tools.profiling import run_profiled
+#   run_profiled(segment_flow, project_home + '/reports', 'MultiProc', {'n_procs': 10})
+
+import csv
+import json
+import os
+import re
+import resource
+import threading
+import time
+from collections import OrderedDict
+from os.path import abspath, exists, join
+
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin, run_node
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+HAVE_PROC = exists('/proc/self/stat')
+
+FIELDS = ['stage', 'node', 'subject', 'status', 'start', 'wall_s', 'cpu_s',
+          'cpu_user_s', 'cpu_sys_s', 'peak_rss_gb', 'max_threads', 'read_bytes',
+          'write_bytes', 'n_procs', 'mem_gb']
+
+
+def _proc_table():
+    """{pid: (ppid, threads, rss bytes)} for every process visible in /proc."""
+    table = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces; fields start after its ')'
+        fields = stat[stat.rindex(')') + 2:].split()
+        table[int(entry)] = (int(fields[1]), int(fields[17]), int(fields[21]) * PAGE_SIZE)
+    return table
+
+
+def tree_usage(root_pid):
+    """(RSS bytes, threads) summed over root_pid and all its descendants."""
+    table = _proc_table()
+    children = {}
+    for pid, (ppid, _, _) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    rss, threads, todo = 0, 0, [root_pid]
+    while todo:
+        pid = todo.pop()
+        if pid in table:
+            rss += table[pid][2]
+            threads += table[pid][1]
+        todo.extend(children.get(pid, []))
+    return rss, threads
+
+
+def _io_counters():
+    """(bytes read, bytes written) by this process and its reaped children.
+
+    rchar/wchar count what was asked of the filesystem, so network storage
+    (/share) is included, unlike the block-device read_bytes/write_bytes.
+    """
+    if not HAVE_PROC:
+        return None, None
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:
+        return None, None
+    return counters.get('rchar'), counters.get('wchar')
+
+
+class NodeProbe(object):
+    """Measures one node run in the current process.
+
+    A background thread samples the process tree every interval seconds
+    for peak RSS and threads; start() and stop() take a sample as well, so
+    short nodes still get one.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.peak_rss = 0
+        self.max_threads = 0
+
+    def _sample(self):
+        if not HAVE_PROC:
+            return
+        try:
+            rss, threads = tree_usage(os.getpid())
+        except OSError:
+            return
+        self.peak_rss = max(self.peak_rss, rss)
+        self.max_threads = max(self.max_threads, threads)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.t0 = time.time()
+        self.wall0 = time.perf_counter()
+        self.self0 = resource.getrusage(resource.RUSAGE_SELF)
+        self.child0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io0 = _io_counters()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._sample()
+        self._stop.set()
+        self._thread.join()
+        wall = time.perf_counter() - self.wall0
+        self1 = resource.getrusage(resource.RUSAGE_SELF)
+        child1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        user = (self1.ru_utime - self.self0.ru_utime) + (child1.ru_utime - self.child0.ru_utime)
+        system = (self1.ru_stime - self.self0.ru_stime) + (child1.ru_stime - self.child0.ru_stime)
+        peak_rss = self.peak_rss
+        if not HAVE_PROC:
+            # lifetime maximum in kB (Linux/BSD); an upper bound for this node
+            peak_rss = max(self1.ru_maxrss, child1.ru_maxrss) * 1024
+        io1 = _io_counters()
+        read, write = [None if b is None or a is None else b - a
+                       for a, b in zip(self.io0, io1)]
+        return OrderedDict([('start', self.t0),
+                            ('wall_s', round(wall, 3)),
+                            ('cpu_s', round(user + system, 3)),
+                            ('cpu_user_s', round(user, 3)),
+                            ('cpu_sys_s', round(system, 3)),
+                            ('peak_rss_gb', round(peak_rss / 1024.0 ** 3, 4)),
+                            ('max_threads', self.max_threads or None),
+                            ('read_bytes', read),
+                            ('write_bytes', write)])
+
+
+def _node_subject(node):
+    """Subject from the node's iterable parameterization ('' if none)."""
+    match = re.search(r'_subject_id_([^/]+)', node.output_dir())
+    return match.group(1) if match else ''
+
+
+def _node_stage(node):
+    """Stage of a node: its name, or its MapNode's name for a MapNode subnode."""
+    # subnodes (_<mapnode><index>) run in <mapnode dir>/mapflow/
+    node_dir, name = os.path.split(node.output_dir())
+    parent_dir, mapflow = os.path.split(node_dir)
+    if mapflow == 'mapflow' and name == node.name:
+        return os.path.basename(parent_dir)
+    return node.name
+
+
+def record_node(report_file, node, usage, status):
+    """Append one node's measurements to the JSON-lines report_file."""
+    record = OrderedDict([('stage', _node_stage(node)),
+                          ('node', node.fullname),
+                          ('subject', _node_subject(node)),
+                          ('status', status)])
+    record.update(usage)
+    record['n_procs'] = node.n_procs
+    record['mem_gb'] = node.mem_gb
+    # a single O_APPEND write per record, so concurrent workers do not interleave
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(report_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def run_node_profiled(node, updatehash, taskid, report_file, interval=1.0):
+    """MultiProc worker function: nipype's run_node under a NodeProbe."""
+    probe = NodeProbe(interval).start()
+    result = run_node(node, updatehash, taskid)
+    record_node(report_file, node, probe.stop(),
+                'exception' if result['traceback'] else 'end')
+    return result
+
+
+class ProfiledMultiProcPlugin(MultiProcPlugin):
+    """MultiProc that profiles every node in the worker process running it.
+
+    Takes the MultiProc plugin_args plus report_file (JSON lines, appended
+    to) and sample_interval (seconds between RSS/thread samples).
+    """
+
+    def __init__(self, plugin_args=None):
+        plugin_args = dict(plugin_args or {})
+        self.report_file = abspath(plugin_args.pop('report_file'))
+        self.sample_interval = plugin_args.pop('sample_interval', 1.0)
+        super(ProfiledMultiProcPlugin, self).__init__(plugin_args=plugin_args)
+
+    def _submit_job(self, node, updatehash=False):
+        # MultiProcPlugin._submit_job with run_node_profiled as the worker
+        self._taskid += 1
+        if getattr(node.interface, 'terminal_output', '') == 'stream':
+            node.interface.terminal_output = 'allatonce'
+        result_future = self.pool.submit(run_node_profiled, node, updatehash, self._taskid,
+                                         self.report_file, self.sample_interval)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
+
+
+class ProfileCallback(object):
+    """status_callback for plugins that run nodes in this process (Linear).
+
+    then, if given, is another status_callback called after this one.
+    """
+
+    def __init__(self, report_file, interval=1.0, then=None):
+        self.report_file = abspath(report_file)
+        self.interval = interval
+        self.then = then
+        self._probes = {}
+
+    def __getstate__(self):
+        # nipype pickles plugin_args along with the nodes; running probes hold threads
+        return {'report_file': self.report_file, 'interval': self.interval,
+                'then': self.then, '_probes': {}}
+
+    def __call__(self, node, status):
+        if status == 'start':
+            self._probes[node.fullname] = NodeProbe(self.interval).start()
+        else:
+            probe = self._probes.pop(node.fullname, None)
+            if probe is not None:
+                record_node(self.report_file, node, probe.stop(), status)
+        if self.then is not None:
+            self.then(node, status)
+
+
+def read_records(report_file):
+    if not exists(report_file):
+        return []
+    with open(report_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _total(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _max(values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def summarize_stages(records):
+    """Per-stage (node name) totals/maxima, in order of first start."""
+    stages = OrderedDict()
+    for record in sorted(records, key=lambda r: r['start']):
+        stages.setdefault(record['stage'], []).append(record)
+    summary = OrderedDict()
+    for stage, rows in stages.items():
+        walls = [r['wall_s'] for r in rows]
+        summary[stage] = OrderedDict([
+            ('runs', len(rows)),
+            ('failed', sum(r['status'] != 'end' for r in rows)),
+            ('subjects', len(set(r['subject'] for r in rows if r['subject']))),
+            ('wall_s_total', round(sum(walls), 3)),
+            ('wall_s_mean', round(sum(walls) / len(walls), 3)),
+            ('wall_s_max', max(walls)),
+            ('cpu_s_total', round(_total(r['cpu_s'] for r in rows), 3)),
+            ('peak_rss_gb_max', _max(r['peak_rss_gb'] for r in rows)),
+            ('max_threads', _max(r['max_threads'] for r in rows)),
+            ('read_bytes_total', _total(r['read_bytes'] for r in rows)),
+            ('write_bytes_total', _total(r['write_bytes'] for r in rows))])
+    return summary
+
+
+def write_report(report_dir, run_info=None):
+    """Write nodes.csv, stages.csv and report.json from report_dir/nodes.jsonl."""
+    records = read_records(join(report_dir, 'nodes.jsonl'))
+    with open(join(report_dir, 'nodes.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(sorted(records, key=lambda r: r['start']))
+
+    stages = summarize_stages(records)
+    stage_fields = ['stage'] + (list(next(iter(stages.values())).keys()) if stages else [])
+    with open(join(report_dir, 'stages.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, stage_fields)
+        writer.writeheader()
+        for stage, summary in stages.items():
+            writer.writerow(dict(summary, stage=stage))
+
+    report = OrderedDict(run_info or {})
+    report['nodes'] = len(records)
+    report['failed'] = sum(r['status'] != 'end' for r in records)
+    report['subjects'] = len(set(r['subject'] for r in records if r['subject']))
+    report['node_wall_s_total'] = round(sum(r['wall_s'] for r in records), 3)
+    report['cpu_s_total'] = _total(r['cpu_s'] for r in records)
+    report['peak_rss_gb_max'] = _max(r['peak_rss_gb'] for r in records)
+    report['read_bytes_total'] = _total(r['read_bytes'] for r in records)
+    report['write_bytes_total'] = _total(r['write_bytes'] for r in records)
+    report['stages'] = stages
+    with open(join(report_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    return join(report_dir, 'report.json')
+
+
+def run_profiled(workflow, report_dir, plugin='MultiProc', plugin_args=None,
+                 sample_interval=1.0):
+    """Run workflow with every node profiled; the report is written even if it fails.
+
+    The report goes to <report_dir>/<workflow name>_<start time>/. MultiProc
+    is profiled in its workers, any other in-process plugin (Linear) through
+    a status_callback.
+    """
+    started = time.time()
+    run_dir = join(abspath(report_dir), '%s_%s' % (workflow.name,
+                   time.strftime('%Y%m%d-%H%M%S', time.localtime(started))))
+    if not exists(run_dir):
+        os.makedirs(run_dir)
+    report_file = join(run_dir, 'nodes.jsonl')
+    plugin_args = dict(plugin_args or {})
+    if plugin == 'MultiProc':
+        plugin_args.update(report_file=report_file, sample_interval=sample_interval)
+        runner = ProfiledMultiProcPlugin(plugin_args)
+    else:
+        plugin_args['status_callback'] = ProfileCallback(report_file, sample_interval,
+                                                         plugin_args.get('status_callback'))
+        runner = plugin
+
+    status = 'failed'
+    try:
+        graph = workflow.run(runner, plugin_args=plugin_args)
+        status = 'finished'
+        return graph
+    finally:
+        write_report(run_dir, OrderedDict([('workflow', workflow.name),
+                                           ('plugin', plugin),
+                                           ('status', status),
+                                           ('started', time.strftime('%Y-%m-%dT%H:%M:%S',
+                                                                     time.localtime(started))),
+                                           ('wall_s', round(time.time() - started, 3))]))
@@ -0,0 +1,215 @@
+# Regional thickness and volume extraction into one long-format table.
+#
+# Per-region measures otherwise come from each subject's FreeSurfer stats
+# text files. Here every label volume (aseg, aparc+aseg, ...) is read once and
+# all of its regions' voxel counts and thickness sums come out of one
+# bincount pass; tissue classes (the aseg_to_tissuemaps label scheme) are
+# summed from the same counts through the label lookup table. Subjects run in
+# a process pool, and the result is a single long table
+#
+#     subject_id, participant, session, atlas, region, label, measure, value
+#
+# (subject_id is the FreeSurfer subject ID, e.g. 001-T1, split into its
+# participant and session) written as Parquet or HDF5 (write_long_table) for
+# CT_Analysis.ipynb.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from os.path import basename, exists, join
+
+import numpy as np
+import nibabel as nib
+from nibabel.orientations import apply_orientation, inv_ornt_aff, io_orientation, ornt_transform
+
+from ct_tools.subjects import parse_session
+from ct_tools.tissue_maps import _as_label_array, build_label_lut
+from ct_tools.volume_io import crop_offsets, load_volume
+
+LABEL_VOLUMES = ('aseg', 'aparc+aseg')
+TISSUE_ATLAS = 'tissue'
+TABLE_COLUMNS = ['subject_id', 'participant', 'session', 'atlas', 'region', 'label', 'measure', 'value']
+
+
+def read_color_lut(lut_file=None):
+    """{label: name} from a FreeSurferColorLUT.txt ($FREESURFER_HOME's by default).
+
+    Returns {} when there is no lookup table; regions are then named label_<n>.
+    """
+    if lut_file is None and os.environ.get('FREESURFER_HOME'):
+        lut_file = join(os.environ['FREESURFER_HOME'], 'FreeSurferColorLUT.txt')
+    names = {}
+    if not lut_file or not exists(lut_file):
+        return names
+    with open(lut_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].isdigit():
+                names[int(fields[0])] = fields[1]
+    return names
+
+
+def labels_on_grid(label_img, ref_img):
+    """Label voxels on ref_img's grid.
+
+    The label volume (e.g. FreeSurfer's conformed LIA aseg.mgz) is only
+    permuted/flipped into ref_img's axis order and, if ref_img was cropped,
+    cut to the same box; no resampling. Raises ValueError when the grids do
+    not line up that way.
+    """
+    transform = ornt_transform(io_orientation(label_img.affine), io_orientation(ref_img.affine))
+    data = apply_orientation(np.asanyarray(label_img.dataobj), transform)
+    affine = label_img.affine.dot(inv_ornt_aff(transform, label_img.shape))
+    if data.shape[:3] == ref_img.shape[:3] and np.allclose(affine, ref_img.affine, atol=1e-3):
+        return data
+    offsets = crop_offsets(ref_img, nib.Nifti1Image(data, affine))
+    return data[tuple(slice(o, o + n) for o, n in zip(offsets, ref_img.shape[:3]))]
+
+
+def label_stats(labels, thickness=None):
+    """Voxel counts (and thickness sums) of every label in one bincount pass.
+
+    Returns {'count': ..., 'thickness_count', 'thickness_sum', 'thickness_sumsq'}
+    arrays indexed by label; thickness statistics only use voxels with a
+    positive thickness.
+    """
+    labels = _as_label_array(labels).ravel()
+    stats = {'count': np.bincount(labels)}
+    if thickness is not None:
+        thickness = np.asarray(thickness, dtype=np.float64).ravel()
+        if thickness.shape != labels.shape:
+            raise ValueError('thickness map has %d voxels, the labels %d' %
+                             (thickness.size, labels.size))
+        thickness = np.where(thickness > 0, thickness, 0.0)
+        n = len(stats['count'])
+        stats['thickness_count'] = np.bincount(labels, weights=thickness > 0, minlength=n)
+        stats['thickness_sum'] = np.bincount(labels, weights=thickness, minlength=n)
+        stats['thickness_sumsq'] = np.bincount(labels, weights=thickness * thickness, minlength=n)
+    return stats
+
+
+def _measures(stats, voxel_volume, index=None, lut=None):
+    """{measure: values} for labels index (or lut rows, summing their labels)."""
+    if lut is not None:
+        n = min(lut.shape[1], len(stats['count']))
+        stats = dict((key, lut[:, :n].dot(values[:n])) for key, values in stats.items())
+    elif index is not None:
+        stats = dict((key, values[index]) for key, values in stats.items())
+    measures = {'volume_mm3': stats['count'] * voxel_volume}
+    if 'thickness_sum' in stats:
+        n = np.maximum(stats['thickness_count'], 1)
+        mean = stats['thickness_sum'] / n
+        measures['thickness_mean'] = np.where(stats['thickness_count'] > 0, mean, np.nan)
+        var = np.maximum(stats['thickness_sumsq'] / n - mean * mean, 0)
+        measures['thickness_std'] = np.where(stats['thickness_count'] > 0, np.sqrt(var), np.nan)
+    return measures
+
+
+def subject_regional_measures(subject_id, subjects_dir, thickness_file=None,
+                              label_volumes=LABEL_VOLUMES, label_scheme=None, names=None):
+    """Per-region measures of one subject as a list of table rows.
+
+    Regions are the labels present in each of label_volumes (files
+    <subjects_dir>/<subject>/mri/<name>.mgz) and, from the first one, the
+    tissue classes of label_scheme (ct_tools.tissue_maps). Measures are
+    volume_mm3 and, with a thickness map (e.g. antsCT_CorticalThickness on
+    the reoriented T1 grid), thickness_mean/thickness_std over the region's
+    voxels of positive thickness.
+    """
+    try:
+        participant, session = parse_session(subject_id)
+    except ValueError:
+        participant, session = subject_id, ''
+    names = names or {}
+    thick_img, thickness = load_volume(thickness_file) if thickness_file else (None, None)
+    lut, class_names = build_label_lut(label_scheme)
+
+    rows = []
+    for k, atlas in enumerate(label_volumes):
+        label_img = nib.load(join(subjects_dir, subject_id, 'mri', atlas + '.mgz'))
+        labels = labels_on_grid(label_img, thick_img) if thick_img is not None else label_img.dataobj
+        voxel_volume = float(abs(np.linalg.det(label_img.affine[:3, :3])))
+        stats = label_stats(labels, thickness)
+        present = np.flatnonzero(stats['count'])
+        present = present[present > 0]
+        regions = [(atlas, names.get(int(l), 'label_%d' % l), int(l)) for l in present]
+        measures = _measures(stats, voxel_volume, index=present)
+        if k == 0:
+            regions += [(TISSUE_ATLAS, name, -1) for name in class_names]
+            tissue = _measures(stats, voxel_volume, lut=lut)
+            measures = dict((key, np.concatenate([values, tissue[key]]))
+                            for key, values in measures.items())
+        for measure, values in sorted(measures.items()):
+            rows.extend((subject_id, participant, session, atlas_name, region, label,
+                         measure, float(value))
+                        for (atlas_name, region, label), value in zip(regions, values))
+    return rows
+
+
+def _subject_rows_star(args):
+    return subject_regional_measures(*args)
+
+
+def thickness_files(subj_proc, container='cortical_thickness'):
+    """{subject: thickness map} from subject_flow's delivery manifest."""
+    from ct_tools.delivery import read_deliveries
+    return dict((record['subject'], join(subj_proc, path))
+                for path, record in read_deliveries(subj_proc).items()
+                if record['container'] == container and
+                basename(path).startswith('antsCT_CorticalThickness'))
+
+
+def extract_regional_measures(subject_ids, subjects_dir, thickness_maps=None,
+                              label_volumes=LABEL_VOLUMES, label_scheme=None,
+                              lut_file=None, n_procs=None):
+    """Long-format pandas DataFrame of all subjects' regional measures.
+
+    thickness_maps is {subject: thickness map} (e.g. thickness_files(subj_proc));
+    subjects without one only get volumes. Subjects run in a pool of n_procs
+    processes (n_procs=1 runs them in this process).
+    """
+    import pandas as pd
+    names = read_color_lut(lut_file)
+    thickness_maps = thickness_maps or {}
+    jobs = [(sub, subjects_dir, thickness_maps.get(sub), tuple(label_volumes), label_scheme, names)
+            for sub in subject_ids]
+    n_procs = min(n_procs or cpu_count(), max(len(jobs), 1))
+    if n_procs == 1:
+        results = [_subject_rows_star(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(n_procs) as pool:
+            results = list(pool.map(_subject_rows_star, jobs))
+    table = pd.DataFrame([row for rows in results for row in rows], columns=TABLE_COLUMNS)
+    for column in ['subject_id', 'participant', 'session', 'atlas', 'region', 'measure']:
+        table[column] = table[column].astype('category')
+    return table
+
+
+def write_long_table(table, out_file, key='regional'):
+    """Write the table as Parquet (.parquet) or HDF5 (.h5/.hdf5, under key).
+
+    Parquet needs pyarrow or fastparquet and HDF5 needs PyTables; .csv(.gz)
+    is written without either.
+    """
+    out_dir = os.path.dirname(out_file)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if out_file.endswith('.parquet'):
+        table.to_parquet(out_file, index=False)
+    elif out_file.endswith(('.h5', '.hdf5')):
+        table.to_hdf(out_file, key=key, mode='w', format='table', data_columns=True)
+    elif out_file.endswith(('.csv', '.csv.gz')):
+        table.to_csv(out_file, index=False)
+    else:
+        raise ValueError('%s: use a .parquet, .h5/.hdf5 or .csv(.gz) file' % out_file)
+    return out_file
+
+
+def read_long_table(in_file, key='regional'):
+    import pandas as pd
+    if in_file.endswith('.parquet'):
+        return pd.read_parquet(in_file)
+    if in_file.endswith(('.h5', '.hdf5')):
+        return pd.read_hdf(in_file, key)
+    # IDs such as participant 001 stay strings
+    return pd.read_csv(in_file, dtype=dict((column, str) for column in TABLE_COLUMNS[:3]))
@@ -0,0 +1,43 @@
+# Per-node thread/memory planning for the MultiProc scheduler.
+#
+# MultiProc only avoids oversubscription if every node declares what it
+# uses: n_procs (threads) and mem_gb, both given when the Node is created.
+# plan_threads picks a thread count per job so that n_jobs jobs fill
+# total_cores without going over the memory budget; MultiProc then packs the
+# nodes onto the cores. MultiProc refuses to start a node that asks for more
+# than n_procs, so no job is planned more threads than total_cores.
+
+
+def plan_threads(n_jobs, total_cores, total_mem_gb=None, mem_gb_per_job=None,
+                 min_threads=1, max_threads=8):
+    """Threads per job so that concurrent jobs x threads fills total_cores.
+
+    Returns (threads_per_job, concurrent_jobs). min_threads gives way to
+    total_cores on hosts with fewer cores.
+    """
+    total_cores = max(1, total_cores)
+    min_threads = min(min_threads, total_cores)
+    if n_jobs < 1:
+        return min_threads, 0
+    concurrent = min(n_jobs, max(1, total_cores // min_threads))
+    if total_mem_gb and mem_gb_per_job:
+        concurrent = min(concurrent, max(1, int(total_mem_gb // mem_gb_per_job)))
+    threads = min(total_cores, max(min_threads, min(max_threads, total_cores // concurrent)))
+    concurrent = min(concurrent, max(1, total_cores // threads))
+    return threads, concurrent
+
+
+def set_node_resources(node, threads):
+    """Give an interface's own thread settings (and ITK threads for ANTs) the node's threads.
+
+    The node itself declares threads and memory when it is created
+    (Node(..., n_procs=threads, mem_gb=...)).
+    """
+    node.n_procs = threads
+    if 'num_threads' in node.inputs.copyable_trait_names():
+        node.inputs.num_threads = threads
+    if 'environ' in node.inputs.copyable_trait_names():
+        # nipype's ANTs interfaces only export NSLOTS; ANTs shell scripts and
+        # their child programs also read the ITK variable
+        node.inputs.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+    return node
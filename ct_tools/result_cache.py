@@ -0,0 +1,203 @@
+# Content-addressed result cache shared by segment_flow and template_flow.
+#
+# nipype only reuses results inside one workflow_dir and keys them on the
+# node's position in the graph, so the same brainmask/T1/aseg conversion is
+# recomputed by every workflow (and after every edit to a script). Here a
+# result is keyed on the sha1 of the input files' contents, the node
+# parameters and the code that computes it (the compute function's bytecode,
+# the source of the ct_tools modules it calls and CACHE_VERSION), stored once
+# under cache_dir, and linked back into the node directory on a hit. Cached
+# files are read-only, so a node that tries to modify a linked result in
+# place fails instead of corrupting the cache. The cache is capped in size
+# and evicts least recently used entries.
+
+import hashlib
+import importlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+from os.path import abspath, basename, exists, getsize, isdir, join
+
+DEFAULT_MAX_SIZE_GB = 50.0
+
+# bump to invalidate every cached result (e.g. after a change in a
+# dependency that code_digest cannot see)
+CACHE_VERSION = 2
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _read_only(path):
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _code_bytes(code):
+    # bytecode, names and constants, recursing into nested functions
+    parts = [code.co_code, repr(code.co_names).encode()]
+    for const in code.co_consts:
+        parts.append(_code_bytes(const) if hasattr(const, 'co_code') else repr(const).encode())
+    return b'|'.join(parts)
+
+
+def code_digest(compute, modules=()):
+    """sha1 of compute's bytecode, the source files of modules and CACHE_VERSION.
+
+    The bytecode covers a node function defined in a workflow script (whose
+    source nipype does not keep in a file); modules lists the ct_tools
+    modules (by name) whose functions or tables it calls.
+    """
+    sha = hashlib.sha1(b'version %d|' % CACHE_VERSION)
+    sha.update(_code_bytes(compute.__code__))
+    for module in modules:
+        with open(importlib.import_module(module).__file__, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def _atomic_write(path, text):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class ResultCache(object):
+
+    def __init__(self, cache_dir, max_size_gb=None):
+        self.cache_dir = abspath(cache_dir)
+        self.objects_dir = join(self.cache_dir, 'objects')
+        self.hashes_dir = join(self.cache_dir, 'file_hashes')
+        for d in (self.objects_dir, self.hashes_dir):
+            if not isdir(d):
+                os.makedirs(d, exist_ok=True)
+        if max_size_gb is None:
+            max_size_gb = self._read_config().get('max_size_gb',
+                                                  DEFAULT_MAX_SIZE_GB)
+        self.max_bytes = int(max_size_gb * 1e9)
+
+    @classmethod
+    def setup(cls, cache_dir, max_size_gb=DEFAULT_MAX_SIZE_GB):
+        # store the size limit so nodes only need to be given cache_dir
+        cache = cls(cache_dir, max_size_gb)
+        _atomic_write(join(cache.cache_dir, 'config.json'),
+                      json.dumps({'max_size_gb': max_size_gb}))
+        return cache
+
+    def _read_config(self):
+        config_file = join(self.cache_dir, 'config.json')
+        if not exists(config_file):
+            return {}
+        with open(config_file) as f:
+            return json.load(f)
+
+    def file_hash(self, fname):
+        # content hash, memoised on (path, size, mtime) so unchanged inputs on
+        # NFS are not re-read on every run
+        st = os.stat(fname)
+        stamp = '%s|%d|%d' % (abspath(fname), st.st_size, st.st_mtime_ns)
+        memo = join(self.hashes_dir, hashlib.sha1(stamp.encode()).hexdigest())
+        if exists(memo):
+            with open(memo) as f:
+                return f.read().strip()
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        _atomic_write(memo, digest)
+        return digest
+
+    def key(self, name, in_files, params=None, code=None):
+        if isinstance(in_files, str):
+            in_files = [in_files]
+        payload = {'name': name,
+                   'version': CACHE_VERSION,
+                   'code': code,
+                   'inputs': [self.file_hash(f) for f in in_files],
+                   'params': params or {}}
+        blob = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def fetch(self, key, dest_dir='.'):
+        """Link a cached (read-only) result into dest_dir; returns the file list or None."""
+        entry = join(self.objects_dir, key)
+        meta_file = join(entry, 'meta.json')
+        if not exists(meta_file):
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        out_files = []
+        for fname in meta['outputs']:
+            dst = abspath(join(dest_dir, fname))
+            if exists(dst):
+                os.remove(dst)
+            _link_or_copy(join(entry, fname), dst)
+            out_files.append(dst)
+        os.utime(meta_file, None)  # mark as recently used
+        return out_files
+
+    def store(self, key, out_files, name=''):
+        entry = join(self.objects_dir, key)
+        if exists(join(entry, 'meta.json')):
+            return
+        tmp = tempfile.mkdtemp(dir=self.objects_dir, prefix='.tmp_')
+        try:
+            names = []
+            for fname in out_files:
+                _link_or_copy(fname, join(tmp, basename(fname)))
+                # shared with every node directory it is linked into
+                _read_only(join(tmp, basename(fname)))
+                names.append(basename(fname))
+            meta = {'name': name, 'outputs': names, 'created': time.time(),
+                    'size': sum(getsize(f) for f in out_files)}
+            with open(join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp, entry)
+        except OSError:
+            # another worker stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self):
+        found = []
+        for key in os.listdir(self.objects_dir):
+            meta_file = join(self.objects_dir, key, 'meta.json')
+            if key.startswith('.') or not exists(meta_file):
+                continue
+            with open(meta_file) as f:
+                size = json.load(f).get('size', 0)
+            found.append((os.stat(meta_file).st_mtime, size, key))
+        return sorted(found)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(join(self.objects_dir, key), ignore_errors=True)
+            total -= size
+
+    def run(self, name, in_files, params, compute, dest_dir='.', modules=()):
+        """Return cached outputs for (inputs, params, code), computing them on a miss.
+
+        compute() must write its outputs and return their paths; modules
+        are the ct_tools modules it depends on (see code_digest). The
+        returned files are read-only.
+        """
+        key = self.key(name, in_files, params, code_digest(compute, modules))
+        out_files = self.fetch(key, dest_dir)
+        if out_files is None:
+            out_files = compute()
+            self.store(key, out_files, name)
+        return out_files
@@ -0,0 +1,192 @@
+# Node-local scratch staging for workflows whose data lives on NFS (/share).
+#
+# With fs_subjdir, workflow_dir and template_proc all on /share, every
+# intermediate read and write of every node goes over the network, and
+# 10+ concurrent subjects saturate the shared storage. Instead:
+#
+# * stage_subjects copies just the FreeSurfer files a workflow reads into
+#   scratch (in parallel, skipping files that are already up to date);
+# * the workflow's base_dir is on scratch;
+# * DataSink writes into a scratch outbox and WriteBack copies every
+#   delivered file to its place on /share from a background thread pool as
+#   soon as the sink node finishes, verifying each copy by sha256 and
+#   recording the checksums (sha256sum -c format) next to the results; the
+#   outbox's delivery manifest (ct_tools.delivery) is appended to the one on
+#   /share rather than replacing it, with each record's source (a scratch
+#   file that is gone once the job ends) replaced by its copy on /share.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, exists, getmtime, getsize, isdir, join, relpath
+
+from ct_tools.delivery import MANIFEST_NAME, record_deliveries
+
+# FreeSurfer files each workflow reads; recon-all.done keeps the staged
+# subjects visible to ct_tools.subjects.completed_subjects
+SEGMENT_FILES = ('mri/brainmask.mgz', 'mri/aseg.mgz', 'scripts/recon-all.done')
+TEMPLATE_FILES = ('mri/T1.mgz', 'scripts/recon-all.done')
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _up_to_date(src, dest):
+    return exists(dest) and getsize(dest) == getsize(src) and getmtime(dest) == getmtime(src)
+
+
+def _stage_file(src, dest):
+    if _up_to_date(src, dest):
+        return False
+    if not isdir(dirname(dest)):
+        os.makedirs(dirname(dest), exist_ok=True)
+    tmp = '%s.tmp%d' % (dest, os.getpid())
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+    return True
+
+
+def stage_subjects(subjects_dir, subjects, scratch_subjects_dir, files=SEGMENT_FILES,
+                   threads=8):
+    """Copy files (relative to each subject dir) of subjects to scratch.
+
+    Returns the scratch subjects directory, to be used as the workflow's
+    FreeSurfer subjects_dir. Files missing on /share are skipped.
+    """
+    scratch_subjects_dir = abspath(scratch_subjects_dir)
+    jobs = []
+    for sub in subjects:
+        for name in files:
+            src = join(subjects_dir, sub, name)
+            if exists(src):
+                jobs.append((src, join(scratch_subjects_dir, sub, name)))
+    t0 = time.time()
+    with ThreadPoolExecutor(threads) as pool:
+        copied = sum(pool.map(lambda job: _stage_file(*job), jobs))
+    print('staged %d files (%d already up to date) for %d subjects to %s in %.1f s' %
+          (copied, len(jobs) - copied, len(subjects), scratch_subjects_dir, time.time() - t0))
+    return scratch_subjects_dir
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_verified(src, dest, retries=1):
+    """Copy src to dest (atomically) and check the written file's sha256.
+
+    Returns the checksum; raises IOError if the copy still differs after
+    retries attempts.
+    """
+    if not isdir(dirname(dest)):
+        os.makedirs(dirname(dest), exist_ok=True)
+    for attempt in range(retries + 1):
+        digest = hashlib.sha256()
+        tmp = '%s.tmp%d.%d' % (dest, os.getpid(), threading.get_ident())
+        with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+            for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                fout.write(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+        shutil.copystat(src, tmp)
+        if file_sha256(tmp) == digest.hexdigest():
+            os.replace(tmp, dest)
+            return digest.hexdigest()
+        os.remove(tmp)
+    raise IOError('checksum mismatch writing %s to %s' % (src, dest))
+
+
+class WriteBack(object):
+    """Background, checksummed copy of files under src_root to dest_root.
+
+    Use callback as (or inside) the plugin's status_callback to send each
+    DataSink's files as soon as it finishes; sync() sends anything else
+    that appeared under src_root (e.g. batch_apply deliveries), and close()
+    waits for all copies and writes dest_root/writeback-<time>.sha256.
+    """
+
+    def __init__(self, src_root, dest_root, threads=4):
+        self.src_root = abspath(src_root)
+        self.dest_root = abspath(dest_root)
+        self.pool = ThreadPoolExecutor(threads)
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.started = time.strftime('%Y%m%d-%H%M%S')
+
+    def __getstate__(self):
+        # nipype pickles plugin_args (with this callback) into MapNodes; the
+        # copies sent to workers never submit anything
+        return {'src_root': self.src_root, 'dest_root': self.dest_root,
+                'pool': None, 'futures': {}, 'lock': None, 'started': self.started}
+
+    def submit(self, path):
+        path = abspath(path)
+        rel = relpath(path, self.src_root)
+        if rel.startswith('..'):
+            raise ValueError('%s is not under %s' % (path, self.src_root))
+        if rel == MANIFEST_NAME:
+            # merged into the destination's manifest by close()
+            return
+        dest = join(self.dest_root, rel)
+        with self.lock:
+            # outputs left in the outbox by an earlier run are already delivered
+            if rel not in self.futures and not _up_to_date(path, dest):
+                self.futures[rel] = self.pool.submit(copy_verified, path, dest)
+
+    def callback(self, node, status):
+        from nipype.interfaces.io import DataSink
+        if status != 'end' or not isinstance(node.interface, DataSink):
+            return
+        out_files = node.result.outputs.out_file
+        for path in out_files if isinstance(out_files, list) else [out_files]:
+            if path and exists(path):
+                self.submit(path)
+
+    def sync(self):
+        for root, _, names in os.walk(self.src_root):
+            for name in names:
+                self.submit(join(root, name))
+
+    def close(self):
+        """Wait for all copies; returns {relative path: sha256}.
+
+        The outbox's delivery manifest is appended to dest_root's (once every
+        file arrived, with sources pointing at the files in dest_root) and
+        removed from the outbox.
+        """
+        checksums, failures = {}, []
+        for rel, future in sorted(self.futures.items()):
+            try:
+                checksums[rel] = future.result()
+            except Exception as err:
+                failures.append('%s: %s' % (rel, err))
+        self.pool.shutdown()
+        manifest = join(self.src_root, MANIFEST_NAME)
+        if exists(manifest) and not failures:
+            with open(manifest) as f:
+                records = [json.loads(line, object_pairs_hook=OrderedDict)
+                           for line in f if line.strip()]
+            for record in records:
+                # what is on /share is this write-back's verified copy
+                record['source'] = join(self.dest_root, record['path'])
+                record['method'] = 'copy'
+            record_deliveries(self.dest_root, records)
+            os.remove(manifest)
+        if checksums:
+            manifest = join(self.dest_root, 'writeback-%s.sha256' % self.started)
+            with open(manifest, 'w') as f:
+                for rel, digest in sorted(checksums.items()):
+                    f.write('%s  %s\n' % (digest, rel))
+        if failures:
+            raise IOError('write-back to %s failed for %d files:\n%s' %
+                          (self.dest_root, len(failures), '\n'.join(failures)))
+        return checksums
@@ -0,0 +1,96 @@
+# Subject discovery for the FreeSurfer subjects directory.
+#
+# listdir(fs_subjdir) picks up log files, fsaverage links and subjects whose
+# recon-all is still running or failed. Only subjects with
+# scripts/recon-all.done are returned here, and a small JSON manifest
+# remembers the recon-all.done timestamp each subject was last processed
+# with, so reruns only feed new or re-run subjects into the workflow.
+#
+# Longitudinal subject IDs are <participant>-<session>; parse_session splits
+# them for the template, regional and group-level code.
+
+import json
+import os
+import re
+from datetime import datetime
+from os.path import exists, isdir, islink, join
+
+from ct_tools.delivery import read_deliveries
+
+# subject IDs are <participant>-<session>, e.g. 145-T1, 156-Tmid, 307-TK1
+SESSION_PATTERN = re.compile(r'^(?P<participant>[^-]+)-(?P<session>T1|Tmid|T2|TK\d*)$')
+
+
+def parse_session(subject_id):
+    """'145-Tmid' -> ('145', 'Tmid')."""
+    match = SESSION_PATTERN.match(subject_id)
+    if not match:
+        raise ValueError('%s is not a <participant>-<session> subject ID' % subject_id)
+    return match.group('participant'), match.group('session')
+
+
+def completed_subjects(subjects_dir):
+    """Return {subject: recon-all.done mtime} for finished subjects."""
+    subjects = {}
+    for sub in sorted(os.listdir(subjects_dir)):
+        sub_dir = join(subjects_dir, sub)
+        if sub.startswith('fsaverage') or islink(sub_dir) or not isdir(sub_dir):
+            continue
+        done_file = join(sub_dir, 'scripts', 'recon-all.done')
+        if exists(done_file):
+            subjects[sub] = os.stat(done_file).st_mtime
+    return subjects
+
+
+def read_manifest(manifest_file):
+    if not exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def find_new_subjects(subjects_dir, manifest_file):
+    """Finished subjects that are not in the manifest or were re-run since."""
+    manifest = read_manifest(manifest_file)
+    new_subjects = []
+    for sub, done_time in completed_subjects(subjects_dir).items():
+        if sub not in manifest or manifest[sub]['done_time'] != done_time:
+            new_subjects.append(sub)
+    return new_subjects
+
+
+def record_subjects(manifest_file, subjects_dir, subjects):
+    """Mark subjects as processed with their current recon-all.done time."""
+    manifest = read_manifest(manifest_file)
+    done = completed_subjects(subjects_dir)
+    now = datetime.now().isoformat()
+    for sub in subjects:
+        if sub in done:
+            manifest[sub] = {'done_time': done[sub], 'processed': now}
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+    return manifest
+
+
+def delivered_subjects(sink_dir, containers):
+    """Subjects that have outputs in every DataSink container of sink_dir.
+
+    Read from sink_dir's delivery manifest (ct_tools.delivery) when there is
+    one; sinks delivered without it are found by listing the container folders.
+    """
+    deliveries = read_deliveries(sink_dir)
+    subjects = None
+    for container in containers:
+        if deliveries:
+            found = set(record['subject'] for record in deliveries.values()
+                        if record['container'] == container and record['subject'])
+        else:
+            container_dir = join(sink_dir, container)
+            found = set(os.listdir(container_dir)) if isdir(container_dir) else set()
+        subjects = found if subjects is None else subjects & found
+    return sorted(subjects or [])
@@ -0,0 +1,293 @@
+# Template construction with ANTs antsMultivariateTemplateConstruction2.sh
+#
+# make3DTemplate is wrapped directly in a nipype Function node by both
+# workflows, so it keeps its imports inside the function body.
+#
+# make_subject_templates is the first level of a two-level template: the
+# sessions of each participant (<participant>-T1, -Tmid, -T2, -TK1, ...) are
+# built into a within-subject template, participants in parallel in a process
+# pool, and the group template is then built from those.
+#
+# With a tolerance or a state_dir, make3DTemplate runs the ANTs script one
+# iteration at a time, measures how much each iteration still changes the
+# template, stops once that falls below the tolerance, and keeps every
+# iteration's template in state_dir so that a crashed build resumes from the
+# last one instead of from the start.
+
+import json
+import os
+from collections import OrderedDict
+
+from ct_tools.subjects import parse_session
+
+# antsMultivariateTemplateConstruction2.sh -c values
+PARALLEL_MODES = {'serial': 0,
+                  'sge': 1,
+                  'local': 2,   # pexec on localhost, uses -j cores
+                  'pbs': 4,
+                  'slurm': 5}
+
+# iteration state of make3DTemplate runs with a state_dir
+STATE_NAME = 'template_state.json'
+
+
+def make3DTemplate(subject_T1s, num_proc, output_prefix, parallel_mode='local',
+                   iterations=4, ants_script='antsMultivariateTemplateConstruction2.sh',
+                   extra_args=None, tolerance=None, state_dir=None):
+    """Build a group template from subject_T1s with the ANTs template script.
+
+    The inputs are symlinked (not copied) into the node directory under unique
+    names, because ANTs names its per-subject outputs after the input file
+    names and every subject's file is called T1/brainmask. parallel_mode picks
+    the ANTs -c backend: 'serial', 'local' (num_proc cores on this machine),
+    'sge', 'pbs' or 'slurm' (num_proc jobs on the cluster). The script's
+    output is streamed into the nipype log and into ants_template.log.
+
+    With tolerance or state_dir the script is run one iteration at a time
+    (at most iterations), each starting from the previous template (-z).
+    The change between successive templates (template_change) is logged and
+    written to state_dir/template_convergence.csv, and the iterations stop
+    once it is below tolerance. Each iteration's template is kept in
+    state_dir, which should be outside the workflow directory: a rerun on
+    the same inputs resumes after the last finished iteration.
+    """
+    from nipype import logging
+    from os import getcwd, readlink, remove, replace, symlink
+    from os.path import abspath, basename, islink, join, lexists
+    from shutil import copyfile
+    from ct_tools.templates import (PARALLEL_MODES, _run_ants_template, template_change,
+                                    template_state)
+
+    iflogger = logging.getLogger('nipype.interface')
+    if parallel_mode not in PARALLEL_MODES:
+        raise ValueError('parallel_mode must be one of %s, not %r' %
+                         (sorted(PARALLEL_MODES), parallel_mode))
+
+    curr_dir = getcwd()
+
+    #link T1s into current directory with unique names
+    input_files = []
+    for T, subject_T1 in enumerate(subject_T1s):
+        linked = join(curr_dir, 'S' + str(T) + '_' + basename(subject_T1))
+        if lexists(linked):
+            if islink(linked) and readlink(linked) == abspath(subject_T1):
+                input_files.append(linked)
+                continue
+            # left by a run on another subject list (or a copy): never reuse it
+            remove(linked)
+        try:
+            symlink(abspath(subject_T1), linked)
+        except OSError:
+            # filesystems without symlink support
+            copyfile(subject_T1, linked)
+        input_files.append(linked)
+
+    # -c flag is control for parallel computing (see PARALLEL_MODES)
+    # -j flag is for number of processors/jobs allowed
+    cmd = [ants_script, '-d', '3', '-o', output_prefix,
+           '-c', str(PARALLEL_MODES[parallel_mode]), '-j', str(num_proc)]
+    if extra_args:
+        cmd += list(extra_args)
+    sample_template = abspath(output_prefix + 'template0.nii.gz')
+
+    if tolerance is None and state_dir is None:
+        _run_ants_template(cmd[:5] + ['-r', '1', '-i', str(iterations)] + cmd[5:] + input_files,
+                           sample_template, iflogger)
+        return(sample_template)
+
+    state_dir = abspath(state_dir or 'template_state')
+    state = template_state(state_dir, subject_T1s, {'output_prefix': output_prefix,
+                                                    'ants_script': ants_script,
+                                                    'extra_args': extra_args})
+    done = state['iterations']
+    if done:
+        iflogger.info('Resuming template construction after iteration %d (%s)',
+                      len(done), done[-1]['template'])
+
+    def converged():
+        return tolerance is not None and bool(done) and done[-1]['change'] < tolerance
+
+    while len(done) < iterations and not converged():
+        k = len(done) + 1
+        if done:
+            # rigid initialization only before the first iteration
+            start = ['-r', '0', '-i', '1', '-z', join(state_dir, done[-1]['template'])]
+        else:
+            start = ['-r', '1', '-i', '1']
+        _run_ants_template(cmd[:5] + start + cmd[5:] + input_files, sample_template, iflogger)
+        template_file = 'iteration%02d_template0.nii.gz' % k
+        copyfile(sample_template, join(state_dir, template_file + '.tmp'))
+        replace(join(state_dir, template_file + '.tmp'), join(state_dir, template_file))
+        change, correlation = (template_change(sample_template, join(state_dir, done[-1]['template']))
+                               if done else (float('nan'), float('nan')))
+        done.append({'iteration': k, 'template': template_file,
+                     'change': change, 'correlation': correlation})
+        template_state(state_dir, state=state)
+        iflogger.info('Template iteration %d/%d: change %.6f, correlation %.6f%s', k, iterations,
+                      change, correlation, ' (converged)' if converged() else '')
+
+    with open(join(state_dir, 'template_convergence.csv'), 'w') as f:
+        f.write('iteration,change,correlation,template\n')
+        for step in done:
+            f.write('%d,%.8g,%.8g,%s\n' % (step['iteration'], step['change'], step['correlation'],
+                                            join(state_dir, step['template'])))
+    # the node directory's copy may be from a later, discarded run
+    copyfile(join(state_dir, done[-1]['template']), sample_template)
+    return(sample_template)
+
+
+def _run_ants_template(cmd, sample_template, iflogger):
+    from subprocess import Popen, PIPE, STDOUT
+    if os.path.exists(sample_template):
+        # left by the previous iteration; a failed run must not pass for a finished one
+        os.remove(sample_template)
+    iflogger.info('Running: %s', ' '.join(cmd))
+    with open('ants_template.log', 'a') as log:
+        proc = Popen(cmd, stdout=PIPE, stderr=STDOUT, universal_newlines=True,
+                     bufsize=1)
+        for line in proc.stdout:
+            log.write(line)
+            iflogger.info(line.rstrip())
+        returncode = proc.wait()
+    if returncode != 0 or not os.path.exists(sample_template):
+        raise RuntimeError('%s exited with status %d; see %s' %
+                           (cmd[0], returncode, os.path.abspath('ants_template.log')))
+
+
+def template_change(new_file, old_file):
+    """(normalized RMS difference, correlation) of two template estimates.
+
+    The change is ||new - old|| / ||old|| over the voxels where either is
+    nonzero. Templates on different grids give (nan, nan), which never
+    counts as converged.
+    """
+    import numpy as np
+    from ct_tools.volume_io import load_volume
+    new_img, new = load_volume(new_file)
+    old_img, old = load_volume(old_file)
+    if new_img.shape != old_img.shape or not np.allclose(new_img.affine, old_img.affine, atol=1e-3):
+        return float('nan'), float('nan')
+    new = np.asarray(new, dtype=np.float64)
+    old = np.asarray(old, dtype=np.float64)
+    voxels = (new != 0) | (old != 0)
+    new, old = new[voxels], old[voxels]
+    norm = np.sqrt(np.sum(old * old))
+    change = np.sqrt(np.sum((new - old) ** 2)) / norm if norm > 0 else float('nan')
+    if new.size < 2 or new.std() == 0 or old.std() == 0:
+        correlation = float('nan')
+    else:
+        correlation = np.corrcoef(new, old)[0, 1]
+    return float(change), float(correlation)
+
+
+def read_template_state(state_dir):
+    state_file = os.path.join(state_dir, STATE_NAME)
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def template_state(state_dir, in_files=None, params=None, state=None):
+    """Iteration state of a template build in state_dir.
+
+    With in_files/params, returns the stored state if it was built from
+    the same inputs (by sha256) and parameters, and otherwise starts a new
+    one (removing the old iteration templates). With state, writes it.
+    """
+    from ct_tools.staging import file_sha256
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+    if state is None:
+        key = {'inputs': [file_sha256(f) for f in in_files], 'params': params}
+        state = read_template_state(state_dir)
+        if state is not None and state['key'] == json.loads(json.dumps(key)):
+            return state
+        for name in os.listdir(state_dir):
+            if name.startswith('iteration') and name.endswith('template0.nii.gz'):
+                os.remove(os.path.join(state_dir, name))
+        state = {'key': key, 'iterations': []}
+    state_file = os.path.join(state_dir, STATE_NAME)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_file + '.tmp', state_file)
+    return state
+
+
+def group_sessions(subject_ids, in_files):
+    """Group session files by participant: [(participant, [files])] in first-seen order."""
+    groups = OrderedDict()
+    for sub, in_file in zip(subject_ids, in_files):
+        try:
+            participant = parse_session(sub)[0]
+        except ValueError:
+            participant = sub
+        groups.setdefault(participant, []).append(in_file)
+    return list(groups.items())
+
+
+def _participant_template(participant, session_files, work_dir, num_threads, iterations,
+                          ants_script, extra_args, cache_dir, tolerance=None, state_dir=None):
+    """Process pool worker: one participant's within-subject template in work_dir."""
+    import shutil
+    from os.path import abspath, exists, join
+    if not exists(work_dir):
+        os.makedirs(work_dir)
+    os.chdir(work_dir)
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_threads)
+    prefix = participant + '_'
+
+    def _template():
+        if len(session_files) == 1:
+            # a single session is its own template, under the participant's name
+            in_file = session_files[0]
+            ext = '.nii.gz' if in_file.endswith('.nii.gz') else '.nii'
+            out_file = abspath(prefix + 'template0' + ext)
+            if exists(out_file):
+                os.remove(out_file)
+            try:
+                os.link(in_file, out_file)
+            except OSError:
+                shutil.copy2(in_file, out_file)
+            return [out_file]
+        return [make3DTemplate(session_files, num_threads, prefix, 'serial', iterations,
+                               ants_script, extra_args, tolerance,
+                               join(state_dir, participant) if state_dir else None)]
+
+    if cache_dir:
+        from ct_tools.result_cache import ResultCache
+        params = {'participant': participant, 'iterations': iterations,
+                  'ants_script': ants_script, 'extra_args': extra_args, 'tolerance': tolerance}
+        return ResultCache(cache_dir).run('subject_template', session_files, params, _template,
+                                          modules=('ct_tools.templates',))[0]
+    return _template()[0]
+
+
+def make_subject_templates(subject_T1s, subject_ids, n_jobs=4, num_threads=2, iterations=4,
+                           ants_script='antsMultivariateTemplateConstruction2.sh',
+                           extra_args=None, cache_dir=None, tolerance=None, state_dir=None):
+    """Build one within-subject template per participant, in parallel.
+
+    subject_T1s are in subject_ids (<participant>-<session>) order. Each
+    participant's sessions go through the ANTs template script (serial
+    mode, num_threads ITK threads) in its own directory, n_jobs participants
+    at a time; a participant with a single session passes it through. With
+    cache_dir, templates are shared through ct_tools.result_cache, so only
+    participants whose sessions changed are rebuilt. tolerance and
+    state_dir (one subdirectory per participant) are make3DTemplate's
+    early stopping and resume. Returns (subject_templates, participants).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from os import getcwd
+    from os.path import join
+    from ct_tools.templates import _participant_template, group_sessions
+
+    groups = group_sessions(subject_ids, subject_T1s)
+    base_dir = getcwd()
+    participants = [participant for participant, _ in groups]
+    jobs = [[participant, files, join(base_dir, 'participant_' + participant), num_threads,
+             iterations, ants_script, extra_args, cache_dir, tolerance, state_dir]
+            for participant, files in groups]
+    with ProcessPoolExecutor(max(1, min(n_jobs, len(jobs)))) as pool:
+        subject_templates = list(pool.map(_participant_template, *zip(*jobs)))
+    return(subject_templates, participants)
@@ -0,0 +1,107 @@
+# Label-to-tissue lookup table engine for FreeSurfer aseg volumes.
+#
+# Instead of scanning the aseg once per label (aseg_data == x), a small
+# (n_classes x n_labels) uint8 table is built once and the whole volume is
+# mapped through it with a single gather, giving every tissue class at once.
+
+from collections import OrderedDict
+
+import numpy as np
+
+# Default FreeSurfer aseg label scheme used for the template subjects.
+# Order matters: it is the order of the masks returned to the workflow.
+DEFAULT_LABEL_SCHEME = OrderedDict([
+    ('subcortical_gm', [8, 10, 11, 12, 13, 17, 18, 26,
+                        47, 49, 50, 51, 52, 53, 54, 58]),
+    ('cortical_gm', [3, 42]),
+])
+
+
+def build_label_lut(label_scheme=None):
+    """Build a one-hot lookup table from a {class name: [labels]} scheme.
+
+    Returns (lut, class_names). lut has shape (n_classes, max_label + 2);
+    the extra last column is all zeros so out-of-range labels can be clipped
+    onto it.
+    """
+    if label_scheme is None:
+        label_scheme = DEFAULT_LABEL_SCHEME
+    class_names = list(label_scheme.keys())
+    all_labels = [int(l) for labels in label_scheme.values() for l in labels]
+    if not all_labels:
+        raise ValueError('label scheme does not contain any labels')
+    if min(all_labels) < 1:
+        raise ValueError('labels must be positive; 0 is background')
+
+    lut = np.zeros((len(class_names), max(all_labels) + 2), dtype=np.uint8)
+    for k, name in enumerate(class_names):
+        lut[k, np.asarray(label_scheme[name], dtype=np.intp)] = 1
+    return lut, class_names
+
+
+def _as_label_array(aseg_data):
+    # Labels may come in as float (e.g. get_data()) or any integer type;
+    # the gather needs an integer index array.
+    aseg_data = np.asanyarray(aseg_data)
+    if aseg_data.dtype.kind in 'iu':
+        return aseg_data
+    return np.rint(aseg_data).astype(np.int32)
+
+
+def labels_to_tissue_masks(aseg_data, label_scheme=None, lut=None):
+    """Map a label volume to uint8 tissue masks in one pass.
+
+    Returns an OrderedDict {class name: uint8 mask}. Each mask is a
+    contiguous view into a single (n_classes,) + aseg.shape array.
+    """
+    if lut is None:
+        lut, class_names = build_label_lut(label_scheme)
+    else:
+        class_names = list((label_scheme or DEFAULT_LABEL_SCHEME).keys())
+    labels = _as_label_array(aseg_data)
+    masks = np.take(lut, labels, axis=1, mode='clip')
+    return OrderedDict((name, masks[k]) for k, name in enumerate(class_names))
+
+
+def order_classes_by_intensity(t1_data, class_maps):
+    """Order tissue class maps by their mean T1 intensity (dark to bright).
+
+    class_maps are partial volume (or binary) maps on the T1 grid; each map's
+    mean intensity is weighted by its values. On a T1-weighted image the
+    result is CSF, GM, WM. Returns (order, means), order being indices into
+    class_maps.
+    """
+    t1 = np.asarray(t1_data, dtype=np.float32).ravel()
+    means = []
+    for class_map in class_maps:
+        weights = np.asarray(class_map, dtype=np.float32).ravel()
+        total = weights.sum(dtype=np.float64)
+        means.append(float(np.dot(weights, t1)) / total if total > 0 else np.inf)
+    return list(np.argsort(means, kind='stable')), means
+
+
+def binarize_volume(data, min_value=1, dilate=1, erode=1):
+    """Threshold (>= min_value) and close a volume like mri_binarize.
+
+    Dilation and then erosion are applied `dilate`/`erode` times with a
+    3x3x3 structuring element. Returns a uint8 mask.
+    """
+    from scipy import ndimage
+    mask = np.asanyarray(data) >= min_value
+    structure = np.ones((3, 3, 3), dtype=bool)
+    if dilate:
+        mask = ndimage.binary_dilation(mask, structure, iterations=dilate)
+    if erode:
+        mask = ndimage.binary_erosion(mask, structure, iterations=erode)
+    return mask.view(np.uint8)
+
+
+def binarize_brain_mask(in_file, out_file='brainmask_bin.nii.gz', min=1,
+                        dilate=1, erode=1):
+    """nipype Function replacement for the FreeSurfer Binarize node."""
+    from os.path import abspath
+    from ct_tools.tissue_maps import binarize_volume
+    from ct_tools.volume_io import load_volume, save_mask
+    img, data = load_volume(in_file)
+    save_mask(binarize_volume(data, min, dilate, erode), img, out_file)
+    return(abspath(out_file))
@@ -0,0 +1,229 @@
+# Out-of-core accumulation of tissue priors from warped template-subject masks.
+#
+# Each class keeps a running float32 sum in a memory-mapped file, and
+# subjects are added one at a time, so peak memory is one subject's mask plus
+# the page cache and does not grow with the number of subjects.
+#
+# The sums can also be kept between runs (update_priors): an index records
+# the sha256 of every subject's delivered masks and keeps the warped masks
+# that went into the sums, so when a few template subjects' masks are edited
+# only those subjects are re-registered and warped, and their old
+# contribution is subtracted before the new one is added.
+
+import json
+import os
+from glob import glob
+from os.path import abspath, exists, join
+
+import numpy as np
+import nibabel as nib
+
+from ct_tools.volume_io import load_volume
+
+# ANTs cortical thickness prior order: 1 CSF, 2 cortical GM, 3 WM, 4 subcortical GM
+PRIOR_CLASSES = ['csf', 'cortical_gm', 'wm', 'subcortical_gm']
+BRAIN_CLASS = 'brain'
+
+
+class PriorAccumulator(object):
+
+    def __init__(self, work_dir, reference_file, class_names):
+        self.work_dir = abspath(work_dir)
+        if not exists(self.work_dir):
+            os.makedirs(self.work_dir)
+        self.reference = nib.load(reference_file)
+        self.shape = self.reference.shape[:3]
+        self.class_names = list(class_names)
+        self.state_file = join(self.work_dir, 'accumulator.json')
+        self.counts = {}
+        if exists(self.state_file):
+            with open(self.state_file) as f:
+                self.counts = json.load(f)['counts']
+        self.sums = {}
+        for name in self.class_names:
+            sum_file = join(self.work_dir, 'sum_%s.f32' % name)
+            mode = 'r+' if exists(sum_file) else 'w+'
+            self.sums[name] = np.memmap(sum_file, dtype=np.float32, mode=mode,
+                                        shape=self.shape)
+            self.counts.setdefault(name, 0)
+
+    def add(self, name, mask_file, sign=1):
+        """Add (sign=1) or subtract (sign=-1) one subject's warped mask."""
+        _, data = load_volume(mask_file)
+        if data.shape[:3] != self.shape:
+            raise ValueError('%s has shape %s, expected the template grid %s' %
+                             (mask_file, data.shape, self.shape))
+        acc = self.sums[name]
+        # slab by slab, so only one slab of float32 temporaries exists at once
+        for start in range(0, self.shape[0], 32):
+            stop = min(start + 32, self.shape[0])
+            slab = np.asarray(data[start:stop], dtype=np.float32)
+            if sign > 0:
+                acc[start:stop] += slab
+            else:
+                acc[start:stop] -= slab
+        self.counts[name] += sign
+
+    def add_subject(self, mask_files, sign=1):
+        """mask_files: {class name: warped mask file} for one subject."""
+        for name, mask_file in mask_files.items():
+            self.add(name, mask_file, sign)
+
+    def flush(self):
+        for acc in self.sums.values():
+            acc.flush()
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'counts': self.counts}, f)
+        os.replace(tmp_file, self.state_file)
+
+    def write_priors(self, out_dir='.', out_ext='.nii.gz',
+                     prior_classes=PRIOR_CLASSES, brain_class=BRAIN_CLASS):
+        """Write normalised priors on the reference grid.
+
+        Each prior is the fraction of subjects with that tissue at a voxel;
+        where the tissue fractions add up to more than 1 (overlapping or
+        interpolated masks) they are rescaled to sum to 1. Returns
+        (prior files in ANTs order, brain probability file or None).
+        """
+        self.flush()
+        total = np.zeros(self.shape, dtype=np.float32)
+        for name in prior_classes:
+            total += self.sums[name] / max(self.counts[name], 1)
+        scale = 1.0 / np.maximum(total, 1.0)
+        del total
+
+        prior_files = []
+        for k, name in enumerate(prior_classes):
+            prior = (self.sums[name] / max(self.counts[name], 1)) * scale
+            out_file = abspath(join(out_dir, 'segmentationPriors%d%s' % (k + 1, out_ext)))
+            self._save(np.clip(prior, 0, 1), out_file)
+            prior_files.append(out_file)
+
+        brain_file = None
+        if brain_class in self.sums:
+            brain = self.sums[brain_class] / max(self.counts[brain_class], 1)
+            brain_file = abspath(join(out_dir, 'brain_prior' + out_ext))
+            self._save(np.clip(brain, 0, 1), brain_file)
+        return prior_files, brain_file
+
+    def _save(self, data, out_file):
+        img = nib.Nifti1Image(np.asarray(data, dtype=np.float32),
+                              self.reference.affine)
+        img.set_data_dtype(np.float32)
+        nib.save(img, out_file)
+
+
+INDEX_NAME = 'prior_index.json'
+
+
+def read_prior_index(state_dir):
+    index_file = join(state_dir, INDEX_NAME)
+    if not exists(index_file):
+        return None
+    with open(index_file) as f:
+        return json.load(f)
+
+
+def _write_prior_index(state_dir, index):
+    index_file = join(state_dir, INDEX_NAME)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def _index_valid(index, template_checksum, class_names):
+    """Sums in state_dir can be updated (same template and classes, no update cut short)."""
+    return (index is not None and index['template'] == template_checksum and
+            index['class_names'] == list(class_names) and not index.get('pending'))
+
+
+def mask_checksums(base_dir, templates, subject):
+    """{key: sha256} of one subject's files ({key: SelectFiles pattern})."""
+    from ct_tools.staging import file_sha256
+    checksums = {}
+    for key, pattern in sorted(templates.items()):
+        matches = sorted(glob(join(base_dir, pattern.format(subject_id=subject))))
+        checksums[key] = file_sha256(matches[0]) if matches else None
+    return checksums
+
+
+def plan_prior_update(state_dir, base_dir, templates, subjects, template_file, class_names):
+    """Subjects whose contribution to the priors in state_dir is out of date.
+
+    Returns (changed, removed, checksums): subjects that are new or whose
+    files under base_dir changed since they were added, subjects in the sums
+    that are no longer delivered, and {subject: mask_checksums} for the
+    changed ones. Every subject is changed when the sums cannot be updated
+    (no index yet, another template or class list, an update cut short).
+    """
+    from ct_tools.staging import file_sha256
+    index = read_prior_index(state_dir)
+    if not _index_valid(index, file_sha256(template_file), class_names):
+        index = {'subjects': {}}
+    checksums = {}
+    for sub in subjects:
+        sums = mask_checksums(base_dir, templates, sub)
+        if index['subjects'].get(sub, {}).get('checksums') != sums:
+            checksums[sub] = sums
+    changed = [sub for sub in subjects if sub in checksums]
+    removed = sorted(set(index['subjects']) - set(subjects))
+    return changed, removed, checksums
+
+
+def update_priors(warped_masks, subject_ids, checksums, class_names, template_file,
+                  state_dir, removed=None, out_ext='.nii.gz', out_dir='.'):
+    """nipype Function node: update the priors kept in state_dir and write them.
+
+    warped_masks holds one list per subject in subject_ids (as joined over
+    the subjects) of warped mask files in class_names order; checksums is
+    plan_prior_update's {subject: mask checksums}. A subject already in the
+    sums has its previous warped masks subtracted before the new ones are
+    added; subjects in removed are only subtracted. The state is rebuilt
+    from scratch when plan_prior_update would have (see _index_valid). The
+    priors are written to out_dir.
+    """
+    from os import makedirs
+    from os.path import basename, exists, join, relpath
+    from shutil import rmtree
+    from ct_tools.delivery import deliver_file
+    from ct_tools.staging import file_sha256
+    from ct_tools.tissue_priors import (PriorAccumulator, _index_valid, _write_prior_index,
+                                        read_prior_index)
+
+    template_checksum = file_sha256(template_file)
+    index = read_prior_index(state_dir)
+    if not _index_valid(index, template_checksum, class_names):
+        if exists(state_dir):
+            rmtree(state_dir)
+        index = {'template': template_checksum, 'class_names': list(class_names),
+                 'subjects': {}, 'pending': None}
+    accumulator = PriorAccumulator(state_dir, template_file, class_names)
+
+    updates = [(sub, None) for sub in (removed or [])] + list(zip(subject_ids, warped_masks))
+    for sub, masks in updates:
+        # a crash between here and the index update leaves 'pending' set: the next run rebuilds
+        index['pending'] = sub
+        _write_prior_index(state_dir, index)
+        sub_dir = join(state_dir, 'contributions', sub)
+        old = index['subjects'].pop(sub, None)
+        if old:
+            accumulator.add_subject(dict((name, join(state_dir, path))
+                                         for name, path in old['warped'].items()), sign=-1)
+            rmtree(sub_dir)
+        if masks:
+            makedirs(sub_dir)
+            warped = {}
+            for name, mask_file in zip(class_names, masks):
+                kept = join(sub_dir, name + '_' + basename(mask_file))
+                # internal state, never edited: share the data with the workflow directory
+                deliver_file(mask_file, kept, 'link')
+                warped[name] = relpath(kept, state_dir)
+            accumulator.add_subject(dict(zip(class_names, masks)))
+            index['subjects'][sub] = {'checksums': checksums[sub], 'warped': warped}
+        accumulator.flush()
+        index['pending'] = None
+        _write_prior_index(state_dir, index)
+
+    prior_files, brain_prior = accumulator.write_priors(out_dir, out_ext)
+    return(prior_files, brain_prior)
@@ -0,0 +1,176 @@
+# In-process tissue segmentation engine, an optional stand-in for FSL FAST.
+#
+# A K-class Gaussian mixture is fitted to the brain voxel intensities with EM
+# (over the distinct intensity values weighted by their counts, which is exact
+# and for FreeSurfer's uint8 brainmask means ~256 values instead of millions of
+# voxels), followed by a mean-field MRF step that smooths the class posteriors
+# with their 6-neighbourhood. The voxel work is split into slabs along the
+# first axis and run on a thread pool; numpy releases the GIL for the heavy
+# array operations.
+#
+# Classes are returned ordered by mean intensity (dark to bright), i.e. CSF,
+# GM, WM for a T1-weighted image, which is also how FAST numbers them.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def _slabs(n, chunk):
+    return [(i, min(i + chunk, n)) for i in range(0, n, chunk)]
+
+
+def fit_gmm(values, counts, n_classes=3, max_iter=100, tol=1e-6):
+    """EM for a 1-D Gaussian mixture on (value, count) pairs.
+
+    Returns (means, variances, weights), sorted by mean.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+
+    # start from the weighted quantiles of the intensity distribution
+    cdf = np.cumsum(counts) / total
+    quantiles = (np.arange(n_classes) + 0.5) / n_classes
+    means = values[np.minimum(np.searchsorted(cdf, quantiles), len(values) - 1)]
+    mean_all = (counts * values).sum() / total
+    var_all = (counts * (values - mean_all) ** 2).sum() / total
+    variances = np.full(n_classes, max(var_all / n_classes, 1e-6))
+    weights = np.full(n_classes, 1.0 / n_classes)
+
+    prev_ll = -np.inf
+    for _ in range(max_iter):
+        log_p = (-0.5 * (values[:, None] - means) ** 2 / variances
+                 - 0.5 * np.log(2 * np.pi * variances) + np.log(weights))
+        log_norm = np.logaddexp.reduce(log_p, axis=1)
+        resp = np.exp(log_p - log_norm[:, None]) * counts[:, None]
+        nk = resp.sum(axis=0) + 1e-12
+        means = (resp * values[:, None]).sum(axis=0) / nk
+        variances = np.maximum((resp * (values[:, None] - means) ** 2).sum(axis=0) / nk,
+                               1e-6)
+        weights = nk / total
+        ll = (counts * log_norm).sum() / total
+        if abs(ll - prev_ll) < tol:
+            break
+        prev_ll = ll
+
+    order = np.argsort(means)
+    return means[order], variances[order], weights[order]
+
+
+def segment_tissues(data, mask=None, n_classes=3, mrf_beta=0.5, mrf_iter=5,
+                    n_threads=4, slab_size=16):
+    """Segment a skull-stripped volume into n_classes tissue classes.
+
+    data: 3D intensity volume. mask: brain mask (default data > 0).
+    Returns (pve, labels, means): pve is (n_classes,) + data.shape float32
+    posterior (partial volume) maps, labels is uint8 with 0 outside the mask
+    and 1..n_classes inside, classes ordered dark to bright.
+    """
+    data = np.asanyarray(data)
+    if mask is None:
+        mask = data > 0
+    mask = np.asarray(mask, dtype=bool)
+    pve = np.zeros((n_classes,) + data.shape, dtype=np.float32)
+    labels = np.zeros(data.shape, dtype=np.uint8)
+    if not mask.any():
+        return pve, labels, np.zeros(n_classes)
+
+    # work on the brain bounding box only
+    bbox = tuple(slice(idx.min(), idx.max() + 1) for idx in np.nonzero(mask))
+    sub = np.asarray(data[bbox], dtype=np.float32)
+    sub_mask = mask[bbox]
+
+    values, counts = np.unique(sub[sub_mask], return_counts=True)
+    means, variances, weights = fit_gmm(values, counts, n_classes)
+
+    # per-class log likelihood of every distinct intensity, looked up per voxel
+    log_lik_values = (-0.5 * (values[:, None] - means) ** 2 / variances
+                      - 0.5 * np.log(2 * np.pi * variances)
+                      + np.log(weights)).astype(np.float32)
+
+    nx = sub.shape[0]
+    slabs = _slabs(nx, slab_size)
+    log_lik = np.zeros((n_classes,) + sub.shape, dtype=np.float32)
+    prob = np.zeros_like(log_lik)
+
+    def _softmax_into(out, logit, slab_mask):
+        logit = logit - logit.max(axis=0)
+        np.exp(logit, out=logit)
+        logit /= logit.sum(axis=0)
+        logit *= slab_mask
+        out[...] = logit
+
+    def _init_slab(slab):
+        start, stop = slab
+        slab_mask = sub_mask[start:stop]
+        idx = np.searchsorted(values, sub[start:stop])
+        idx = np.minimum(idx, len(values) - 1)
+        log_lik[:, start:stop] = np.moveaxis(log_lik_values[idx], -1, 0)
+        _softmax_into(prob[:, start:stop], log_lik[:, start:stop].copy(), slab_mask)
+
+    def _mrf_slab(slab, current, new):
+        # mean-field update: log posterior = log likelihood + beta * sum of the
+        # neighbours' class probabilities (6-neighbourhood, 1-voxel halo)
+        start, stop = slab
+        lo, hi = max(start - 1, 0), min(stop + 1, nx)
+        block = current[:, lo:hi]
+        nsum = np.zeros_like(block)
+        nsum[:, 1:] += block[:, :-1]
+        nsum[:, :-1] += block[:, 1:]
+        nsum[:, :, 1:] += block[:, :, :-1]
+        nsum[:, :, :-1] += block[:, :, 1:]
+        nsum[..., 1:] += block[..., :-1]
+        nsum[..., :-1] += block[..., 1:]
+        nsum = nsum[:, start - lo:start - lo + (stop - start)]
+        logit = log_lik[:, start:stop] + mrf_beta * nsum
+        _softmax_into(new[:, start:stop], logit, sub_mask[start:stop])
+
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+        list(pool.map(_init_slab, slabs))
+        if mrf_beta > 0:
+            new = np.empty_like(prob)
+            for _ in range(mrf_iter):
+                list(pool.map(lambda s: _mrf_slab(s, prob, new), slabs))
+                prob, new = new, prob
+
+    pve[(slice(None),) + bbox] = prob
+    sub_labels = (np.argmax(prob, axis=0) + 1).astype(np.uint8)
+    sub_labels[~sub_mask] = 0
+    labels[bbox] = sub_labels
+    return pve, labels, means
+
+
+def segment_tissues_node(in_files, number_classes=3, out_basename='brainmask',
+                         out_ext='.nii.gz', mrf_beta=0.5, mrf_iter=5, n_threads=4):
+    """nipype Function wrapper with FAST-compatible outputs.
+
+    Writes <out_basename>_seg_<k> (binary class masks) and
+    <out_basename>_pve_<k> (partial volume maps) for k = 0..number_classes-1
+    and returns (tissue_class_files, partial_volume_files).
+    """
+    from os.path import abspath
+    from nibabel import save, Nifti1Image
+    from numpy import float32
+    from ct_tools.tissue_segment import segment_tissues
+    from ct_tools.volume_io import load_volume, save_mask
+
+    in_file = in_files[0] if isinstance(in_files, (list, tuple)) else in_files
+    img, data = load_volume(in_file)
+    pve, labels, means = segment_tissues(data, n_classes=number_classes,
+                                         mrf_beta=mrf_beta, mrf_iter=mrf_iter,
+                                         n_threads=n_threads)
+
+    tissue_class_files = []
+    partial_volume_files = []
+    for k in range(number_classes):
+        seg_file = abspath('%s_seg_%d%s' % (out_basename, k, out_ext))
+        save_mask(labels == k + 1, img, seg_file)
+        tissue_class_files.append(seg_file)
+
+        pve_file = abspath('%s_pve_%d%s' % (out_basename, k, out_ext))
+        pve_img = Nifti1Image(pve[k], img.affine)
+        pve_img.set_data_dtype(float32)
+        save(pve_img, pve_file)
+        partial_volume_files.append(pve_file)
+    return(tissue_class_files, partial_volume_files)
@@ -0,0 +1,201 @@
+# Volume I/O helpers shared by the workflow nodes.
+#
+# Functions meant to be wrapped directly in a nipype Function node keep all of
+# their imports inside the function body, because nipype only ships the
+# function's source to the worker.
+
+import numpy as np
+import nibabel as nib
+
+
+def load_volume(in_file):
+    """Load an image and its voxel data without promoting the dtype.
+
+    Uncompressed files are memory-mapped, so only the voxels that are touched
+    get paged in. Data stored with a scale factor comes back scaled (float);
+    label and mask volumes are returned in their on-disk integer dtype.
+    Returns (img, data).
+    """
+    img = nib.load(in_file, mmap='r')
+    return img, np.asanyarray(img.dataobj)
+
+
+def save_mask(mask, ref_img, out_file):
+    """Write a 0/1 mask as uint8 using the geometry of ref_img."""
+    header = ref_img.header.copy()
+    header.set_data_dtype(np.uint8)
+    if hasattr(header, 'set_slope_inter'):
+        header.set_slope_inter(1, 0)
+    mask_img = nib.Nifti1Image(np.asarray(mask, dtype=np.uint8), ref_img.affine,
+                               header)
+    nib.save(mask_img, out_file)
+    return mask_img
+
+
+def convert_to_std(in_file, out_file='out.nii.gz', orientation='LAS',
+                   cache_dir=None):
+    """Convert a FreeSurfer volume to NIfTI in standard axis order.
+
+    In-process replacement for MRIConvert followed by Reorient2Std: the voxel
+    array is only permuted/flipped (no resampling) so its axes follow
+    `orientation` ('LAS' matches fslreorient2std / MNI152, 'RAS' is the
+    nibabel canonical order), and a single output file is written in the
+    input's on-disk dtype. With cache_dir set, results are shared through
+    ct_tools.result_cache.
+    """
+    from os.path import abspath
+    from nibabel import load, save, Nifti1Image
+    from nibabel.orientations import (io_orientation, axcodes2ornt,
+                                      ornt_transform, apply_orientation,
+                                      inv_ornt_aff)
+    from numpy import asanyarray, ascontiguousarray
+
+    def _convert():
+        img = load(in_file)
+        data = asanyarray(img.dataobj)
+        transform = ornt_transform(io_orientation(img.affine),
+                                   axcodes2ornt(tuple(orientation)))
+        data = ascontiguousarray(apply_orientation(data, transform))
+        affine = img.affine.dot(inv_ornt_aff(transform, img.shape))
+
+        out_img = Nifti1Image(data, affine)
+        out_img.set_data_dtype(img.get_data_dtype())
+        out_img.set_qform(affine, code=1)
+        out_img.set_sform(affine, code=1)
+        save(out_img, out_file)
+        return([abspath(out_file)])
+
+    if cache_dir:
+        from ct_tools.result_cache import ResultCache
+        params = {'out_file': out_file, 'orientation': orientation}
+        return(ResultCache(cache_dir).run('convert_to_std', [in_file], params,
+                                          _convert)[0])
+    return(_convert()[0])
+
+
+# Intermediate formats: uncompressed .nii can be memory-mapped by the next
+# node; .nii.gz written through nibabel uses its fast default (level 1).
+INTERMEDIATE_EXT = {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}
+
+
+def compress_outputs(in_files, compresslevel=6):
+    """Gzip uncompressed NIfTI files on their way to the DataSink.
+
+    Accepts a single file or a list and returns the same shape. Files that are
+    already compressed are passed through untouched; .nii files are streamed
+    into <name>.nii.gz in the working directory without decoding the image.
+    """
+    import gzip
+    from os.path import abspath, basename
+    from shutil import copyfileobj
+
+    def _compress(in_file):
+        if not in_file.endswith('.nii'):
+            return(in_file)
+        out_file = abspath(basename(in_file) + '.gz')
+        with open(in_file, 'rb') as f_in:
+            with gzip.open(out_file, 'wb', compresslevel=compresslevel) as f_out:
+                copyfileobj(f_in, f_out, 1024 * 1024)
+        return(out_file)
+
+    if isinstance(in_files, (list, tuple)):
+        return([_compress(f) for f in in_files])
+    return(_compress(in_files))
+
+
+# Brain bounding-box cropping. The conformed volumes are 256^3 but the brain
+# fills a fraction of the field of view, so FAST and template construction
+# run on the brain's bounding box plus a margin. The crop is recorded in the
+# affine (same voxel size and axes, shifted origin), which is all that is
+# needed to put results back on the full grid (uncrop_image).
+#
+# template_flow builds the template from cropped T1s and priors_flow registers
+# the same cropped T1s to it, so both take their crop from TEMPLATE_CROP (a
+# T1 cropped with another margin is a different moving image). segment_flow's
+# crop only bounds FAST's field of view; its outputs go back on the full grid.
+TEMPLATE_CROP = {'crop_brain': True, 'margin': 20}
+SEGMENT_CROP = {'crop_brain': True, 'margin': 10}
+
+def brain_bbox(mask, margin=0):
+    """Bounding box of the nonzero voxels of a 3D array, grown by margin voxels.
+
+    Returns a tuple of slices (clipped to the array), or None for an empty mask.
+    """
+    mask = np.asanyarray(mask)
+    xy = mask.any(axis=2)
+    spans = [np.flatnonzero(xy.any(axis=1)), np.flatnonzero(xy.any(axis=0)),
+             np.flatnonzero(mask.any(axis=(0, 1)))]
+    if not len(spans[0]):
+        return None
+    return tuple(slice(max(int(span[0]) - margin, 0), min(int(span[-1]) + 1 + margin, size))
+                 for span, size in zip(spans, mask.shape[:3]))
+
+
+def crop_offsets(img, ref_img, tol=1e-3):
+    """Voxel offset of img's first voxel in ref_img's grid.
+
+    img must be a crop of ref_img's grid (same voxel axes and sizes, origin on
+    a ref_img voxel, inside its field of view); raises ValueError otherwise.
+    """
+    vox2vox = np.linalg.inv(ref_img.affine).dot(img.affine)
+    offsets = np.round(vox2vox[:3, 3]).astype(int)
+    if (not np.allclose(vox2vox[:3, :3], np.eye(3), atol=tol) or
+            not np.allclose(vox2vox[:3, 3], offsets, atol=tol)):
+        raise ValueError('image is not on a crop of the reference grid')
+    if (offsets < 0).any() or (offsets + img.shape[:3] > np.array(ref_img.shape[:3])).any():
+        raise ValueError('cropped image extends outside the reference field of view')
+    return tuple(int(o) for o in offsets)
+
+
+def uncrop_image(img, ref_img):
+    """Place a cropped image back on ref_img's full grid (zeros outside the crop)."""
+    offsets = crop_offsets(img, ref_img)
+    data = np.asanyarray(img.dataobj)
+    full = np.zeros(tuple(ref_img.shape[:3]) + data.shape[3:], dtype=data.dtype)
+    full[tuple(slice(o, o + n) for o, n in zip(offsets, data.shape[:3]))] = data
+    header = img.header.copy()
+    header.set_data_dtype(data.dtype)
+    if hasattr(header, 'set_slope_inter'):
+        header.set_slope_inter(1, 0)
+    return nib.Nifti1Image(full, ref_img.affine, header)
+
+
+def crop_to_brain(in_file, out_file='cropped.nii.gz', mask_file=None, margin=10,
+                  threshold=0):
+    """Crop a volume to the brain's bounding box plus margin voxels.
+
+    The brain is the voxels of mask_file above threshold (in_file itself when
+    no mask is given, e.g. a skull-stripped brainmask). mask_file may be on any
+    grid aligned with in_file in world space (e.g. FreeSurfer's brainmask.mgz
+    for a reoriented T1): the box is carried over through the affines. The
+    output keeps in_file's voxel data and dtype; its affine records the crop
+    offset, so uncrop_image can restore the full field of view.
+    """
+    from os.path import abspath
+    from itertools import product
+    import numpy as np
+    import nibabel as nib
+    from ct_tools.volume_io import brain_bbox, load_volume
+
+    img, data = load_volume(in_file)
+    if mask_file:
+        mask_img, mask_data = load_volume(mask_file)
+    else:
+        mask_img, mask_data = img, data
+    box = brain_bbox(mask_data > threshold)
+    if box is None:
+        box = tuple(slice(0, n) for n in img.shape[:3])
+    else:
+        if mask_img is not img:
+            # mask box corners -> in_file voxels
+            corners = np.array([list(c) + [1] for c in product(*[(s.start, s.stop - 1) for s in box])]).T
+            vox = np.linalg.inv(img.affine).dot(mask_img.affine).dot(corners)[:3]
+            box = tuple(slice(int(np.floor(lo)), int(np.ceil(hi)) + 1)
+                        for lo, hi in zip(vox.min(axis=1), vox.max(axis=1)))
+        box = tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n))
+                    for s, n in zip(box, img.shape[:3]))
+    cropped = img.slicer[box]
+    cropped.set_data_dtype(img.get_data_dtype())
+    nib.save(cropped, out_file)
+    return(abspath(out_file))
+
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# Parallel, resumable replacement for run_template_kids_fs6.sh
+#
+# Runs recon-all for several subjects at once, splitting the available cores
+# into (concurrent subjects) x (OpenMP threads per subject). Subjects that
+# already have scripts/recon-all.done are skipped, so the batch can simply be
+# resubmitted if the job dies. Every started and every finished subject is
+# appended as one JSON line (status, host/pid or exit code, wall time) to
+# recon_batch_log.jsonl. A resubmitted batch resumes unfinished subjects:
+# subjects whose recon-all is still alive according to that log are left
+# alone, the others get their stale scripts/IsRunning.* locks removed (recon-all
+# will not start while they exist) and restart from their own mri/orig/001.mgz,
+# or from the raw input if the crash came before that was written.
+#
+# Example (32 cores as 8 subjects x 4 threads):
+#   python run_recon_batch.py --cores 32 --threads 4
+#
+# --recon-all can point at a stub executable for testing.
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from os.path import abspath, exists, join
+from threading import Lock
+
+# Set up study specific variables
+raw_dir = '/share/iang/active/ELS/ELS_FreeSurfer/ELS_FS_subjDir'
+fs_subjdir = '/share/iang/active/ELS/ELS_FreeSurfer/Analysis/proc/template_fs6'
+
+template_subs = ['145-T1', '156-Tmid', '137x-Tmid', '183-T1', '307-TK1', '031-T1',
+                 '196-T1', '202-T1', '164-Tmid', '005-T1', '125-Tmid', '146-Tmid',
+                 '002-T1', '034-T1', '159-T2', '302-TK1', '026-T1', '120-T2',
+                 '023-T1', '110x-T2', '069-T2', '086x-T1', '103-T1', '106-T2',
+                 '055-T2', '077-T1', '149-T1', '024-Tmid', '038-T2', '006-TK3']
+
+
+def is_done(subjects_dir, sub):
+    return exists(join(subjects_dir, sub, 'scripts', 'recon-all.done'))
+
+
+def plan_slots(cores, threads):
+    # number of subjects that can run at once without oversubscribing
+    if threads < 1:
+        raise ValueError('threads per subject must be >= 1')
+    return max(1, cores // threads)
+
+
+def has_orig(subjects_dir, sub):
+    return exists(join(subjects_dir, sub, 'mri', 'orig', '001.mgz'))
+
+
+def recon_command(sub, raw_dir, subjects_dir, threads, recon_all='recon-all',
+                  extra_flags=('-gcut',)):
+    cmd = [recon_all, '-s', sub]
+    # a subject with its own orig/001.mgz but no recon-all.done is a crashed
+    # run, restarted from that volume (recon-all refuses -i for an existing
+    # subject); anything earlier starts over from the raw input
+    if not has_orig(subjects_dir, sub):
+        cmd += ['-i', join(raw_dir, sub, 'mri', 'orig', '001.mgz')]
+    cmd += ['-all'] + list(extra_flags) + ['-openmp', str(threads)]
+    return cmd
+
+
+def read_batch_log(log_file):
+    # latest record of each subject
+    latest = {}
+    if exists(log_file):
+        with open(log_file) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    latest[record['subject']] = record
+    return latest
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_live(record):
+    # only a recon-all started on this host can be checked; a 'running'
+    # record from another host is a job that died without logging its end
+    return (record is not None and record['status'] == 'running' and
+            record.get('host') == socket.gethostname() and pid_alive(record['pid']))
+
+
+def clear_stale_locks(subjects_dir, sub):
+    # recon-all will not start while scripts/IsRunning.* exist
+    locks = sorted(glob.glob(join(subjects_dir, sub, 'scripts', 'IsRunning.*')))
+    for lock in locks:
+        os.remove(lock)
+    return locks
+
+
+class BatchLog(object):
+    # thread-safe writer for the JSON lines log and the legacy log.txt
+
+    def __init__(self, log_file, subjects_dir):
+        self.log_file = log_file
+        self.legacy_file = join(subjects_dir, 'log.txt')
+        self.lock = Lock()
+
+    def write(self, record):
+        with self.lock:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            if record['status'] in ('skipped', 'running'):
+                return
+            with open(self.legacy_file, 'a') as f:
+                if record['status'] == 'done':
+                    f.write('-------------- %s  finished running.\n' % record['subject'])
+                else:
+                    f.write('WARNING:  %s  did not complete!!\n' % record['subject'])
+
+
+def run_subject(sub, raw_dir, subjects_dir, threads, log_dir, recon_all,
+                extra_flags, log=None):
+    cleared = clear_stale_locks(subjects_dir, sub)
+    if exists(join(subjects_dir, sub)) and not has_orig(subjects_dir, sub):
+        # crashed during setup: -i needs the subject directory to be gone
+        shutil.rmtree(join(subjects_dir, sub))
+    cmd = recon_command(sub, raw_dir, subjects_dir, threads, recon_all,
+                        extra_flags)
+    env = dict(os.environ, SUBJECTS_DIR=subjects_dir,
+               OMP_NUM_THREADS=str(threads))
+    start = time.time()
+    with open(join(log_dir, sub + '.recon-all.out'), 'w') as out:
+        for lock in cleared:
+            out.write('removed stale lock %s\n' % lock)
+        out.flush()
+        try:
+            proc = subprocess.Popen(cmd, env=env, stdout=out,
+                                    stderr=subprocess.STDOUT)
+        except OSError as e:
+            out.write('could not start recon-all: %s\n' % e)
+            returncode = -1
+        else:
+            if log is not None:
+                log.write({'subject': sub, 'status': 'running',
+                           'host': socket.gethostname(), 'pid': proc.pid,
+                           'threads': threads,
+                           'start': datetime.fromtimestamp(start).isoformat(),
+                           'command': cmd})
+            returncode = proc.wait()
+    wall_time = time.time() - start
+
+    done = is_done(subjects_dir, sub)
+    return {'subject': sub,
+            'status': 'done' if (returncode == 0 and done) else 'failed',
+            'returncode': returncode,
+            'threads': threads,
+            'start': datetime.fromtimestamp(start).isoformat(),
+            'wall_time_s': round(wall_time, 1),
+            'command': cmd}
+
+
+def run_batch(subjects, raw_dir, subjects_dir, cores, threads, log_dir,
+              recon_all='recon-all', extra_flags=('-gcut',)):
+    if not exists(log_dir):
+        os.makedirs(log_dir)
+    log = BatchLog(join(log_dir, 'recon_batch_log.jsonl'), subjects_dir)
+    previous = read_batch_log(log.log_file)
+
+    todo = []
+    for sub in subjects:
+        if is_done(subjects_dir, sub) or is_live(previous.get(sub)):
+            log.write({'subject': sub, 'status': 'skipped', 'returncode': None,
+                       'threads': 0, 'start': None, 'wall_time_s': 0.0,
+                       'command': None,
+                       'reason': 'done' if is_done(subjects_dir, sub) else 'running'})
+        else:
+            todo.append(sub)
+
+    records = []
+    slots = plan_slots(cores, threads)
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        futures = [pool.submit(run_subject, sub, raw_dir, subjects_dir,
+                               threads, log_dir, recon_all, extra_flags, log)
+                   for sub in todo]
+        for future in as_completed(futures):
+            record = future.result()
+            log.write(record)
+            records.append(record)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run recon-all for many subjects in parallel.')
+    parser.add_argument('subjects', nargs='*', default=template_subs,
+                        help='subject IDs (default: the template subjects)')
+    parser.add_argument('--raw-dir', default=raw_dir)
+    parser.add_argument('--subjects-dir', default=fs_subjdir)
+    parser.add_argument('--cores', type=int, default=os.cpu_count(),
+                        help='total cores available to the batch')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='OpenMP threads per recon-all run')
+    parser.add_argument('--log-dir', default='recon_batch_logs',
+                        help='where per-subject output and the JSON log go')
+    parser.add_argument('--recon-all', default='recon-all',
+                        help='recon-all executable (or a stub for testing)')
+    parser.add_argument('--flags', default='-gcut',
+                        help='extra recon-all flags, space separated')
+    args = parser.parse_args(argv)
+
+    print('%d subjects, %d at a time with %d threads each' %
+          (len(args.subjects), plan_slots(args.cores, args.threads), args.threads))
+    records = run_batch(args.subjects, abspath(args.raw_dir),
+                        abspath(args.subjects_dir),
+                        args.cores, args.threads, args.log_dir,
+                        recon_all=args.recon_all,
+                        extra_flags=tuple(args.flags.split()))
+    failed = [r['subject'] for r in records if r['status'] != 'done']
+    if failed:
+        print('did not complete: ' + ' '.join(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,6 @@
+import sys
+from os.path import abspath, dirname
+
+REPO = dirname(dirname(abspath(__file__)))
+STUB_DIR = REPO + '/benchmarks/stubs'
+sys.path.insert(0, REPO)
@@ -0,0 +1,59 @@
+import os
+import stat
+
+import pytest
+
+from ct_tools.delivery import deliver_file
+
+
+def make_file(path, text='data', read_only=False):
+    with open(path, 'w') as f:
+        f.write(text)
+    if read_only:
+        os.chmod(path, stat.S_IRUSR | stat.S_IRGRP)
+    return path
+
+
+def writable(path):
+    return bool(os.stat(path).st_mode & stat.S_IWUSR)
+
+
+@pytest.mark.parametrize('mode', ['reflink', 'copy'])
+def test_default_modes_deliver_independent_writable_files(tmp_path, mode):
+    src = make_file(str(tmp_path / 'gm.nii.gz'), read_only=True)
+    dst = str(tmp_path / 'sink' / 'gm.nii.gz')
+    assert deliver_file(src, dst, mode) in ('reflink', 'copy')
+    assert not os.path.samefile(src, dst)
+    assert writable(dst)
+    with open(dst, 'a') as f:
+        f.write(' edited')
+    with open(src) as f:
+        assert f.read() == 'data'
+
+
+def test_default_is_not_a_hard_link(tmp_path):
+    src = make_file(str(tmp_path / 'gm.nii.gz'))
+    dst = str(tmp_path / 'gm_sink.nii.gz')
+    deliver_file(src, dst)
+    assert not os.path.samefile(src, dst)
+
+
+def test_link_mode_copies_read_only_cache_objects(tmp_path):
+    cached = make_file(str(tmp_path / 'cached.nii.gz'), read_only=True)
+    dst = str(tmp_path / 'cached_sink.nii.gz')
+    assert deliver_file(cached, dst, 'link') in ('reflink', 'copy')
+    assert writable(dst)
+
+    work = make_file(str(tmp_path / 'work.nii.gz'))
+    dst = str(tmp_path / 'work_sink.nii.gz')
+    assert deliver_file(work, dst, 'link') in ('reflink', 'hardlink')
+    assert deliver_file(work, dst, 'link') == 'kept'
+
+
+def test_earlier_hard_link_is_broken(tmp_path):
+    src = make_file(str(tmp_path / 'gm.nii.gz'))
+    dst = str(tmp_path / 'gm_sink.nii.gz')
+    os.link(src, dst)
+    assert deliver_file(src, dst) != 'kept'
+    assert not os.path.samefile(src, dst)
+    assert deliver_file(src, dst) == 'kept'
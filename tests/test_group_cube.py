@@ -0,0 +1,107 @@
+from os.path import getsize
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from ct_tools import group_cube
+from ct_tools.group_cube import GroupCube
+
+SHAPE = (5, 4, 3)
+
+
+def save(data, path, affine=np.eye(4)):
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype=np.float32), affine), path)
+    return path
+
+
+@pytest.fixture
+def cube(tmp_path):
+    mask = np.zeros(SHAPE)
+    mask[1:4, 1:3, :] = 1
+    return GroupCube.create(str(tmp_path / 'cube'), save(mask, str(tmp_path / 'mask.nii.gz')))
+
+
+@pytest.fixture
+def maps(tmp_path):
+    """Template-space thickness map of each session, and its data."""
+    rng = np.random.RandomState(0)
+    maps = {}
+    for sub in ('001-T1', '001-T2', '002-T1', '003-TK1'):
+        data = rng.uniform(1, 4, SHAPE)
+        maps[sub] = (save(data, str(tmp_path / ('%s.nii.gz' % sub))), data)
+    return maps
+
+
+def append(cube, maps, subjects, **kwargs):
+    return cube.append([maps[sub][0] for sub in subjects], subjects, **kwargs)
+
+
+def check_rows(cube, maps):
+    assert getsize(cube.data_file) == len(cube) * cube.n_voxels * 4
+    data = cube.data()
+    for k, sub in enumerate(cube.subject_ids):
+        np.testing.assert_allclose(data[k], maps[sub][1][cube.mask], rtol=1e-6)
+
+
+def test_append(cube, maps):
+    assert cube.n_voxels == 18 and len(cube) == 0
+    assert append(cube, maps, ['001-T1', '002-T1']) == (['001-T1', '002-T1'], [])
+    assert append(cube, maps, ['001-T2']) == (['001-T2'], [])
+    reopened = GroupCube(cube.cube_dir)
+    assert reopened.subject_ids == ['001-T1', '002-T1', '001-T2']
+    assert [(r['participant'], r['session']) for r in reopened.rows] == \
+        [('001', 'T1'), ('002', 'T1'), ('001', 'T2')]
+    check_rows(reopened, maps)
+    volume = reopened.to_volume(reopened.data()[1]).get_fdata()
+    np.testing.assert_allclose(volume[reopened.mask], maps['002-T1'][1][reopened.mask], rtol=1e-6)
+    assert (volume[~reopened.mask] == 0).all()
+
+
+def test_reappend_existing_subject(cube, maps, tmp_path):
+    append(cube, maps, ['001-T1', '002-T1'])
+    assert append(cube, maps, ['001-T1', '002-T1']) == ([], [])
+
+    # re-run session: its row is overwritten in place
+    new = np.full(SHAPE, 2.5)
+    maps['001-T1'] = (save(new, maps['001-T1'][0]), new)
+    assert append(cube, maps, ['001-T1'], replace_changed=False) == ([], [])
+    assert append(cube, maps, ['001-T1', '003-TK1']) == (['003-TK1'], ['001-T1'])
+    assert cube.subject_ids == ['001-T1', '002-T1', '003-TK1']
+    check_rows(GroupCube(cube.cube_dir), maps)
+
+
+def test_interrupted_append_is_dropped(cube, maps, monkeypatch):
+    append(cube, maps, ['001-T1'])
+
+    # the data is written, then the process dies before the index update
+    def _crash(path, obj):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(group_cube, '_write_json', _crash)
+    with pytest.raises(KeyboardInterrupt):
+        append(cube, maps, ['002-T1'])
+    monkeypatch.undo()
+    reopened = GroupCube(cube.cube_dir)
+    assert reopened.subject_ids == ['001-T1']
+    assert getsize(cube.data_file) > len(reopened) * reopened.n_voxels * 4
+
+    # and a half-written row on top
+    with open(cube.data_file, 'ab') as f:
+        f.write(b'\0' * 10)
+    assert append(reopened, maps, ['003-TK1', '002-T1']) == (['003-TK1', '002-T1'], [])
+    check_rows(GroupCube(cube.cube_dir), maps)
+
+
+def test_off_grid_map_is_rejected(cube, maps, tmp_path):
+    shifted = save(maps['001-T1'][1], str(tmp_path / 'shifted.nii.gz'), np.diag([2, 2, 2, 1]))
+    with pytest.raises(ValueError):
+        cube.append([shifted], ['001-T1'])
+    assert len(GroupCube(cube.cube_dir)) == 0
+
+
+def test_create_twice(cube, tmp_path):
+    with pytest.raises(IOError):
+        GroupCube.create(cube.cube_dir, cube.mask_file)
+    assert GroupCube.open_or_create(cube.cube_dir, cube.mask_file).cube_dir == cube.cube_dir
+    with pytest.raises(IOError):
+        GroupCube(str(tmp_path))
@@ -0,0 +1,110 @@
+import os
+from os.path import join
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from ct_tools.regional import (TABLE_COLUMNS, extract_regional_measures, label_stats,
+                               read_long_table, write_long_table)
+
+AFFINE = np.diag([2.0, 2.0, 2.0, 1.0])  # 8 mm^3 voxels
+LABEL_SCHEME = {'gm': [3, 17], 'wm': [2]}
+
+
+@pytest.fixture
+def subjects_dir(tmp_path):
+    """Two sessions with the same labels; (subjects_dir, labels, thickness map file, thickness)."""
+    labels = np.zeros((6, 4, 4), dtype=np.int32)
+    labels[0:2] = 2                  # WM: no thickness
+    labels[2:4] = 3                  # cortex
+    labels[4, :2] = 17               # hippocampus
+    thickness = np.zeros(labels.shape, dtype=np.float32)
+    rng = np.random.RandomState(0)
+    thickness[2:5] = rng.uniform(1, 4, (3, 4, 4))
+    thickness[2, 0, 0] = 0           # a cortex voxel without thickness
+    subjects_dir = str(tmp_path / 'fs')
+    for sub in ('001-T1', '001-T2'):
+        os.makedirs(join(subjects_dir, sub, 'mri'))
+        for atlas in ('aseg', 'aparc+aseg'):
+            nib.save(nib.MGHImage(labels, AFFINE), join(subjects_dir, sub, 'mri', atlas + '.mgz'))
+    thickness_file = str(tmp_path / 'thickness.nii.gz')
+    nib.save(nib.Nifti1Image(thickness, AFFINE), thickness_file)
+    return subjects_dir, labels, thickness_file, thickness
+
+
+@pytest.fixture
+def lut_file(tmp_path):
+    lut_file = str(tmp_path / 'FreeSurferColorLUT.txt')
+    with open(lut_file, 'w') as f:
+        f.write('#No. Label Name: R G B A\n'
+                '2   Left-Cerebral-White-Matter  245 245 245 0\n'
+                '3   Left-Cerebral-Cortex        205 62  78  0\n')
+    return lut_file
+
+
+def test_label_stats():
+    labels = np.array([0, 1, 1, 1, 3, 3])
+    thickness = np.array([5, 1, 2, 0, 0, 0], dtype=float)
+    stats = label_stats(labels, thickness)
+    np.testing.assert_array_equal(stats['count'], [1, 3, 0, 2])
+    np.testing.assert_array_equal(stats['thickness_count'], [1, 2, 0, 0])
+    np.testing.assert_array_equal(stats['thickness_sum'], [5, 3, 0, 0])
+    with pytest.raises(ValueError):
+        label_stats(labels, thickness[:-1])
+
+
+def test_regional_measures(subjects_dir, lut_file):
+    subjects_dir, labels, thickness_file, thickness = subjects_dir
+    table = extract_regional_measures(['001-T1', '001-T2'], subjects_dir, {'001-T1': thickness_file},
+                                      label_scheme=LABEL_SCHEME, lut_file=lut_file, n_procs=2)
+    assert list(table.columns) == TABLE_COLUMNS
+    assert set(zip(table.subject_id, table.participant, table.session)) == \
+        {('001-T1', '001', 'T1'), ('001-T2', '001', 'T2')}
+    assert sorted(table.atlas.unique()) == ['aparc+aseg', 'aseg', 'tissue']
+
+    def value(sub, atlas, region, measure):
+        rows = table[(table.subject_id == sub) & (table.atlas == atlas) &
+                     (table.region == region) & (table.measure == measure)]
+        assert len(rows) == 1
+        return rows.value.iloc[0]
+
+    regions = [('Left-Cerebral-White-Matter', labels == 2), ('Left-Cerebral-Cortex', labels == 3),
+               ('label_17', labels == 17), ('gm', (labels == 3) | (labels == 17)),
+               ('wm', labels == 2)]
+    for region, voxels in regions:
+        atlas = 'tissue' if region in LABEL_SCHEME else 'aseg'
+        for sub in ('001-T1', '001-T2'):
+            assert value(sub, atlas, region, 'volume_mm3') == pytest.approx(8 * voxels.sum())
+        values = thickness[voxels & (thickness > 0)]
+        if len(values):
+            assert value('001-T1', atlas, region, 'thickness_mean') == pytest.approx(values.mean())
+            assert value('001-T1', atlas, region, 'thickness_std') == pytest.approx(values.std(), abs=1e-6)
+        else:
+            assert np.isnan(value('001-T1', atlas, region, 'thickness_mean'))
+            assert np.isnan(value('001-T1', atlas, region, 'thickness_std'))
+    # sessions without a thickness map only get volumes
+    assert set(table[table.subject_id == '001-T2'].measure) == {'volume_mm3'}
+    assert (table[table.atlas == 'tissue'].label == -1).all()
+
+
+@pytest.mark.parametrize('ext, module', [('.csv.gz', None), ('.parquet', 'pyarrow'),
+                                         ('.h5', 'tables')])
+def test_long_table_round_trip(subjects_dir, tmp_path, ext, module):
+    if module:
+        pytest.importorskip(module)
+    subjects_dir, _, thickness_file, _ = subjects_dir
+    table = extract_regional_measures(['001-T1'], subjects_dir, {'001-T1': thickness_file},
+                                      label_scheme=LABEL_SCHEME, n_procs=1)
+    out_file = write_long_table(table, str(tmp_path / 'tables' / ('regional' + ext)))
+    read = read_long_table(out_file)
+    assert list(read.columns) == TABLE_COLUMNS
+    assert len(read) == len(table)
+    for column in ('subject_id', 'participant', 'session', 'region'):
+        assert list(read[column].astype(str)) == list(table[column].astype(str))
+    np.testing.assert_allclose(read.value, table.value)
+
+
+def test_unknown_table_format(tmp_path):
+    with pytest.raises(ValueError):
+        write_long_table(None, str(tmp_path / 'regional.xlsx'))
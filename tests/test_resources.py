@@ -0,0 +1,27 @@
+import pytest
+
+from ct_tools.resources import plan_threads
+
+
+@pytest.mark.parametrize('total_cores', [1, 2, 3])
+def test_threads_never_exceed_small_core_counts(total_cores):
+    threads, concurrent = plan_threads(10, total_cores, 64, 8, min_threads=2, max_threads=8)
+    assert 1 <= threads <= total_cores
+    assert 1 <= concurrent and threads * concurrent <= total_cores
+
+
+def test_single_core_host():
+    assert plan_threads(4, 1, min_threads=2) == (1, 1)
+    assert plan_threads(0, 1, min_threads=2) == (1, 0)
+
+
+def test_jobs_fill_the_cores():
+    assert plan_threads(4, 16) == (4, 4)
+    assert plan_threads(2, 16, max_threads=8) == (8, 2)
+    assert plan_threads(100, 16, min_threads=2) == (2, 8)
+
+
+def test_memory_limits_concurrent_jobs():
+    threads, concurrent = plan_threads(10, 32, total_mem_gb=24, mem_gb_per_job=8)
+    assert concurrent == 3
+    assert threads == 8
@@ -0,0 +1,119 @@
+import os
+import stat
+from os.path import basename, join
+
+import pytest
+
+from ct_tools import result_cache
+from ct_tools.result_cache import ResultCache, code_digest
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+def counting_compute(out_dir, text='result'):
+    """compute() for ResultCache.run and the list of its calls."""
+    calls = []
+
+    def compute():
+        calls.append(len(calls) + 1)
+        return [write(join(out_dir, 'out_%d.txt' % len(calls)), text)]
+    return compute, calls
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache.setup(str(tmp_path / 'cache'), 1)
+
+
+@pytest.fixture
+def node_dir(tmp_path):
+    node_dir = str(tmp_path / 'node')
+    os.makedirs(node_dir)
+    return node_dir
+
+
+def test_hit_returns_read_only_copies(cache, node_dir, tmp_path):
+    in_file = write(str(tmp_path / 'T1.nii'), 'T1')
+    compute, calls = counting_compute(node_dir)
+    first = cache.run('convert', [in_file], {'orientation': 'RAS'}, compute, node_dir)
+    fetch_dir = str(tmp_path / 'other_node')
+    os.makedirs(fetch_dir)
+    second = cache.run('convert', [in_file], {'orientation': 'RAS'}, compute, fetch_dir)
+    assert len(calls) == 1
+    assert [basename(f) for f in second] == [basename(f) for f in first]
+    with open(second[0]) as f:
+        assert f.read() == 'result'
+    for out_file in first + second:
+        assert not os.stat(out_file).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def test_changed_input_or_params_miss(cache, node_dir, tmp_path):
+    in_file = write(str(tmp_path / 'T1.nii'), 'T1')
+    compute, calls = counting_compute(node_dir)
+    cache.run('convert', [in_file], {'orientation': 'RAS'}, compute, node_dir)
+    cache.run('convert', [in_file], {'orientation': 'LIA'}, compute, node_dir)
+    assert len(calls) == 2
+    write(in_file, 'edited T1')
+    cache.run('convert', [in_file], {'orientation': 'RAS'}, compute, node_dir)
+    assert len(calls) == 3
+
+
+def test_changed_code_misses(cache, node_dir, tmp_path, monkeypatch):
+    in_file = write(str(tmp_path / 'T1.nii'), 'T1')
+    calls = []
+
+    def convert():
+        calls.append('old')
+        return [write(join(node_dir, 'T1_std.nii'), 'old')]
+    key_old = code_digest(convert)
+    cache.run('convert', [in_file], {}, convert, node_dir)
+
+    def convert():
+        calls.append('new')
+        return [write(join(node_dir, 'T1_std.nii'), 'new')]
+    assert code_digest(convert) != key_old
+    out_file, = cache.run('convert', [in_file], {}, convert, node_dir)
+    assert calls == ['old', 'new']
+    with open(out_file) as f:
+        assert f.read() == 'new'
+
+    monkeypatch.setattr(result_cache, 'CACHE_VERSION', result_cache.CACHE_VERSION + 1)
+    cache.run('convert', [in_file], {}, convert, node_dir)
+    assert calls == ['old', 'new', 'new']
+
+
+def test_changed_module_source_misses(tmp_path, monkeypatch):
+    module_file = write(str(tmp_path / 'cache_test_helpers.py'), 'SCALE = 1\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    def compute():
+        return []
+    digest = code_digest(compute, modules=('cache_test_helpers',))
+    assert code_digest(compute, modules=('cache_test_helpers',)) == digest
+    write(module_file, 'SCALE = 2\n')
+    assert code_digest(compute, modules=('cache_test_helpers',)) != digest
+
+
+def test_eviction_keeps_the_cache_under_its_size(tmp_path, node_dir):
+    cache = ResultCache(str(tmp_path / 'cache'), max_size_gb=250e-9)  # 250 bytes
+    in_files = [write(str(tmp_path / ('in%d.nii' % k)), 'input %d' % k) for k in range(3)]
+    compute, calls = counting_compute(node_dir, 'x' * 100)
+    keys = []
+    for k, in_file in enumerate(in_files[:2]):
+        cache.run('convert', [in_file], {}, compute, node_dir)
+        keys.append(cache.entries()[-1][2])
+        meta_file = join(cache.objects_dir, keys[-1], 'meta.json')
+        os.utime(meta_file, (1000 + k, 1000 + k))
+    # using the oldest entry makes the other one least recently used
+    cache.run('convert', [in_files[0]], {}, compute, node_dir)
+    assert len(calls) == 2
+    cache.run('convert', [in_files[2]], {}, compute, node_dir)
+    entries = cache.entries()
+    assert sum(size for _, size, _ in entries) <= cache.max_bytes
+    assert len(entries) == 2
+    assert keys[0] in [key for _, _, key in entries]
+    assert keys[1] not in [key for _, _, key in entries]
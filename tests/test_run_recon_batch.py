@@ -0,0 +1,84 @@
+import json
+import os
+import socket
+from os.path import exists, join
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from conftest import STUB_DIR
+import run_recon_batch
+
+RECON_ALL = join(STUB_DIR, 'recon-all')
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    raw_dir, subjects_dir, log_dir = [str(tmp_path / d) for d in ('raw', 'subjects', 'logs')]
+    for sub in ('001-T1', '002-T1', '003-T1'):
+        os.makedirs(join(raw_dir, sub, 'mri', 'orig'))
+        data = np.zeros((8, 8, 8), dtype=np.uint8)
+        data[2:6, 2:6, 2:6] = 100
+        nib.save(nib.MGHImage(data, np.eye(4)), join(raw_dir, sub, 'mri', 'orig', '001.mgz'))
+    os.makedirs(subjects_dir)
+    return raw_dir, subjects_dir, log_dir
+
+
+def run(dirs, subjects):
+    raw_dir, subjects_dir, log_dir = dirs
+    return dict((r['subject'], r) for r in
+                run_recon_batch.run_batch(subjects, raw_dir, subjects_dir, 2, 1, log_dir,
+                                          recon_all=RECON_ALL))
+
+
+def log_records(log_dir):
+    with open(join(log_dir, 'recon_batch_log.jsonl')) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_finished_subjects_are_skipped(dirs):
+    raw_dir, subjects_dir, log_dir = dirs
+    assert run(dirs, ['001-T1'])['001-T1']['status'] == 'done'
+    assert run(dirs, ['001-T1']) == {}
+    assert log_records(log_dir)[-1]['status'] == 'skipped'
+    assert log_records(log_dir)[-1]['reason'] == 'done'
+
+
+def test_failure_is_logged_and_resumed(dirs, monkeypatch):
+    raw_dir, subjects_dir, log_dir = dirs
+    monkeypatch.setenv('RECON_STUB_FAIL', '002-T1')
+    records = run(dirs, ['001-T1', '002-T1'])
+    assert records['001-T1']['status'] == 'done'
+    assert records['002-T1']['status'] == 'failed'
+    assert records['002-T1']['returncode'] != 0
+    with open(join(subjects_dir, 'log.txt')) as f:
+        assert 'WARNING:  002-T1  did not complete!!' in f.read()
+    # the killed run leaves its lock behind
+    assert exists(join(subjects_dir, '002-T1', 'scripts', 'IsRunning.lh+rh'))
+
+    monkeypatch.delenv('RECON_STUB_FAIL')
+    records = run(dirs, ['001-T1', '002-T1'])
+    assert list(records) == ['002-T1']
+    assert records['002-T1']['status'] == 'done'
+    # resumed from its own orig volume, not the raw input
+    assert '-i' not in records['002-T1']['command']
+    assert not exists(join(subjects_dir, '002-T1', 'scripts', 'IsRunning.lh+rh'))
+
+
+def test_crash_during_setup_restarts_from_raw_input(dirs):
+    raw_dir, subjects_dir, log_dir = dirs
+    os.makedirs(join(subjects_dir, '003-T1', 'scripts'))
+    records = run(dirs, ['003-T1'])
+    assert records['003-T1']['status'] == 'done'
+    assert '-i' in records['003-T1']['command']
+
+
+def test_live_subject_is_left_alone(dirs):
+    raw_dir, subjects_dir, log_dir = dirs
+    os.makedirs(log_dir)
+    with open(join(log_dir, 'recon_batch_log.jsonl'), 'w') as f:
+        f.write(json.dumps({'subject': '001-T1', 'status': 'running',
+                            'host': socket.gethostname(), 'pid': os.getpid()}) + '\n')
+    assert run(dirs, ['001-T1']) == {}
+    assert log_records(log_dir)[-1]['reason'] == 'running'
@@ -0,0 +1,107 @@
+import os
+from os.path import exists, join
+
+import pytest
+
+from ct_tools import staging
+from ct_tools.delivery import deliver_file, delivery_record, read_deliveries, record_deliveries
+from ct_tools.staging import WriteBack, copy_verified, file_sha256, stage_subjects, SEGMENT_FILES
+
+
+def write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+@pytest.fixture
+def share(tmp_path):
+    """/share: FreeSurfer subjects and an already delivered template_proc."""
+    fs_dir = str(tmp_path / 'share' / 'fs')
+    for sub in ('001-T1', '002-T1'):
+        for name in SEGMENT_FILES + ('mri/T1.mgz',):
+            write(join(fs_dir, sub, name), '%s %s' % (sub, name))
+    os.remove(join(fs_dir, '002-T1', 'mri', 'aseg.mgz'))
+    dest_root = str(tmp_path / 'share' / 'template_proc')
+    old = write(join(dest_root, 'anats', '000-T1', 'brainmask.nii.gz'), 'delivered earlier')
+    record_deliveries(dest_root, [delivery_record(dest_root, old, old, 'anats', '000-T1', 'copy')])
+    return fs_dir, dest_root
+
+
+def sink(outbox, container, subject, name, text, scratch):
+    """Deliver a node output into the outbox as a DataSink would."""
+    src = write(join(scratch, 'workflows', subject, name), text)
+    dst = join(outbox, container, subject, name)
+    record_deliveries(outbox, [delivery_record(outbox, dst, src, container, subject,
+                                               deliver_file(src, dst))])
+    return dst
+
+
+def test_stage_subjects(share, tmp_path, capsys):
+    fs_dir, _ = share
+    scratch_dir = stage_subjects(fs_dir, ['001-T1', '002-T1'], str(tmp_path / 'scratch' / 'fs'))
+    staged = sorted(os.path.relpath(join(root, name), scratch_dir)
+                    for root, _, names in os.walk(scratch_dir) for name in names)
+    # only the workflow's files, and missing ones are skipped
+    assert staged == ['001-T1/mri/aseg.mgz', '001-T1/mri/brainmask.mgz',
+                      '001-T1/scripts/recon-all.done',
+                      '002-T1/mri/brainmask.mgz', '002-T1/scripts/recon-all.done']
+    for rel in staged:
+        assert file_sha256(join(scratch_dir, rel)) == file_sha256(join(fs_dir, rel))
+    capsys.readouterr()
+    stage_subjects(fs_dir, ['001-T1', '002-T1'], scratch_dir)
+    assert 'staged 0 files (5 already up to date)' in capsys.readouterr().out
+
+
+def test_write_back(share, tmp_path):
+    _, dest_root = share
+    scratch = str(tmp_path / 'scratch')
+    outbox = join(scratch, 'outbox')
+    delivered = [sink(outbox, 'anats', '001-T1', 'brainmask.nii.gz', 'brain 1', scratch),
+                 sink(outbox, 'gm_files', '001-T1', 'gm.nii.gz', 'gm 1', scratch)]
+
+    writeback = WriteBack(outbox, dest_root, threads=2)
+    writeback.sync()
+    checksums = writeback.close()
+    rels = ['anats/001-T1/brainmask.nii.gz', 'gm_files/001-T1/gm.nii.gz']
+    assert sorted(checksums) == rels
+    for rel, src in zip(rels, delivered):
+        assert checksums[rel] == file_sha256(src) == file_sha256(join(dest_root, rel))
+    sha_files = [name for name in os.listdir(dest_root) if name.endswith('.sha256')]
+    with open(join(dest_root, sha_files[0])) as f:
+        assert sorted(line.split()[1] for line in f) == rels
+
+    # the outbox manifest is merged into /share's, pointing at the files there
+    assert not exists(join(outbox, 'delivered.jsonl'))
+    records = read_deliveries(dest_root)
+    assert sorted(records) == ['anats/000-T1/brainmask.nii.gz'] + rels
+    for rel in rels:
+        assert records[rel]['source'] == join(dest_root, rel)
+        assert records[rel]['method'] == 'copy'
+        assert exists(records[rel]['source'])
+
+
+def test_checksum_mismatch_raises(share, tmp_path, monkeypatch):
+    _, dest_root = share
+    src = write(str(tmp_path / 'scratch' / 'gm.nii.gz'), 'gm')
+    dest = join(dest_root, 'gm_files', 'gm.nii.gz')
+    monkeypatch.setattr(staging, 'file_sha256', lambda path: 'corrupted')
+    with pytest.raises(IOError):
+        copy_verified(src, dest, retries=2)
+    assert os.listdir(os.path.dirname(dest)) == []
+
+
+def test_failed_write_back_keeps_the_outbox_manifest(share, tmp_path, monkeypatch):
+    _, dest_root = share
+    scratch = str(tmp_path / 'scratch')
+    outbox = join(scratch, 'outbox')
+    sink(outbox, 'anats', '001-T1', 'brainmask.nii.gz', 'brain 1', scratch)
+    monkeypatch.setattr(staging, 'file_sha256', lambda path: 'corrupted')
+    writeback = WriteBack(outbox, dest_root)
+    writeback.sync()
+    with pytest.raises(IOError):
+        writeback.close()
+    assert exists(join(outbox, 'delivered.jsonl'))
+    assert sorted(read_deliveries(dest_root)) == ['anats/000-T1/brainmask.nii.gz']
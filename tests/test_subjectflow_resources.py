@@ -0,0 +1,80 @@
+import os
+import sys
+from collections import OrderedDict
+from os.path import join
+
+import pytest
+
+from conftest import REPO
+sys.path.insert(0, join(REPO, 'benchmarks'))
+from bench_pipeline import override_variables
+
+SCRIPT = join(REPO, 'CorticalThicknessProcessing_subjectflow.py')
+
+
+class StopRun(Exception):
+    pass
+
+
+@pytest.fixture
+def build_subject_flow(tmp_path, monkeypatch):
+    """Build subject_flow for n_subjects sessions; returns (workflow, plugin, plugin_args)."""
+    import ct_tools.profiling
+    from nipype.pipeline.engine import Workflow
+    monkeypatch.setattr(Workflow, 'write_graph', lambda self, *args, **kwargs: None)
+    calls = []
+
+    def _run_profiled(workflow, report_dir, plugin, plugin_args=None):
+        calls.append((workflow, plugin, plugin_args))
+        raise StopRun()
+    monkeypatch.setattr(ct_tools.profiling, 'run_profiled', _run_profiled)
+
+    project_home, fs_dir = str(tmp_path / 'project'), str(tmp_path / 'fs')
+    priors_dir = join(project_home, 'proc', 'template', 'priors')
+    os.makedirs(priors_dir)
+    os.makedirs(join(project_home, 'proc', 'template', 'sample_template'))
+    for name in ['sample_template/ELS_CT_template0.nii.gz', 'priors/brain_prior.nii.gz'] + \
+            ['priors/segmentationPriors%d.nii.gz' % k for k in range(1, 5)]:
+        open(join(project_home, 'proc', 'template', name), 'w').close()
+
+    def _build(n_subjects, total_cores, total_mem_gb=64):
+        for k in range(n_subjects):
+            os.makedirs(join(fs_dir, '%03d-T1' % (k + 1), 'scripts'), exist_ok=True)
+            open(join(fs_dir, '%03d-T1' % (k + 1), 'scripts', 'recon-all.done'), 'w').close()
+        with open(SCRIPT) as f:
+            source = override_variables(f.read(), OrderedDict([
+                ('project_home', project_home), ('fs_subjdir', fs_dir),
+                ('total_cores', total_cores), ('total_mem_gb', total_mem_gb)]))
+        with pytest.raises(StopRun):
+            exec(compile(source, SCRIPT, 'exec'), {'__name__': '__main__'})
+        return calls[-1]
+    return _build
+
+
+def test_planned_resources_reach_the_nodes(build_subject_flow):
+    workflow, plugin, plugin_args = build_subject_flow(3, 4)
+    assert plugin == 'MultiProc'
+    assert plugin_args == {'n_procs': 4, 'memory_gb': 64}
+
+    ct = workflow.get_node('corticalthickness')
+    assert (ct.n_procs, ct.mem_gb) == (2, 8)
+    assert ct.inputs.num_threads == 2
+    assert ct.inputs.environ['NSLOTS'] == '2'
+    assert ct.inputs.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] == '2'
+    reorient = workflow.get_node('reorientT1')
+    assert (reorient.n_procs, reorient.mem_gb) == (1, 0.5)
+    to_template = workflow.get_node('thickness_to_template')
+    assert (to_template.n_procs, to_template.mem_gb) == (1, 0.1)
+
+
+@pytest.mark.parametrize('total_cores, threads', [(1, 1), (2, 2), (3, 3), (16, 8)])
+def test_no_node_asks_for_more_than_multiproc_has(build_subject_flow, total_cores, threads):
+    workflow, plugin, plugin_args = build_subject_flow(5, total_cores, total_mem_gb=16)
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        assert node.n_procs <= plugin_args['n_procs']
+        assert node.mem_gb <= plugin_args['memory_gb']
+    # 16 GB allow two 8 GB runs at a time, at most 8 threads each
+    ct = workflow.get_node('corticalthickness')
+    assert ct.n_procs == threads
+    assert ct.inputs.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] == str(threads)
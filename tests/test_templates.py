@@ -0,0 +1,180 @@
+import os
+import sys
+from os.path import join, realpath
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from conftest import REPO, STUB_DIR
+from ct_tools import templates
+from ct_tools.templates import make3DTemplate, make_subject_templates, read_template_state
+from ct_tools.volume_io import compress_outputs
+sys.path.insert(0, join(REPO, 'benchmarks'))
+from synthetic_subjects import session_ids
+
+ANTS_SCRIPT = join(STUB_DIR, 'antsMultivariateTemplateConstruction2.sh')
+
+
+def write_volume(path, value):
+    data = np.zeros((8, 8, 8), dtype=np.float32)
+    data[2:6, 2:6, 2:6] = value
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+    return path
+
+
+@pytest.fixture
+def t1s(tmp_path):
+    in_files = []
+    for sub, value in (('001-T1', 100), ('002-T1', 200)):
+        os.makedirs(str(tmp_path / sub))
+        in_files.append(write_volume(str(tmp_path / sub / 'T1.nii.gz'), value))
+    return in_files
+
+
+@pytest.fixture
+def commands(tmp_path, monkeypatch):
+    """Run in a node directory and record every ANTs command line."""
+    node_dir = tmp_path / 'node'
+    node_dir.mkdir()
+    monkeypatch.chdir(str(node_dir))
+    calls = []
+    run_ants_template = templates._run_ants_template
+
+    def _record(cmd, sample_template, iflogger):
+        calls.append(cmd)
+        return run_ants_template(cmd, sample_template, iflogger)
+    monkeypatch.setattr(templates, '_run_ants_template', _record)
+    return calls
+
+
+def option(cmd, flag):
+    return cmd[cmd.index(flag) + 1]
+
+
+@pytest.mark.parametrize('parallel_mode', sorted(templates.PARALLEL_MODES))
+def test_command_line(t1s, commands, parallel_mode):
+    out_file = make3DTemplate(t1s, 3, 'ELS_CT_', parallel_mode, 2, ANTS_SCRIPT)
+    assert out_file == join(os.getcwd(), 'ELS_CT_template0.nii.gz')
+    cmd, = commands
+    assert cmd[0] == ANTS_SCRIPT
+    assert option(cmd, '-d') == '3'
+    assert option(cmd, '-o') == 'ELS_CT_'
+    assert option(cmd, '-c') == str(templates.PARALLEL_MODES[parallel_mode])
+    assert option(cmd, '-j') == '3'
+    assert (option(cmd, '-r'), option(cmd, '-i')) == ('1', '2')
+    # unique names for the inputs, linked to the real files in order
+    inputs = cmd[-2:]
+    assert [os.path.basename(f) for f in inputs] == ['S0_T1.nii.gz', 'S1_T1.nii.gz']
+    assert [realpath(f) for f in inputs] == [realpath(f) for f in t1s]
+    template = nib.load(out_file).get_fdata()
+    assert template[3, 3, 3] == pytest.approx(150)
+
+
+def test_unknown_parallel_mode(t1s, commands):
+    with pytest.raises(ValueError):
+        make3DTemplate(t1s, 1, 'ELS_CT_', 'condor', 1, ANTS_SCRIPT)
+    assert commands == []
+
+
+def test_stale_links_are_replaced(t1s, commands, tmp_path):
+    other = write_volume(str(tmp_path / 'other_T1.nii.gz'), 1000)
+    os.symlink(other, 'S0_T1.nii.gz')
+    with open('S1_T1.nii.gz', 'w') as f:
+        f.write('copy of an old input')
+    make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 1, ANTS_SCRIPT)
+    assert [realpath(f) for f in commands[0][-2:]] == [realpath(f) for f in t1s]
+
+
+def test_failed_script_raises(t1s, commands, monkeypatch):
+    monkeypatch.setenv('ANTS_STUB_FAIL', '1')
+    with pytest.raises(RuntimeError):
+        make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 1, ANTS_SCRIPT)
+    assert not os.path.exists('ELS_CT_template0.nii.gz')
+
+
+def test_stops_once_converged(t1s, commands, tmp_path):
+    state_dir = str(tmp_path / 'state')
+    make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 4, ANTS_SCRIPT,
+                   tolerance=0.002, state_dir=state_dir)
+    # the stub's second iteration leaves the mean template unchanged
+    assert len(commands) == 2
+    assert option(commands[1], '-z') == join(state_dir, 'iteration01_template0.nii.gz')
+    steps = read_template_state(state_dir)['iterations']
+    assert np.isnan(steps[0]['change'])
+    assert steps[1]['change'] == pytest.approx(0)
+    with open(join(state_dir, 'template_convergence.csv')) as f:
+        assert len(f.readlines()) == 3
+
+    make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 4, ANTS_SCRIPT,
+                   tolerance=0.002, state_dir=state_dir)
+    assert len(commands) == 2
+
+
+def test_resumes_after_last_iteration(t1s, commands, tmp_path):
+    state_dir = str(tmp_path / 'state')
+    make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 2, ANTS_SCRIPT, state_dir=state_dir)
+    assert len(commands) == 2
+    make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 3, ANTS_SCRIPT, state_dir=state_dir)
+    assert len(commands) == 3
+    assert option(commands[2], '-z') == join(state_dir, 'iteration02_template0.nii.gz')
+    assert len(read_template_state(state_dir)['iterations']) == 3
+
+    # other inputs start over
+    write_volume(t1s[1], 300)
+    make3DTemplate(t1s, 1, 'ELS_CT_', 'serial', 1, ANTS_SCRIPT, state_dir=state_dir)
+    assert '-z' not in commands[3]
+    assert len(read_template_state(state_dir)['iterations']) == 1
+    assert not os.path.exists(join(state_dir, 'iteration02_template0.nii.gz'))
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    """Uncompressed T1s of the synthetic benchmark sessions: 000 has two, 001 one."""
+    subject_ids = session_ids(3)
+    in_files = []
+    for k, sub in enumerate(subject_ids):
+        os.makedirs(str(tmp_path / sub))
+        in_files.append(write_volume(str(tmp_path / sub / 'T1.nii'), 100 * (k + 1)))
+    return subject_ids, in_files
+
+
+def test_subject_templates(sessions, tmp_path, monkeypatch):
+    subject_ids, in_files = sessions
+    assert subject_ids == ['000-T1', '000-T2', '001-T1']
+    monkeypatch.chdir(str(tmp_path))
+    state_dir = str(tmp_path / 'state')
+    templates_, participants = make_subject_templates(in_files, subject_ids, n_jobs=2, num_threads=1,
+                                                      iterations=2, ants_script=ANTS_SCRIPT,
+                                                      state_dir=state_dir)
+    assert participants == ['000', '001']
+    assert [os.path.basename(f) for f in templates_] == ['000_template0.nii.gz', '001_template0.nii']
+    # two sessions: built by the ANTs script, in the participant's own directory and state
+    assert os.path.dirname(templates_[0]) == str(tmp_path / 'participant_000')
+    assert nib.load(templates_[0]).get_fdata()[3, 3, 3] == pytest.approx(150)
+    assert len(read_template_state(join(state_dir, '000'))['iterations']) == 2
+    # one session is passed through
+    assert os.path.samefile(templates_[1], in_files[2])
+    assert not os.path.exists(join(state_dir, '001'))
+
+    # as template_flow's gzip_templates delivers them
+    delivered = compress_outputs(templates_)
+    assert [os.path.basename(f) for f in delivered] == ['000_template0.nii.gz', '001_template0.nii.gz']
+    np.testing.assert_array_equal(nib.load(delivered[1]).get_fdata(), nib.load(in_files[2]).get_fdata())
+
+
+def test_subject_templates_from_cache(sessions, tmp_path, monkeypatch):
+    subject_ids, in_files = sessions
+    cache_dir = str(tmp_path / 'cache')
+    outputs = []
+    for run in ('run1', 'run2'):
+        os.makedirs(str(tmp_path / run))
+        monkeypatch.chdir(str(tmp_path / run))
+        outputs.append(make_subject_templates(in_files, subject_ids, n_jobs=1, num_threads=1,
+                                              iterations=1, ants_script=ANTS_SCRIPT,
+                                              cache_dir=cache_dir)[0])
+    # the second run only links the cached templates
+    assert os.path.exists(str(tmp_path / 'run1' / 'participant_000' / 'ants_template.log'))
+    assert not os.path.exists(str(tmp_path / 'run2' / 'participant_000' / 'ants_template.log'))
+    for first, second in zip(*outputs):
+        assert os.path.samefile(first, second)
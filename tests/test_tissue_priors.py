@@ -0,0 +1,138 @@
+import os
+from os.path import join
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from ct_tools import tissue_priors
+from ct_tools.tissue_priors import (BRAIN_CLASS, PRIOR_CLASSES, plan_prior_update,
+                                    read_prior_index, update_priors)
+
+CLASS_NAMES = PRIOR_CLASSES + [BRAIN_CLASS]
+SHAPE = (6, 5, 4)
+# delivered masks of each subject, as priors_flow's SelectFiles templates
+TEMPLATES = dict((name, 'masks/{subject_id}/%s.nii.gz' % name) for name in CLASS_NAMES)
+
+
+def save(data, path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype=np.float32), np.eye(4)), path)
+    return path
+
+
+class Study(object):
+    """Delivered masks under base_dir and their 'warped' versions (new files per warp)."""
+
+    def __init__(self, tmp_path):
+        self.base_dir = str(tmp_path / 'template_proc')
+        self.work_dir = str(tmp_path / 'work')
+        self.state_dir = str(tmp_path / 'priors_state')
+        self.template = save(np.ones(SHAPE), join(self.base_dir, 'template.nii.gz'))
+        self.rng = np.random.RandomState(0)
+        self.masks = {}
+        self.warps = 0
+
+    def deliver(self, sub):
+        """Write new (edited) masks for sub; overlapping classes, so some voxels get rescaled."""
+        self.masks[sub] = [self.rng.uniform(0, 0.6, SHAPE) for _ in CLASS_NAMES]
+        for name, data in zip(CLASS_NAMES, self.masks[sub]):
+            save(data, join(self.base_dir, TEMPLATES[name].format(subject_id=sub)))
+
+    def warp(self, sub):
+        # every warp writes new files, as a rerun nipype node does
+        self.warps += 1
+        return [save(data, join(self.work_dir, 'warp%d' % self.warps, '%s_%s.nii.gz' % (sub, name)))
+                for name, data in zip(CLASS_NAMES, self.masks[sub])]
+
+    def plan(self, subjects):
+        return plan_prior_update(self.state_dir, self.base_dir, TEMPLATES, subjects,
+                                 self.template, CLASS_NAMES)
+
+    def update(self, subjects, removed=None):
+        changed, _, checksums = self.plan(subjects)
+        out_dir = join(self.work_dir, 'priors%d' % self.warps)
+        os.makedirs(out_dir, exist_ok=True)
+        return update_priors([self.warp(sub) for sub in changed], changed, checksums, CLASS_NAMES,
+                             self.template, self.state_dir, removed, out_dir=out_dir)
+
+    def expected(self, subjects):
+        """Priors of a full rebuild from subjects' current masks."""
+        means = [np.mean([self.masks[sub][k] for sub in subjects], axis=0)
+                 for k in range(len(CLASS_NAMES))]
+        scale = 1.0 / np.maximum(np.sum(means[:len(PRIOR_CLASSES)], axis=0), 1.0)
+        return [np.clip(m * scale, 0, 1) for m in means[:len(PRIOR_CLASSES)]], means[-1]
+
+
+def check_priors(result, expected):
+    prior_files, brain_prior = result
+    priors, brain = expected
+    assert len(prior_files) == len(priors)
+    for prior_file, prior in zip(prior_files, priors):
+        np.testing.assert_allclose(nib.load(prior_file).get_fdata(), prior, atol=1e-5)
+    np.testing.assert_allclose(nib.load(brain_prior).get_fdata(), brain, atol=1e-5)
+
+
+@pytest.fixture
+def study(tmp_path):
+    study = Study(tmp_path)
+    for sub in ('001', '002', '003'):
+        study.deliver(sub)
+    return study
+
+
+def test_add_subjects(study):
+    check_priors(study.update(['001', '002']), study.expected(['001', '002']))
+    assert study.plan(['001', '002'])[0] == []
+
+    assert study.plan(['001', '002', '003'])[0] == ['003']
+    check_priors(study.update(['001', '002', '003']), study.expected(['001', '002', '003']))
+    assert sorted(read_prior_index(study.state_dir)['subjects']) == ['001', '002', '003']
+
+
+def test_replace_edited_subject(study):
+    subjects = ['001', '002', '003']
+    study.update(subjects)
+    study.deliver('002')
+    assert study.plan(subjects)[0] == ['002']
+    check_priors(study.update(subjects), study.expected(subjects))
+
+
+def test_remove_subject(study):
+    study.update(['001', '002', '003'])
+    changed, removed, _ = study.plan(['001', '003'])
+    assert (changed, removed) == ([], ['002'])
+    check_priors(study.update(['001', '003'], removed), study.expected(['001', '003']))
+    assert not os.path.exists(join(study.state_dir, 'contributions', '002'))
+    assert study.plan(['001', '003'])[:2] == ([], [])
+
+
+def test_interrupted_update_rebuilds(study, monkeypatch):
+    subjects = ['001', '002', '003']
+    study.update(['001', '002'])
+    study.deliver('002')
+
+    add_subject = tissue_priors.PriorAccumulator.add_subject
+
+    def _crash(self, mask_files, sign=1):
+        if sign > 0:
+            raise KeyboardInterrupt()
+        add_subject(self, mask_files, sign)
+    monkeypatch.setattr(tissue_priors.PriorAccumulator, 'add_subject', _crash)
+    with pytest.raises(KeyboardInterrupt):
+        study.update(subjects)
+    # 002's old masks are subtracted, the new ones never added
+    assert read_prior_index(study.state_dir)['pending'] == '002'
+    monkeypatch.undo()
+
+    assert study.plan(subjects)[0] == subjects
+    check_priors(study.update(subjects), study.expected(subjects))
+    assert read_prior_index(study.state_dir)['pending'] is None
+
+
+def test_other_template_rebuilds(study):
+    study.update(['001', '002'])
+    save(2 * np.ones(SHAPE), study.template)
+    assert study.plan(['001', '002'])[0] == ['001', '002']
+    check_priors(study.update(['001', '002']), study.expected(['001', '002']))
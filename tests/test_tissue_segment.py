@@ -0,0 +1,56 @@
+import sys
+from os.path import join
+
+import numpy as np
+import pytest
+
+from conftest import REPO
+from ct_tools.tissue_maps import order_classes_by_intensity
+from ct_tools.tissue_segment import fit_gmm, segment_tissues
+sys.path.insert(0, join(REPO, 'benchmarks'))
+from bench_segmentation import dice, phantom
+
+MIN_DICE = {1: 0.8, 2: 0.85, 3: 0.9}  # csf, gm, wm on the 32^3 phantom
+
+
+@pytest.fixture(scope='module')
+def segmented():
+    image, truth = phantom(32, seed=0)
+    return image, truth, segment_tissues(image, n_threads=2, slab_size=8)
+
+
+def test_fit_gmm():
+    rng = np.random.RandomState(0)
+    samples = np.concatenate([rng.normal(160, 5, 4000), rng.normal(40, 5, 1000),
+                              rng.normal(110, 5, 3000)])
+    values, counts = np.unique(np.round(samples), return_counts=True)
+    means, variances, weights = fit_gmm(values, counts)
+    np.testing.assert_allclose(means, [40, 110, 160], atol=1)
+    np.testing.assert_allclose(np.sqrt(variances), 5, rtol=0.1)
+    np.testing.assert_allclose(weights, [0.125, 0.375, 0.5], atol=0.01)
+
+
+def test_classes_ordered_by_intensity(segmented):
+    image, truth, (pve, labels, means) = segmented
+    assert list(np.argsort(means)) == [0, 1, 2]
+    # the same order segmentflow's FAST outputs are put in
+    order, pve_means = order_classes_by_intensity(image, pve)
+    assert order == [0, 1, 2]
+    np.testing.assert_allclose(pve_means, means, rtol=0.1)
+
+
+def test_dice_against_truth(segmented):
+    image, truth, (pve, labels, means) = segmented
+    assert labels.dtype == np.uint8 and set(np.unique(labels)) == {0, 1, 2, 3}
+    assert (labels[image == 0] == 0).all()
+    assert (pve[:, image == 0] == 0).all()
+    np.testing.assert_allclose(pve[:, image > 0].sum(axis=0), 1, rtol=1e-5)
+    for k, min_dice in MIN_DICE.items():
+        assert dice(labels == k, truth == k) >= min_dice
+
+
+def test_threads_do_not_change_the_result(segmented):
+    image, truth, (pve, labels, means) = segmented
+    serial_pve, serial_labels, serial_means = segment_tissues(image, n_threads=1, slab_size=32)
+    np.testing.assert_array_equal(serial_labels, labels)
+    np.testing.assert_allclose(serial_pve, pve, atol=1e-6)